@@ -38,30 +38,32 @@ def home():
 @app.route('/db')
 def show_entries(entries=None):
     if not entries:
-        return render_template('show_entries.html', entries=query_db('select * from phase ORDER BY datetime(timestamp) DESC '))
+        return render_template('show_entries.html', entries=query_db('select * from phase ORDER BY timestamp DESC '))
     else:
                 return render_template('show_entries.html', entries=entries)
 @app.route('/failed')
 def show_failed():
-    return render_template('show_failed.html', entries=query_db('select * from phase where status = "f" ORDER BY datetime(timestamp) DESC '))
+    return render_template('show_failed.html', entries=query_db('select * from phase where status IN ("f", "t") ORDER BY timestamp DESC '))
+
+@app.route('/running_all')
+def show_running_all():
+    return render_template('show_running.html', entries=query_db('select * from phase where status = "r" ORDER BY timestamp DESC' ))
 
 @app.route('/running')
 def show_running():
-    return render_template('show_running.html', entries=query_db('select * from phase where status = "r" ORDER BY datetime(timestamp) DESC' ))
+    entries = query_db('select run_id, orthogroup, phase, attempts, started from phase_state '
+                       'where status = "r" ORDER BY phase DESC')
+    return render_template('show_running_now.html', entries=entries)
 
 
 @app.route('/success')
 def show_success():
-    return render_template('show_success.html', entries=query_db('select * from phase where status ="s" ORDER BY datetime(timestamp) DESC'))
+    return render_template('show_success.html', entries=query_db('select * from phase where status ="s" ORDER BY timestamp DESC'))
 
 
 @app.route('/orthogroups')
 def show_ortho():
-    entries = query_db('select run_id, orthogroup, headers from orthoinfo')
-    for e in entries:
-        print(e['headers'])
-        print(e['headers'].replace(',',' '))
-    return render_template('show_ortho.html', entries=query_db('select * from orthoinfo'))
+    return render_template('show_ortho.html', entries=query_db('select run_id, orthogroup, headers from orthoinfo_headers'))
 
 
 @app.route('/subset', methods=['POST'])
@@ -71,10 +73,10 @@ def filter_subset():
     #and_query = ('?', [request.form['rad_and']], )
     andor = request.form['andor']
     if andor == "AND":
-        entries = query_db('select * from phase where orthogroup = ? AND  run_id = ? ORDER BY datetime(timestamp) DESC', [request.form['orthogroup'], request.form['run_id']])
+        entries = query_db('select * from phase where orthogroup = ? AND  run_id = ? ORDER BY timestamp DESC', [request.form['orthogroup'], request.form['run_id']])
 
     if andor == "OR":
-        entries = query_db('select * from phase where orthogroup = ? OR  run_id = ? ORDER BY datetime(timestamp) DESC', [request.form['orthogroup'], request.form['run_id']])
+        entries = query_db('select * from phase where orthogroup = ? OR  run_id = ? ORDER BY timestamp DESC', [request.form['orthogroup'], request.form['run_id']])
     #or_query = ('?',[request.form['or']])
     #print(or_query)
     #if request.form['and']:
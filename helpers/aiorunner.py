@@ -0,0 +1,493 @@
+__author__ = 'jmass'
+import os
+import sys
+import json
+import shlex
+import signal
+import asyncio
+import getopt
+import subprocess
+import contextvars
+import shutil
+import warnings
+import functools
+import threading
+import traceback
+from .cache import ArtifactCache, CACHE_HIT
+from .scratch import scratch_dir, staging_dir, publish, publish_outputs
+from .joblog import RotatingLog, job_log, STDERR_TAIL
+from .rusage import JobUsage, exit_code
+from .mfa2phy import mfa2phy, phy_file
+from .costmodel import read_ctl, raxml_thread_count
+from . import dbwriter
+from .fastahelper import FastaParser
+from .paml_msa import nogap_paml
+from .bootstraps import chunk_run_name, chunk_file, merge_bootstraps, remove_raxml_files
+from .backtranslate import back_translate, BackTranslationException
+from .failures import classify, error_kind, retry_delay, scale_resources, KILL_GRACE
+from .failures import TOOL, TIMEOUT, INPUT, UNKNOWN
+
+"""
+Python 3 only: asyncio versions of the prank, pal2nal, raxml and codeml
+runners of helpers.wrappers, for the "asyncio" backend of
+helpers.jobarray.ArrayScheduler.
+
+    python3 -m helpers.aiorunner [-j JOBS] [-l prank=8,codeml=64] [-p PYTHON2] TASKFILE
+
+runs every task of TASKFILE (written by ArrayScheduler) in one event loop.
+The tools are started without a shell, at most as many per tool at once
+as its limit allows; a RusageWatcher reaps them with os.wait4 for their rusage.
+The back translation runs in a thread of the loop's executor. Tasks of other runners
+(ctl maker, pysickle, ...) need the Python 2 modules, they are handed to
+`PYTHON2 -m helpers.array_worker TASKFILE ID` under the limit of "python".
+"""
+
+# resources of the job running in the current task
+current_job = contextvars.ContextVar("current_job")
+
+
+class ToolFailed(Exception):
+    """kind is the helpers.failures class, as for wrappers.PipelineException"""
+    kind = TOOL
+
+    def __init__(self, message="", kind=None):
+        Exception.__init__(self, message)
+        if kind:
+            self.kind = kind
+
+
+class ToolTimeout(ToolFailed):
+    kind = TIMEOUT
+
+
+def logged(f):
+    """coroutine version of wrappers.db_logger, returns the status of the run.
+    The job waits for a slot of its tool (run_codeml -> codeml) before it is
+    logged as running, run_raxml_bootstraps takes a slot of raxml.
+    Retried attempts give the slot back while they wait for their backoff."""
+    @functools.wraps(f)
+    async def wrapper(self, **kwargs):
+        loop = asyncio.get_running_loop()
+        log_dir = kwargs.pop("log_dir", None)
+        retry = kwargs.pop("retry", None)
+        if log_dir:
+            kwargs["log"] = job_log(log_dir, f.__name__, kwargs)
+        row = functools.partial(dbwriter.log_phase, kwargs.get("db"), kwargs.get("run_id"),
+                                kwargs.get("orthogroup"), kwargs.get("phase"), log=kwargs.get("log"))
+        attempt = 0
+        while True:
+            attempt += 1
+            failure = None
+            async with self.semaphore(f.__name__.replace("run_", "", 1).split("_")[0]):
+                await loop.run_in_executor(None, functools.partial(row, status="r", attempt=attempt))
+                job = JobUsage(in_process=False)  # the loop's own CPU time is shared by all jobs
+                current_job.set(job)
+                try:
+                    res = await f(self, **kwargs)
+                    status = "c" if res == CACHE_HIT else "s"
+                except ToolTimeout as e:
+                    sys.stderr.write(str(e))
+                    status, failure = "t", e.kind
+                except ToolFailed as e:
+                    sys.stderr.write(str(e))
+                    status, failure = "f", e.kind
+                except BaseException:  # no "r" row without an end
+                    row(status="f", usage=job.finish(), failure=UNKNOWN, attempt=attempt)
+                    raise
+                await loop.run_in_executor(None, functools.partial(row, status=status, usage=job.finish(),
+                                                                   failure=failure, attempt=attempt))
+            delay = retry_delay(retry, attempt, failure)
+            if delay is None:
+                return status
+            scale_resources(retry, failure, kwargs)
+            sys.stderr.write("{} of {} failed ({}), attempt {} in {} s\n".format(
+                f.__name__, kwargs.get("orthogroup"), failure, attempt + 1, delay))
+            await asyncio.sleep(delay)
+    return wrapper
+
+
+class RusageWatcher(getattr(asyncio, "AbstractChildWatcher", object)):
+    """child watcher of the processes of asyncio.create_subprocess_exec that reaps
+    them with os.wait4, the rusage of a child is in rusage[pid] once it exited.
+    The loop watches a pidfd of each child; without pidfds (before Linux 5.3)
+    a thread waits for it."""
+    def __init__(self):
+        self.rusage = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def is_active(self):
+        return True
+
+    def attach_loop(self, loop):
+        pass
+
+    def close(self):
+        pass
+
+    def add_child_handler(self, pid, callback, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            fd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            threading.Thread(target=self._wait, args=(loop, pid, callback, args), daemon=True).start()
+            return
+        loop.add_reader(fd, self._reap, loop, fd, pid, callback, args)
+
+    def remove_child_handler(self, pid):
+        return False
+
+    def _reap(self, loop, fd, pid, callback, args):
+        loop.remove_reader(fd)
+        os.close(fd)
+        self._exited(pid, callback, args, *os.wait4(pid, 0)[1:])
+
+    def _wait(self, loop, pid, callback, args):
+        status, rusage = os.wait4(pid, 0)[1:]
+        loop.call_soon_threadsafe(self._exited, pid, callback, args, status, rusage)
+
+    def _exited(self, pid, callback, args, status, rusage):
+        self.rusage[pid] = rusage
+        callback(pid, exit_code(status), *args)
+
+
+_watcher = None
+
+
+def watch_children():
+    """install the RusageWatcher, a Python without child watchers (3.14) records no tool rusage"""
+    global _watcher
+    if _watcher is None and hasattr(asyncio, "set_child_watcher"):
+        _watcher = RusageWatcher()
+        with warnings.catch_warnings():  # deprecated since 3.12
+            warnings.simplefilter("ignore", DeprecationWarning)
+            asyncio.set_child_watcher(_watcher)
+    return _watcher
+
+
+async def drain(stream, log=None, tail=0):
+    """read stream until EOF into log, returns its last tail bytes"""
+    res = b""
+    while True:
+        block = await stream.read(65536)
+        if not block:
+            return res
+        if log:
+            log.write(block)
+        if tail:
+            res = (res + block)[-tail:]
+
+
+class AsyncRunner(object):
+    """Runs the external tools of many jobs from one event loop.
+
+    limits maps a tool name (prank, pal2nal, raxml, codeml, python) to the
+    number of its processes allowed at once, other tools get default.
+    """
+    def __init__(self, limits=None, default=1):
+        self.limits = limits or {}
+        self.default = max(1, int(default))
+        self._semaphores = {}
+        watch_children()
+
+    def semaphore(self, tool):
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(int(self.limits.get(tool, self.default)))
+        return self._semaphores[tool]
+
+    async def exec_tool(self, argv, cwd=None, stdout=None, timeout=None, log=None):
+        """run argv, returns (retval, end of stderr). The process gets a session
+        of its own, it is killed with everything it started when timeout
+        seconds are over (ToolTimeout). Its rusage is added to the current job."""
+        out = err = None
+        if log:
+            out = RotatingLog(log + ".out")
+            err = RotatingLog(log + ".err")
+            out.write("$ {}\n".format(" ".join(argv)).encode("utf-8"))
+        try:
+            p = await asyncio.create_subprocess_exec(*argv, cwd=cwd, start_new_session=True,
+                                                     stdout=stdout or subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:  # no such program, not executable
+            for log_file in (out, err):
+                if log_file:
+                    log_file.close()
+            raise ToolFailed("could not start {}: {}\n".format(argv[0], e), kind=error_kind(e))
+        exited = asyncio.ensure_future(p.wait())
+        readers = [drain(stream, log_file, tail=tail)
+                   for stream, log_file, tail in [(p.stderr, err, STDERR_TAIL), (p.stdout, out, 0)]
+                   if stream is not None]
+        try:
+            res = await asyncio.wait_for(asyncio.gather(asyncio.shield(exited), *readers), timeout)
+        except asyncio.TimeoutError:
+            await self.kill(p.pid, exited)
+            raise ToolTimeout("{} killed after {} s\n".format(" ".join(argv), timeout))
+        finally:
+            for log_file in (out, err):
+                if log_file:
+                    log_file.close()
+        rusage = _watcher.rusage.pop(p.pid, None) if _watcher else None
+        job = current_job.get(None)
+        if job is not None and rusage is not None:
+            job.add(rusage)
+        return p.returncode, res[1]
+
+    async def kill(self, pid, exited):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pid, sig)
+            except OSError:  # group is gone already
+                return
+            try:
+                await asyncio.wait_for(asyncio.shield(exited), KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def check(self, argv, **kwargs):
+        retval, p_err = await self.exec_tool(argv, **kwargs)
+        if retval != 0:
+            raise ToolFailed("{} returned {}:\n{}\n".format(" ".join(argv), retval,
+                                                            p_err.decode("utf-8", "replace")),
+                             kind=classify(retval, p_err))
+
+    @logged
+    async def run_prank(self, infile=None, outfile=None, cpu=1, db=None, orthogroup=None,
+                        run_id=None, phase=None, program=None, cache=None, timeout=None, log=None):
+        if cache:
+            cache = ArtifactCache(cache)
+            key = cache.key(files=[infile], args=[os.path.basename(program), "+F"])
+            if cache.fetch(key, {"msa": outfile}):
+                return CACHE_HIT
+        await self.check(shlex.split(program) + ["+F", "-d=" + infile, "-o=" + outfile],
+                         timeout=timeout, log=log)
+        #prank attaches ".best.fas"
+        shutil.move(outfile + ".best.fas", outfile)
+        if cache:
+            cache.store(key, {"msa": outfile})
+        return 0
+
+    @logged
+    async def run_pal2nal(self, program=None, pep_msa=None, outfile=None, nuc_fa=None, cpu=1, db=None,
+                          orthogroup=None, run_id=None, phase=None, timeout=None, log=None):
+        pal2nal_nuc_in = outfile + ".nuc"
+        nuc = dict(FastaParser().read_fasta(nuc_fa))
+        with open(pal2nal_nuc_in, 'w') as o:
+            for h, s in FastaParser().read_fasta(pep_msa):
+                o.write(">{}\n{}\n".format(h, nuc[h]))
+        # one pal2nal run for the gapped alignment, the -nogap one is cut from it
+        with open(outfile + ".pamlg", 'wb') as out:
+            await self.check(shlex.split(program) + [pep_msa, pal2nal_nuc_in, "-output", "paml"],
+                             stdout=out, timeout=timeout, log=log)
+        try:
+            nogap_paml(outfile + ".pamlg", outfile + ".paml")
+        except (IndexError, ValueError) as e:
+            raise ToolFailed("could not read {}: {}\n".format(outfile + ".pamlg", e))
+        return 0
+
+    @logged
+    async def run_backtranslate(self, program=None, pep_msa=None, outfile=None, nuc_fa=None, cpu=1, db=None,
+                                orthogroup=None, run_id=None, phase=None, timeout=None, log=None):
+        """wrappers.run_backtranslate, in a thread of the loop's executor"""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, back_translate, pep_msa, nuc_fa, outfile)
+        except OSError as e:
+            raise ToolFailed("back translation of {} failed: {}\n".format(pep_msa, e), kind=error_kind(e))
+        except (BackTranslationException, KeyError) as e:
+            raise ToolFailed("back translation of {} failed: {}\n".format(pep_msa, e), kind=INPUT)
+        return 0
+
+    @logged
+    async def run_raxml(self, program=None, pep_msa=None, outdir=None, model=None, bootstrap_seed=123,
+                        num_bootstraps=None, workdir=None, num_cpu=None, db=None, orthogroup=None,
+                        run_id=None, phase=None, cache=None, scratch=None, min_free_mb=0, timeout=None, log=None):
+        run_name = orthogroup
+        for name in (run_name, run_name + ".mrc"):
+            remove_raxml_files(workdir, name)
+        if num_bootstraps == 0:
+            outputs = {"result": os.path.join(workdir, "RAxML_result." + run_name),
+                       "bestTree": os.path.join(workdir, "RAxML_bestTree." + run_name)}
+        else:
+            outputs = {"bootstrap": os.path.join(workdir, "RAxML_bootstrap." + run_name),
+                       "MajorityRuleConsensusTree": os.path.join(workdir, "RAxML_MajorityRuleConsensusTree." + run_name + ".mrc")}
+        if cache:
+            cache = ArtifactCache(cache)
+            key = cache.key(files=[pep_msa], args=[os.path.basename(program), model, num_bootstraps, bootstrap_seed])
+            if cache.fetch(key, outputs):
+                return CACHE_HIT
+        loop = asyncio.get_running_loop()
+        with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, inputs=[pep_msa], prefix="raxml_") as wd:
+            pep_msa_phy = phy_file(pep_msa, wd, workdir)
+            await loop.run_in_executor(None, mfa2phy, pep_msa, pep_msa_phy)
+            raxml = shlex.split(program)
+            threads = raxml_thread_count(program, num_cpu)
+            threads = ["-T", str(threads)] if threads else []
+            started = loop.time()
+            if num_bootstraps == 0:
+                await self.check(raxml + ["-p", str(bootstrap_seed), "-m", model] + threads +
+                                 ["-n", run_name, "-s", pep_msa_phy, "-w", wd], timeout=timeout, log=log)
+            else:
+                await self.check(raxml + ["-m", model] + threads +
+                                 ["-n", run_name, "-s", pep_msa_phy, "-b", str(bootstrap_seed),
+                                  "-N", str(num_bootstraps), "-w", wd], timeout=timeout, log=log)
+                if timeout:  # the consensus gets what is left of the job's limit
+                    timeout = max(1, float(timeout) - (loop.time() - started))
+                bstree = os.path.join(wd, "RAxML_bootstrap." + orthogroup)
+                await self.consensus(raxml, model, bstree, orthogroup, wd, timeout=timeout, log=log)
+            publish_outputs(wd, outputs)
+        if cache:
+            cache.store(key, outputs)
+        return 0
+
+    async def consensus(self, raxml, model, bstree, orthogroup, workdir, timeout=None, log=None):
+        await self.check(raxml + ["-m", model, "-J", "MR", "-z", bstree, "-n", orthogroup + ".mrc",
+                                  "-w", workdir], timeout=timeout, log=log)
+
+    @logged
+    async def run_raxml_bootstraps(self, program=None, pep_msa=None, model=None, bootstrap_seed=123,
+                                   num_bootstraps=None, chunk=0, workdir=None, num_cpu=None, db=None,
+                                   orthogroup=None, run_id=None, phase=None, cache=None, scratch=None, min_free_mb=0,
+                                   timeout=None, log=None):
+        run_name = chunk_run_name(orthogroup, chunk)
+        remove_raxml_files(workdir, run_name)
+        outputs = {"bootstrap": chunk_file(workdir, orthogroup, chunk)}
+        if cache:
+            cache = ArtifactCache(cache)
+            key = cache.key(files=[pep_msa], args=[os.path.basename(program), model, num_bootstraps, bootstrap_seed])
+            if cache.fetch(key, outputs):
+                return CACHE_HIT
+        with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, inputs=[pep_msa], prefix="raxml_") as wd:
+            pep_msa_phy = phy_file(pep_msa, wd, workdir, suffix=".bs{}.phy".format(chunk))
+            await asyncio.get_running_loop().run_in_executor(None, mfa2phy, pep_msa, pep_msa_phy)
+            threads = raxml_thread_count(program, num_cpu)
+            threads = ["-T", str(threads)] if threads else []
+            await self.check(shlex.split(program) + ["-m", model] + threads +
+                             ["-n", run_name, "-s", pep_msa_phy, "-b", str(bootstrap_seed),
+                              "-N", str(num_bootstraps), "-w", wd], timeout=timeout, log=log)
+            publish_outputs(wd, outputs)
+        if cache:
+            cache.store(key, outputs)
+        return 0
+
+    @logged
+    async def run_raxml_consensus(self, program=None, model=None, num_bootstraps=None, chunks=None,
+                                  workdir=None, db=None, orthogroup=None, run_id=None, phase=None,
+                                  scratch=None, min_free_mb=0, timeout=None, log=None):
+        for name in (orthogroup, orthogroup + ".mrc"):
+            remove_raxml_files(workdir, name)
+        outputs = {"bootstrap": os.path.join(workdir, "RAxML_bootstrap." + orthogroup),
+                   "MajorityRuleConsensusTree": os.path.join(workdir, "RAxML_MajorityRuleConsensusTree." + orthogroup + ".mrc")}
+        with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, prefix="raxml_") as wd:
+            try:
+                bstree = merge_bootstraps(workdir, orthogroup, chunks, num_bootstraps, out_dir=wd)
+            except (IOError, ValueError) as e:
+                raise ToolFailed("could not merge the bootstraps of {}: {}\n".format(orthogroup, e))
+            await self.consensus(shlex.split(program), model, bstree, orthogroup, wd, timeout=timeout, log=log)
+            publish_outputs(wd, outputs)
+        return 0
+
+    @logged
+    async def run_codeml(self, program=None, ctl_file=None, work_dir=None, db=None, orthogroup=None,
+                         run_id=None, phase=None, semaphore=None, cache=None, scratch=None, min_free_mb=0,
+                         timeout=None, log=None):
+        ctl = read_ctl(os.path.join(work_dir, ctl_file))
+        outfile = os.path.join(work_dir, ctl["outfile"])
+        if os.path.exists(outfile):  # may be a hardlink into the cache, never write through it
+            os.remove(outfile)
+        inputs = [os.path.join(work_dir, ctl_file),
+                  os.path.join(work_dir, ctl["treefile"]),
+                  os.path.join(work_dir, ctl["seqfile"])]
+        if cache:
+            cache = ArtifactCache(cache)
+            key = cache.key(files=inputs, args=[os.path.basename(program)])
+            if cache.fetch(key, {"out": outfile}):
+                return CACHE_HIT
+        with scratch_dir(work_dir, inputs=inputs, prefix=".codeml_", root=scratch, min_free_mb=min_free_mb) as wd:
+            await self.check(shlex.split(program) + [os.path.basename(ctl_file)], cwd=wd,
+                             timeout=timeout, log=log)
+            publish(os.path.join(wd, os.path.basename(ctl["outfile"])), outfile)
+        if cache:
+            cache.store(key, {"out": outfile})
+        return 0
+
+    async def run_task(self, taskfile, task_id, task, python="python2"):
+        """run one task of an ArrayScheduler task file, writes TASKFILE.TASK_ID.done like array_worker"""
+        if task["func"] not in NATIVE:
+            async with self.semaphore("python"):
+                await self.exec_tool([python, "-m", "helpers.array_worker", taskfile, str(task_id)])
+            return
+        try:
+            ok, res = True, await getattr(self, task["func"])(**task["kwargs"])
+        except Exception:
+            ok, res = False, traceback.format_exc()
+            sys.stderr.write(res)
+        with open("{}.{}.done".format(taskfile, task_id), 'w') as done:
+            done.write(json.dumps({"ok": ok, "result": res}))
+
+    async def run_taskfile(self, taskfile, python="python2"):
+        with open(taskfile, 'r') as tasks:
+            tasks = [json.loads(line) for line in tasks]
+        dbs = set(t["kwargs"].get("db") for t in tasks) - set([None])
+        if len(dbs) == 1:  # one connection for the rows of all the loop's jobs
+            dbwriter.start(dbs.pop())
+        try:
+            await asyncio.gather(*[self.run_task(taskfile, i, t, python=python) for i, t in enumerate(tasks)])
+        finally:
+            dbwriter.close()
+
+
+# runners with a coroutine version, the others run through helpers.array_worker
+NATIVE = ["run_prank", "run_pal2nal", "run_backtranslate", "run_raxml", "run_raxml_bootstraps", "run_raxml_consensus",
+          "run_codeml"]
+
+
+def parse_limits(limits):
+    """'prank=8,codeml=64' -> {'prank': 8, 'codeml': 64}"""
+    res = {}
+    for l in (limits or "").split(","):
+        if "=" in l:
+            tool, n = l.split("=", 1)
+            res[tool.strip()] = int(n)
+    return res
+
+
+def usage():
+    print ("""
+    #############################################
+    # python3 -m helpers.aiorunner [options] TASKFILE
+    ############################################
+    TASKFILE                one JSON task per line, written by the phasePAML wrapper
+    -j, --jobs=INT [1]      processes per tool at once, for tools without a limit
+    -l, --limits=LIMITS     per tool limits, eg. prank=8,raxml=2,codeml=64,python=4
+    -p, --python=PYTHON2    interpreter for the tasks without a coroutine runner
+    """)
+    sys.exit(2)
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'j:l:p:h', ['jobs=', 'limits=', 'python=', 'help'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+    jobs, limits, python = 1, None, "python2"
+    for o, a in opts:
+        if o in ("-j", "--jobs"):
+            jobs = a
+        elif o in ("-l", "--limits"):
+            limits = parse_limits(a)
+        elif o in ("-p", "--python"):
+            python = a
+        else:
+            usage()
+    if len(args) != 1:
+        usage()
+    runner = AsyncRunner(limits=limits, default=jobs)
+    asyncio.run(runner.run_taskfile(args[0], python=python))
+
+
+if __name__ == "__main__":
+    main()
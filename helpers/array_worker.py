@@ -0,0 +1,58 @@
+__author__ = 'jmass'
+import sys
+import json
+import importlib
+import traceback
+
+"""
+Runs one task of a job array written by helpers.jobarray.ArrayScheduler.
+The wrapped runners report their status into the sqlite phase table
+themselves, the result is also written to TASKFILE.TASK_ID.done.
+"""
+
+
+def usage():
+    print ("""
+    #############################################
+    # python -m helpers.array_worker TASKFILE TASK_ID
+    ############################################
+    TASKFILE    one JSON task per line, written by the phasePAML wrapper
+    TASK_ID     0-based line number of the task to run
+    """)
+    sys.exit(2)
+
+
+def load_task(taskfile, task_id):
+    with open(taskfile, 'r') as tasks:
+        for i, line in enumerate(tasks):
+            if i == task_id:
+                return json.loads(line)
+    raise IndexError("{} has no task {}".format(taskfile, task_id))
+
+
+def run_task(task):
+    module = importlib.import_module(task["module"])
+    func = getattr(module, task["func"])
+    kwargs = dict((str(k), v) for k, v in task["kwargs"].items())
+    try:
+        return True, func(**kwargs)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def main():
+    if len(sys.argv) != 3:
+        usage()
+    taskfile = sys.argv[1]
+    task_id = int(sys.argv[2])
+    ok, res = run_task(load_task(taskfile, task_id))
+    if not ok:
+        sys.stderr.write(res)
+    with open("{}.{}.done".format(taskfile, task_id), 'w') as done:
+        done.write(json.dumps({"ok": ok, "result": res}))
+    if not ok or res in ("f", "t"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
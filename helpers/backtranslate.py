@@ -0,0 +1,93 @@
+__author__ = 'jmass'
+try:
+    import numpy as np
+except ImportError:  # phase 2 falls back to the external pal2nal
+    np = None
+from .fastahelper import FastaParser, SeqTranslator
+from .paml_msa import write_paml_msa
+
+BASES = b"TCAG"
+
+
+class BackTranslationException(Exception):
+    pass
+
+
+def codon_table():
+    """(uint8 base -> 0..3 or 4 for anything else, 64 codon index -> amino acid byte)"""
+    base_index = np.full(256, 4, dtype=np.uint8)
+    for i, b in enumerate(bytearray(BASES)):
+        base_index[b] = i
+        base_index[ord(chr(b).lower())] = i
+    aa = np.zeros(64, dtype="S1")
+    for codon, a in SeqTranslator.DNAmap.items():
+        i = [BASES.index(c.encode("ascii")) for c in codon]
+        aa[16 * i[0] + 4 * i[1] + i[2]] = a.encode("ascii")
+    return base_index, aa
+
+
+def translate(codons, table=None):
+    """amino acids of a (k, 3) uint8 codon array, "X" for codons with other than ACGT"""
+    base_index, aa = table or codon_table()
+    idx = base_index[codons]
+    unknown = (idx == 4).any(axis=1)
+    res = aa[(16 * idx[:, 0] + 4 * idx[:, 1] + idx[:, 2]) % 64]
+    res[unknown] = b"X"
+    return res
+
+
+def codon_alignment(pep_aln, nuc):
+    """(names, (n, L, 3) uint8 codon alignment) for the aligned proteins [(name, seq)]
+    and the coding sequences {name: seq}, checked against SeqTranslator.DNAmap"""
+    table = codon_table()
+    names = [n for n, s in pep_aln]
+    lengths = [len(s) for n, s in pep_aln]
+    if len(set(lengths)) > 1:  # numpy would refuse the ragged rows with a ValueError
+        common = max(set(lengths), key=lengths.count)
+        raise BackTranslationException("protein alignment rows differ in length, {} columns but {}".format(
+            common, ", ".join("{} ({})".format(n, l) for n, l in zip(names, lengths) if l != common)))
+    aa = np.array([bytearray(s.encode("ascii")) for n, s in pep_aln], dtype=np.uint8)
+    residues = aa != ord("-")
+    out = np.full(aa.shape + (3,), ord("-"), dtype=np.uint8)
+    for i, name in enumerate(names):
+        if name not in nuc:
+            raise BackTranslationException("no nucleotide sequence for {}".format(name))
+        row = residues[i]
+        k = int(row.sum())
+        cds = np.frombuffer(nuc[name].encode("ascii"), dtype=np.uint8)
+        if k and len(cds) == 3 * (k - 1) and aa[i, np.flatnonzero(row)[-1]] == ord("*"):
+            row = row.copy()  # a terminal stop of the protein without its codon in the CDS is a gap
+            row[np.flatnonzero(row)[-1]] = False
+            k -= 1
+        if len(cds) < 3 * k:
+            raise BackTranslationException("{}: {} nt for {} residues".format(name, len(cds), k))
+        codons = cds[:3 * k].reshape(k, 3)
+        expected = aa[i, row].view("S1")
+        found = translate(codons, table)
+        bad = (found != expected) & (found != b"X") & (np.char.upper(expected) != b"X")
+        if bad.any():
+            j = int(np.flatnonzero(bad)[0])
+            raise BackTranslationException("{}: codon {} {} does not translate to {}".format(
+                name, j + 1, codons[j].tobytes().decode("ascii"), expected[j].decode("ascii")))
+        out[i, row] = codons
+    return names, out
+
+
+def nogap_columns(codon_aln):
+    """mask of the codon columns without gaps and inframe stop codons, as pal2nal -nogap keeps them"""
+    gaps = (codon_aln == ord("-")).any(axis=(0, 2))
+    n, length = codon_aln.shape[:2]
+    stops = (translate(codon_aln.reshape(n * length, 3)).reshape(n, length) == b"*").any(axis=0)
+    return ~(gaps | stops)
+
+
+def as_rows(names, codon_aln):
+    return [(n, codon_aln[i].tobytes().decode("ascii")) for i, n in enumerate(names)]
+
+
+def back_translate(pep_msa, nuc_fa, outfile):
+    """write outfile.pamlg (gapped) and outfile.paml (-nogap) codon alignments"""
+    nuc = dict(FastaParser().read_fasta(nuc_fa))
+    names, codon_aln = codon_alignment(list(FastaParser().read_fasta(pep_msa)), nuc)
+    write_paml_msa(as_rows(names, codon_aln), outfile + ".pamlg")
+    write_paml_msa(as_rows(names, codon_aln[:, nogap_columns(codon_aln)]), outfile + ".paml")
@@ -0,0 +1,62 @@
+__author__ = 'jmass'
+import os
+
+"""
+RAxML bootstraps of one orthogroup split into chunks: every chunk is a raxml
+run of its own (RAxML_bootstrap.ORTHOGROUP.bsK), the trees are concatenated
+into RAxML_bootstrap.ORTHOGROUP for the majority rule consensus.
+"""
+
+RAXML_OUTPUTS = ["info", "log", "result", "parsimonyTree", "bestTree", "bootstrap",
+                 "MajorityRuleConsensusTree", "bipartitions", "bipartitionsBranchLabels"]
+
+
+def remove_raxml_files(workdir, run_name):
+    """raxml refuses to run if output files of an earlier run with that name exist"""
+    for o in RAXML_OUTPUTS:
+        f = os.path.join(workdir, "RAxML_{}.{}".format(o, run_name))
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def bootstrap_chunks(num_bootstraps, chunks, bootstrap_seed=123):
+    """[(chunk, replicates, seed)] for num_bootstraps split into at most chunks runs.
+    Chunk k draws its replicates with seed bootstrap_seed + k, a rerun with the
+    same settings gives the same trees no matter which chunk finishes first."""
+    chunks = max(1, min(int(chunks), int(num_bootstraps)))
+    size, extra = divmod(int(num_bootstraps), chunks)
+    return [(k, size + (1 if k < extra else 0), int(bootstrap_seed) + k) for k in range(chunks)]
+
+
+def chunk_run_name(orthogroup, chunk):
+    return "{}.bs{}".format(orthogroup, chunk)
+
+
+def chunk_file(workdir, orthogroup, chunk):
+    return os.path.join(workdir, "RAxML_bootstrap." + chunk_run_name(orthogroup, chunk))
+
+
+def count_trees(bootstrap_file):
+    """trees in a RAxML_bootstrap file, raxml writes one per line as they finish"""
+    if not os.path.isfile(bootstrap_file):
+        return 0
+    with open(bootstrap_file, 'r') as trees:
+        return len([t for t in trees if t.strip()])
+
+
+def merge_bootstraps(workdir, orthogroup, chunks, num_bootstraps, out_dir=None):
+    """concatenate the chunks' trees into RAxML_bootstrap.ORTHOGROUP in out_dir (default workdir),
+    returns its path. ValueError if the chunks do not add up to num_bootstraps trees."""
+    merged = os.path.join(out_dir or workdir, "RAxML_bootstrap." + orthogroup)
+    found = 0
+    with open(merged, 'w') as out:
+        for k in range(int(chunks)):
+            with open(chunk_file(workdir, orthogroup, k), 'r') as trees:
+                for tree in trees:
+                    if tree.strip():
+                        out.write(tree.strip() + "\n")
+                        found += 1
+    if found != int(num_bootstraps):
+        raise ValueError("{} bootstrap trees in {} chunks of {}, expected {}".format(
+            found, chunks, orthogroup, num_bootstraps))
+    return merged
@@ -0,0 +1,70 @@
+__author__ = 'jmass'
+import os
+import shutil
+import hashlib
+import tempfile
+from .scratch import link_or_copy
+
+# returned by a runner that linked its outputs from the artifact cache
+CACHE_HIT = "cache hit"
+
+
+class ArtifactCache(object):
+    """Content addressed store for the outputs of the external tools, shared between runs.
+
+    An entry is keyed by the hash of the input files' content and the tool
+    invocation, so the same orthogroup in a run with another name (or
+    another --regex/--models) gets the prank alignment and the raxml trees
+    of an earlier run linked in instead of computing them again.
+    """
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):  # another worker was faster
+                    raise
+
+    def key(self, files=(), args=()):
+        h = hashlib.sha1()
+        for f in files:
+            with open(f, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(block)
+            h.update(b"\0")
+        for a in args:
+            h.update(str(a).encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, outputs):
+        """link the cached files into place, outputs maps names in the entry to destinations"""
+        entry = self._entry(key)
+        if not all(os.path.isfile(os.path.join(entry, n)) for n in outputs):
+            return False
+        for n, dest in outputs.items():
+            link_or_copy(os.path.join(entry, n), dest)
+        return True
+
+    def store(self, key, outputs):
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp")
+        for n, src in outputs.items():
+            link_or_copy(src, os.path.join(tmp, n))
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # stored by a concurrent job in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
@@ -131,6 +131,27 @@ class CODEMLParser(object):
         res["table"] = "\n".join(res["table"])
         return res.copy()
 
+    def retrieveSites(self, infile, method="BEB"):
+        """[(site, amino acid, Prob(w>1), stars)] of the NEB or BEB positive sites list"""
+        with open(infile, 'r') as file:
+            text = file.read()
+        if method == "NEB":
+            m = re.findall('Naive Empirical Bayes (.*?)Bayes Empirical Bayes.*?', text, re.DOTALL)
+        else:
+            m = re.findall('Bayes Empirical Bayes (.*?)The.*?', text, re.DOTALL)
+        sites = []
+        if m:
+            for line in m[0].split("\n")[2:]:
+                c = line.split()
+                if len(c) < 3 or not c[0].isdigit():
+                    continue
+                sig = c[2].count("*")
+                try:
+                    sites.append((int(c[0]), c[1], float(c[2].strip("*")), sig))
+                except ValueError:
+                    continue
+        return sites
+
     ####/done############################################
 
     def retriveTreeLength(self, infile):
@@ -142,14 +163,33 @@ class CODEMLParser(object):
 
     def retrieveKappa(self, infile):
         #kappa (ts/tv) =  1.68285
-        pass
+        with open(infile, 'r') as file:
+            text = file.read()
+        m = re.findall('kappa \(ts/tv\) =\s*([-+.0-9eE]+)', text)
+        if m:
+            m = float(m[-1])
+        else:
+            m = None
+        return m
 
     def retrieveOmegaForSiteClasses(self, infile):
-        proportion = None
-        background = None
-        foreground = None
-
-        pass
+        """[(site class, proportion, background w, foreground w)] of the branch-site models"""
+        with open(infile, 'r') as file:
+            text = file.read()
+        rows = {}
+        m = re.findall('dN/dS \(w\) for site classes.*?\n\s*\n(site class.*?)\n\s*\n', text, re.DOTALL)
+        if not m:
+            return []
+        for line in m[-1].split("\n"):
+            for name in ("site class", "proportion", "background w", "foreground w"):
+                if line.startswith(name):
+                    rows[name] = line[len(name):].split()
+        classes = rows.get("site class", [])
+        values = []
+        for name in ("proportion", "background w", "foreground w"):
+            v = [float(x) for x in rows.get(name, [])]
+            values.append(v if len(v) == len(classes) else [None] * len(classes))
+        return list(zip(classes, *values))
 
         #dN/dS (w) for site classes (K=4)
         #site class             0        1       2a       2b
@@ -218,12 +258,25 @@ def calculatePvalue(h0, h1):
     res["pval"] = pval
     res["stars"] = stars
     res["sig"] = sig
+    res["ts"] = ts
     res["tablerow"] = "{},{},{},{},{},{},{},{}\n".format(h0.split(os.sep)[-1], h1.split(os.sep)[-1], pval, stars, lnLh0,
                                                          lnLh1, nph0, nph1)
 
     return res.copy()
 
 
+def codemlResults(infile):
+    """the values of one codeml output for the results tables (helpers.dbhelper.db_store_codeml)"""
+    cp = CODEMLParser()
+    return {"lnL": cp.retrieveLogLikelihood(infile),
+            "np": cp.retrieveNumParameters(infile),
+            "ntime": cp.retrieveNtime(infile),
+            "kappa": cp.retrieveKappa(infile),
+            "omegas": cp.retrieveOmegaForSiteClasses(infile),
+            "NEB": cp.retrieveSites(infile, "NEB"),
+            "BEB": cp.retrieveSites(infile, "BEB")}
+
+
 def main():
     h0 = None
     h1 = None
@@ -0,0 +1,136 @@
+__author__ = 'jmass'
+import os
+from .fastahelper import FastaParser
+
+# codeml run time relative to M0, branch-site models are the slow ones
+CODEML_MODEL_FACTOR = {"M0": 1.0, "FR": 2.0, "BM": 1.5, "M1a": 2.0, "M2a": 2.5,
+                       "M7": 3.0, "M8": 3.5, "M8a": 3.5, "Ah0": 4.0, "Ah1": 4.0}
+
+
+def read_paml_header(paml_msa):
+    """number of sequences and alignment length from the first line of a PAML alignment"""
+    with open(paml_msa, 'r') as paml:
+        line = paml.readline().strip().split(" ")
+        line = [l for l in line if l.strip() != ""]
+    return int(line[0]), int(line[1])
+
+
+def read_ctl(ctl_file):
+    """key = value pairs of a codeml control file"""
+    res = {}
+    with open(ctl_file, 'r') as ctl:
+        for line in ctl:
+            line = line.split("*")[0]
+            if "=" in line:
+                k, v = line.split("=", 1)
+                res[k.strip()] = v.strip()
+    return res
+
+
+def codeml_model(ctl_file):
+    """model suffix of a ctl file written by tree_labeler, eg. OG1.mrc.12.Ah0.ctl -> Ah0"""
+    model = os.path.basename(ctl_file).split(".")[-2]
+    return model.split("_")[0]
+
+
+class CostModel(object):
+    """Estimates the cost of a job from the number of sequences and the
+    alignment length, in arbitrary units that only need to order jobs.
+
+    sizes maps orthogroup -> number of sequences (from the orthoinfo headers).
+    Every estimate is kept in self.estimates as (orthogroup, phase, task, cost)
+    so it can be stored and compared with the real durations later.
+    """
+    def __init__(self, sizes=None):
+        self.sizes = sizes or {}
+        self.estimates = []
+
+    def num_seqs(self, orthogroup, fasta=None):
+        if orthogroup in self.sizes:
+            return self.sizes[orthogroup]
+        if fasta and os.path.isfile(fasta):  # eg. pysickled orthogroups
+            self.sizes[orthogroup] = len(list(FastaParser().read_fasta(fasta)))
+            return self.sizes[orthogroup]
+        return 1
+
+    def length(self, orthogroup, paml=None, fasta=None):
+        """alignment length in codons/residues, the unaligned mean length if there is no alignment yet"""
+        if paml and os.path.isfile(paml):
+            return read_paml_header(paml)[1] / 3
+        if fasta and os.path.isfile(fasta):
+            return os.path.getsize(fasta) / max(1, self.num_seqs(orthogroup, fasta))
+        return 1
+
+    def _keep(self, orthogroup, phase, task, cost):
+        self.estimates.append((orthogroup, phase, task, cost))
+        return cost
+
+    def prank(self, orthogroup, pep_fa, phase=1):
+        n = self.num_seqs(orthogroup, pep_fa)
+        return self._keep(orthogroup, phase, "prank", float(n * n * self.length(orthogroup, fasta=pep_fa)))
+
+    def raxml(self, orthogroup, num_bootstraps, paml=None, pep_fa=None, phase=3):
+        n = self.num_seqs(orthogroup, pep_fa)
+        cost = n * self.length(orthogroup, paml=paml, fasta=pep_fa) * (int(num_bootstraps) + 1)
+        return self._keep(orthogroup, phase, "raxml", float(cost))
+
+    def codeml(self, orthogroup, ctl_file, paml, phase=5, fasta=None):
+        n = self.num_seqs(orthogroup)
+        model = codeml_model(ctl_file)
+        cost = n * self.length(orthogroup, paml=paml, fasta=fasta) * CODEML_MODEL_FACTOR.get(model, 1.0)
+        return self._keep(orthogroup, phase, os.path.basename(ctl_file), float(cost))
+
+    def pop_estimates(self):
+        estimates, self.estimates = self.estimates, []
+        return estimates
+
+
+def calibrate(cost_vs_duration, tool_phases):
+    """seconds per cost unit for every tool with finished, estimated jobs.
+
+    cost_vs_duration are (orthogroup, phase, estimate, seconds) rows
+    (dbhelper.db_get_cost_vs_duration), tool_phases maps tool -> phases.
+    """
+    res = {}
+    for tool, phases in tool_phases.items():
+        rows = [(c, s) for o, p, c, s in cost_vs_duration if p in phases and c]
+        if rows:
+            res[tool] = sum(s for c, s in rows) / float(sum(c for c, s in rows))
+    return res
+
+
+def count_patterns(msa):
+    """number of distinct alignment columns (site patterns) of a FASTA alignment"""
+    seqs = [s for h, s in FastaParser().read_fasta(msa)]
+    if not seqs:
+        return 0
+    return len(set(zip(*seqs)))
+
+
+class ThreadAllocator(object):
+    """Chooses the number of RAxML Pthreads per job.
+
+    A thread only pays off with enough distinct site patterns to work on,
+    small alignments run fastest single threaded, big ones get more threads.
+    No job gets more than its fair share of the cores when several RAxML
+    jobs run at once, so the node's cores are split between them instead
+    of one wide job blocking the rest.
+    """
+    def __init__(self, cores, jobs=1, patterns_per_thread=200):
+        self.cores = max(1, int(cores))
+        self.jobs = max(1, int(jobs))
+        self.patterns_per_thread = max(1, int(patterns_per_thread))
+
+    def threads(self, patterns, concurrent=1):
+        fair = max(1, self.cores // max(1, min(int(concurrent), self.jobs)))
+        return max(1, min(int(patterns) // self.patterns_per_thread, fair))
+
+
+def raxml_thread_count(program, threads):
+    """-T for program, None to leave it out: a Pthreads build (raxmlHPC-PTHREADS*)
+    refuses to start without -T and needs at least 2, the others get -T only
+    when asked for more than one thread"""
+    threads = max(1, int(threads or 1))
+    if "PTHREADS" in os.path.basename(str(program).split(" ")[0]).upper():
+        return max(2, threads)
+    return threads if threads > 1 else None
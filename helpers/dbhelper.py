@@ -1,72 +1,57 @@
 import sqlite3
+import sys
 import os
 
 
-def q(s):
-    return '"' + s + '"'
-
-
 def check_phase(cursor=None, run_name=None):
     pass
 
 
-def db_check_run(db, run_name, orthogroup_dct):
-    """check if name of run already exists in table"""
+def db_check_run(db, run_name, orthogroup_dct, sequences=None):
+    """check if name of run already exists in table, register it with its orthogroups if not.
+    A new run, its orthoinfo, sequence and phase 0 rows are one transaction. sequences
+    are (orthogroup, seq_id, nuc_len, pep_len) from check_fasta, without them the
+    sequences of orthogroup_dct are stored without lengths."""
     if os.path.isfile(db):
         print("{} exists".format(db))
         con = sqlite3.connect(db)
-        cmd = "SELECT * FROM run WHERE name = " + q(run_name)
-        with con:
-            cur = con.cursor()
-            cur.execute(cmd)
-            res = cur.fetchall()
-            if len(res) > 0:
-                print("Run {} already exists.\n".format(run_name))
-                check_phase(cur, run_name)
-            else:
-                cmd = "INSERT INTO run(name) VALUES({});".format(q(run_name))
-                cur.execute(cmd)
-                con.commit()
-                cmd = "SELECT id FROM run WHERE name = " + q(run_name)
-                cur.execute(cmd)
-                run_id = cur.fetchone()[0]
-                init_orthoinfotable(connection=con,
-                                    run_id=run_id,
-                                    orthogroup_dct=orthogroup_dct)
-
-                init_phasetable(connection=con,
-                                run_id=run_id,
-                                orthogroup_list=orthogroup_dct.keys())
-
-                con.commit()
-
-
     else:
         print("Creating new db file {}.\n".format(db))
-        cmd = 'CREATE TABLE run (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT);'
         con = sqlite3.connect(db)
-        with con:
-            cur = con.cursor()
-            cur.execute(cmd)
-            con.commit()
-            cmd = "INSERT INTO run(name) VALUES({});".format(q(run_name))
-            cur.execute(cmd)
-            con.commit()
-            cmd = "SELECT id FROM run WHERE name = " + q(run_name)
-            cur.execute(cmd)
-            run_id = cur.fetchone()[0]
+        set_journal_mode(con)
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS run (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT);')
+        create_orthoinfotable(cur)
+        create_sequencetable(cur)
+        create_phasetable(cur)
+        con.commit()
+        cur.execute('SELECT * FROM run WHERE name = ?;', (run_name,))
+        res = cur.fetchall()
+        if len(res) > 0:
+            print("Run {} already exists.\n".format(run_name))
+            check_phase(cur, run_name)
+        else:
+            cur.execute('INSERT INTO run(name) VALUES(?);', (run_name,))
+            run_id = cur.lastrowid
             init_orthoinfotable(connection=con,
                                 run_id=run_id,
                                 orthogroup_dct=orthogroup_dct)
+            if sequences is None:
+                sequences = [(o, h, None, None) for o, headers in orthogroup_dct.items() for h in headers]
+            init_sequencetable(connection=con,
+                               run_id=run_id,
+                               sequences=sequences)
 
             init_phasetable(connection=con,
                             run_id=run_id,
                             orthogroup_list=orthogroup_dct.keys())
-
             con.commit()
+            print("Run {} registered with {} orthogroups.\n".format(run_name, len(orthogroup_dct)))
+    con.close()  # a db leaving wal needs it to itself
 
 
-def init_phasetable(connection, run_id, orthogroup_list):
+def create_phasetable(cur):
     cmd = 'CREATE TABLE phase (' \
           'id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
           'run_id INTEGER, ' \
@@ -74,10 +59,12 @@ def init_phasetable(connection, run_id, orthogroup_list):
           'orthogroup TEXT, ' \
           'status TEXT, ' \
           'timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,' \
+          'log TEXT, ' \
+          'failure TEXT, ' \
+          'attempt INTEGER, ' \
           'FOREIGN KEY(run_id) REFERENCES run(id), ' \
           'FOREIGN KEY(orthogroup) REFERENCES orthoinfo(orthogroup)' \
           ');'
-    cur = connection.cursor()
     try:
         cur.execute(cmd)
         print("phase table created.\n")
@@ -85,76 +72,559 @@ def init_phasetable(connection, run_id, orthogroup_list):
     # f: failed
     # r: running
     # s: success
+    # c: success, from cache
+    # t: timeout
+    # failure: helpers.failures class of an f or t row, attempt: 1, 2, ... for retried jobs
     except sqlite3.OperationalError as e:
         print("phase table already existed.\n")
-    cmdf = lambda runid, phase, orthogroup, status: \
-        'INSERT INTO phase(run_id, phase, orthogroup, status)' \
-        ' VALUES ({},{},{},{})'.format(runid, phase, orthogroup, status)
-
-    phase = 0
-    for o in orthogroup_list:
-        cmd = cmdf(run_id, phase, q(o), q("s"))
-        print(cmd, "CMD")
-        print(cmd)
-        cur.execute(cmd)
-    connection.commit()
+    add_phase_indexes(cur)
+    create_phase_state(cur)
+
+
+def create_phase_state(cur):
+    """phase_state: the latest status of every (run_id, orthogroup, phase), kept by
+    insert_phase in the transaction of each phase row. attempts counts the running
+    rows, started and ended are the times of the latest attempt (ended NULL while
+    it runs), phase_id is the phase row that set the status."""
+    cur.execute('CREATE TABLE IF NOT EXISTS phase_state ('
+                'run_id INTEGER, '
+                'orthogroup TEXT, '
+                'phase INTEGER, '
+                'status TEXT, '
+                'attempts INTEGER, '
+                'started TIMESTAMP, '
+                'ended TIMESTAMP, '
+                'phase_id INTEGER, '
+                'PRIMARY KEY(run_id, orthogroup, phase), '
+                'FOREIGN KEY(phase_id) REFERENCES phase(id)'
+                ');')
+    cur.execute('CREATE INDEX IF NOT EXISTS phase_state_status ON phase_state(status);')
+
+
+def init_phasetable(connection, run_id, orthogroup_list):
+    """phase 0 (input checked) done for every orthogroup, the caller commits"""
+    connection.executemany('INSERT INTO phase(run_id, phase, orthogroup, status) VALUES (?,0,?,"s");',
+                           [(run_id, o) for o in orthogroup_list])
+    connection.execute('INSERT OR REPLACE INTO phase_state(run_id, orthogroup, phase, status, attempts, '
+                       'started, ended, phase_id) '
+                       'SELECT run_id, orthogroup, phase, status, 0, timestamp, timestamp, id '
+                       'FROM phase WHERE run_id = ? AND phase = 0;', (run_id,))
 
 
 def update_phasetable(db, run_id, orthogroup_id, phase, status):
-    # todo test
     # update might be misleading, just insert another line for the current step
     # status
     # f: failed
     # r: running
     # s: success
-    con = sqlite3.connect(db)
-    with con:
-        cur = con.cursor()
-        cmdf = lambda runid, phase, orthogroup_id, status: \
-            'INSERT INTO phase(run_id, phase, orthogroup, status)' \
-            ' VALUES ({},{},{},{})'.format(runid, phase, orthogroup_id, status)
-
-        cmd = cmdf(run_id, phase, q(orthogroup_id), q(status))
-        print(cmd, "CMD")
-        cur.execute(cmd)
-        con.commit()
+    db_log_phase(db, run_id, orthogroup_id, phase, status)
 
 
-def init_orthoinfotable(connection, run_id, orthogroup_dct):
+def create_orthoinfotable(cur):
+    # the headers column of older dbs is the orthoinfo_headers view now
     cmd = 'CREATE TABLE orthoinfo (' \
           'run_id INTEGER, ' \
           'orthogroup TEXT, ' \
-          'headers TEXT,' \
           'FOREIGN KEY(run_id) REFERENCES run(id), ' \
           'PRIMARY KEY(run_id, orthogroup)' \
           ');'
-    cur = connection.cursor()
     try:
         cur.execute(cmd)
         print("orthoinfo table created.\n")
-        connection.commit()
     except sqlite3.OperationalError as e:
         print("orthoinfo table already existed.\n")
 
-    cmdf = lambda runid, orthgroup, headers: \
-        'INSERT INTO orthoinfo(run_id, orthogroup, headers)' \
-        ' VALUES ({},{},{})'.format(runid, orthgroup, headers)
 
-    for o in orthogroup_dct:
-        print(o, "OO")
-        qo = q(o)  # orthogroup_n   ame
-        cmd = cmdf(run_id, qo, q(",".join(orthogroup_dct[o])))
-        print(cmd)
-        cur.execute(cmd)
-    connection.commit()
+def init_orthoinfotable(connection, run_id, orthogroup_dct):
+    """one row per orthogroup of the run, the caller commits"""
+    connection.executemany('INSERT INTO orthoinfo(run_id, orthogroup) VALUES (?,?);',
+                           [(run_id, o) for o in orthogroup_dct])
+
+
+def create_sequencetable(cur):
+    """sequence: the members of every orthogroup with the lengths of their nuc and pep
+    sequences, orthoinfo_headers: run_id, orthogroup and the comma separated seq_ids
+    as in the headers column of orthoinfo in older dbs"""
+    cur.execute('CREATE TABLE IF NOT EXISTS sequence ('
+                'run_id INTEGER, '
+                'orthogroup TEXT, '
+                'seq_id TEXT, '
+                'nuc_len INTEGER, '
+                'pep_len INTEGER, '
+                'FOREIGN KEY(run_id, orthogroup) REFERENCES orthoinfo(run_id, orthogroup), '
+                'PRIMARY KEY(run_id, orthogroup, seq_id)'
+                ');')
+    cur.execute('CREATE INDEX IF NOT EXISTS sequence_seq_id ON sequence(seq_id);')
+    cur.execute('CREATE INDEX IF NOT EXISTS sequence_orthogroup ON sequence(orthogroup);')
+    cur.execute('CREATE VIEW IF NOT EXISTS orthoinfo_headers AS '
+                'SELECT run_id, orthogroup, group_concat(seq_id, ",") AS headers '
+                'FROM (SELECT * FROM sequence ORDER BY rowid) GROUP BY run_id, orthogroup;')
+
+
+def init_sequencetable(connection, run_id, sequences):
+    """(orthogroup, seq_id, nuc_len, pep_len) of the run, the caller commits"""
+    connection.executemany('INSERT OR REPLACE INTO sequence(run_id, orthogroup, seq_id, nuc_len, pep_len) '
+                           'VALUES (?,?,?,?,?);', [(run_id,) + tuple(s) for s in sequences])
+
+
+def fill_sequencetable(cur):
+    """sequence rows (without lengths) for the orthogroups that only have the headers
+    column of an older orthoinfo table"""
+    cur.execute('PRAGMA table_info(orthoinfo);')
+    if "headers" not in [c[1] for c in cur.fetchall()]:
+        return
+    cur.execute('SELECT o.run_id, o.orthogroup, o.headers FROM orthoinfo o WHERE o.headers IS NOT NULL '
+                'AND NOT EXISTS (SELECT 1 FROM sequence s WHERE s.run_id = o.run_id AND s.orthogroup = o.orthogroup);')
+    rows = [(r, o, h, None, None) for r, o, headers in cur.fetchall() for h in headers.split(",") if h]
+    cur.executemany('INSERT OR IGNORE INTO sequence(run_id, orthogroup, seq_id, nuc_len, pep_len) '
+                    'VALUES (?,?,?,?,?);', rows)
 
 
 def db_get_run_id(db, run_name):
     con = sqlite3.connect(db)
     with con:
         cur = con.cursor()
-        cmd = "SELECT id FROM run WHERE name = {};".format(q(run_name))
-        print(cmd)
-        cur.execute(cmd)
+        cur.execute('SELECT id FROM run WHERE name = ?;', (run_name,))
         run_ids = cur.fetchall()
-    return run_ids
\ No newline at end of file
+    return run_ids
+
+
+def db_log_phase(db, run_id, orthogroup, phase, status, log=None, usage=None, failure=None, attempt=None):
+    """insert one status row into the phase table, with the job's resources for an end row"""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        insert_phase(con.cursor(), run_id, orthogroup, phase, status, log=log, usage=usage,
+                     failure=failure, attempt=attempt)
+        con.commit()
+
+
+def insert_phase(cur, run_id, orthogroup, phase, status, log=None, usage=None, failure=None, attempt=None):
+    """db_log_phase on an open cursor, the caller commits"""
+    columns = ["run_id", "orthogroup", "phase", "status"]
+    values = [run_id, orthogroup, phase, status]
+    for c, v in [("log", log), ("failure", failure), ("attempt", attempt)]:
+        if v is not None:
+            columns.append(c)
+            values.append(v)
+    cur.execute('INSERT INTO phase({}) VALUES ({});'.format(", ".join(columns), ",".join("?" * len(values))),
+                values)
+    phase_id = cur.lastrowid
+    update_phase_state(cur, phase_id, run_id, orthogroup, phase, status)
+    if usage:
+        insert_usage(cur, phase_id, usage)
+
+
+def update_phase_state(cur, phase_id, run_id, orthogroup, phase, status):
+    """phase_state of the job after its phase row phase_id: a running row starts
+    an attempt, any other ends it. A db without the table gets none."""
+    key = (run_id, orthogroup, phase)
+    try:
+        if status == "r":
+            cur.execute('UPDATE phase_state SET status = ?, attempts = attempts + 1, started = CURRENT_TIMESTAMP, '
+                        'ended = NULL, phase_id = ? WHERE run_id IS ? AND orthogroup IS ? AND phase IS ?;',
+                        (status, phase_id) + key)
+        else:
+            cur.execute('UPDATE phase_state SET status = ?, ended = CURRENT_TIMESTAMP, phase_id = ? '
+                        'WHERE run_id IS ? AND orthogroup IS ? AND phase IS ?;', (status, phase_id) + key)
+        if cur.rowcount == 0:
+            cur.execute('INSERT INTO phase_state(run_id, orthogroup, phase, status, attempts, started, ended, phase_id) '
+                        'VALUES (?,?,?,?,?,CURRENT_TIMESTAMP,CASE WHEN ? = "r" THEN NULL ELSE CURRENT_TIMESTAMP END,?);',
+                        key + (status, 1 if status == "r" else 0, status, phase_id))
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+
+
+def db_add_resource_usage(db):
+    """create the resource_usage table: one row per finished job, for the phase row that ended it.
+    CPU times and wall are seconds, maxrss is the peak RSS in kB, inblock/oublock
+    are block I/O operations and processes the number of tool processes."""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS resource_usage ('
+                    'phase_id INTEGER PRIMARY KEY, '
+                    'wall REAL, '
+                    'utime REAL, '
+                    'stime REAL, '
+                    'maxrss INTEGER, '
+                    'inblock INTEGER, '
+                    'oublock INTEGER, '
+                    'processes INTEGER, '
+                    'FOREIGN KEY(phase_id) REFERENCES phase(id)'
+                    ');')
+        con.commit()
+
+
+def insert_usage(cur, phase_id, usage):
+    """resource_usage row of a job (rusage.JobUsage.finish), a db without the table gets none"""
+    try:
+        cur.execute('INSERT INTO resource_usage(phase_id, wall, utime, stime, maxrss, inblock, oublock, processes) '
+                    'VALUES (?,?,?,?,?,?,?,?);',
+                    (phase_id, usage["wall"], usage["utime"], usage["stime"], usage["maxrss"],
+                     usage["inblock"], usage["oublock"], usage["processes"]))
+    except sqlite3.OperationalError:  # no resource_usage table
+        pass
+
+
+# phase columns newer than the first dbs: path prefix of the job's .out/.err logs,
+# helpers.failures class and attempt number of the row
+PHASE_COLUMNS = [("log", "TEXT"), ("failure", "TEXT"), ("attempt", "INTEGER")]
+
+
+def db_add_phase_columns(db):
+    """add the PHASE_COLUMNS missing in the phase table of an older db"""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        cur.execute('PRAGMA table_info(phase);')
+        columns = [c[1] for c in cur.fetchall()]
+        if columns:
+            for name, kind in PHASE_COLUMNS:
+                if name not in columns:
+                    cur.execute('ALTER TABLE phase ADD COLUMN {} {};'.format(name, kind))
+            con.commit()
+
+
+# indexes of the phase table: the latest row of every (orthogroup, phase) of a run
+# (db_get_phase_status, resume) without touching the table, and the status pages
+PHASE_INDEXES = [("phase_latest", "run_id, orthogroup, phase, id"),
+                 ("phase_status", "status, timestamp")]
+
+
+def add_phase_indexes(cur):
+    for name, columns in PHASE_INDEXES:
+        cur.execute('CREATE INDEX IF NOT EXISTS {} ON phase({});'.format(name, columns))
+
+
+def set_journal_mode(con, mode="wal"):
+    """journal mode of the db file, it stays with the file. With wal readers (the
+    status app, resume) and the writer do not block each other; a db shared by
+    jobs on several hosts over NFS needs delete, wal needs shared memory."""
+    try:
+        return con.execute('PRAGMA journal_mode={};'.format(mode)).fetchone()[0]
+    except sqlite3.OperationalError as e:  # leaving wal needs the db to itself
+        current = con.execute('PRAGMA journal_mode;').fetchone()[0]
+        sys.stderr.write("could not set journal mode {} ({}), the db stays in {}.\n".format(mode, e, current))
+        return current
+
+
+def migrate_db(db, journal_mode="wal"):
+    """bring a db of an earlier version up to date: journal mode, phase columns,
+    phase indexes, phase_state, the sequence table, the resource_usage and codeml tables"""
+    con = sqlite3.connect(db, timeout=60)
+    set_journal_mode(con, journal_mode)
+    con.close()
+    db_add_phase_columns(db)
+    db_add_resource_usage(db)
+    db_add_codeml_tables(db)
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'phase';")
+        if cur.fetchone():
+            add_phase_indexes(cur)
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'phase_state';")
+            if not cur.fetchone():
+                create_phase_state(cur)
+                fill_phase_state(cur)
+            con.commit()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'orthoinfo';")
+        if cur.fetchone():
+            create_sequencetable(cur)
+            fill_sequencetable(cur)
+            con.commit()
+
+
+def fill_phase_state(cur):
+    """phase_state from the history in the phase table"""
+    cur.execute('INSERT INTO phase_state(run_id, orthogroup, phase, status, attempts, started, ended, phase_id) '
+                'SELECT l.run_id, l.orthogroup, l.phase, p.status, l.attempts, COALESCE(l.started, p.timestamp), '
+                'CASE WHEN p.status = "r" THEN NULL ELSE p.timestamp END, l.last '
+                'FROM (SELECT run_id, orthogroup, phase, MAX(id) AS last, SUM(status = "r") AS attempts, '
+                'MAX(CASE WHEN status = "r" THEN timestamp END) AS started '
+                'FROM phase GROUP BY run_id, orthogroup, phase) l JOIN phase p ON p.id = l.last;')
+
+
+def db_add_codeml_tables(db):
+    """create the tables of the codeml results, per (run_id, orthogroup, node) with node
+    the foreground branch (ORTHOGROUP.mrc.NODE.MODEL):
+    codeml_result: lnL, np, ntime and kappa of a model's run,
+    codeml_omega: proportion and background/foreground w of its site classes,
+    codeml_lrt: statistic 2(lnL1 - lnL0), df, p-value and significance level (0-3) of h1 vs h0,
+    codeml_site: the NEB and BEB positive sites with Prob(w>1) and codeml's stars"""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS codeml_result ('
+                    'run_id INTEGER, orthogroup TEXT, node TEXT, model TEXT, '
+                    'lnL REAL, np INTEGER, ntime INTEGER, kappa REAL, outfile TEXT, '
+                    'PRIMARY KEY(run_id, orthogroup, node, model));')
+        cur.execute('CREATE TABLE IF NOT EXISTS codeml_omega ('
+                    'run_id INTEGER, orthogroup TEXT, node TEXT, model TEXT, site_class TEXT, '
+                    'proportion REAL, background_w REAL, foreground_w REAL, '
+                    'PRIMARY KEY(run_id, orthogroup, node, model, site_class));')
+        cur.execute('CREATE TABLE IF NOT EXISTS codeml_lrt ('
+                    'run_id INTEGER, orthogroup TEXT, node TEXT, h0 TEXT, h1 TEXT, '
+                    'statistic REAL, df INTEGER, pval REAL, sig INTEGER, '
+                    'PRIMARY KEY(run_id, orthogroup, node, h0, h1));')
+        cur.execute('CREATE INDEX IF NOT EXISTS codeml_lrt_pval ON codeml_lrt(pval);')
+        cur.execute('CREATE TABLE IF NOT EXISTS codeml_site ('
+                    'run_id INTEGER, orthogroup TEXT, node TEXT, model TEXT, method TEXT, '
+                    'site INTEGER, residue TEXT, probability REAL, stars INTEGER, '
+                    'PRIMARY KEY(run_id, orthogroup, node, model, method, site));')
+        cur.execute('CREATE INDEX IF NOT EXISTS codeml_site_node ON codeml_site(method, node, probability);')
+        cur.execute('CREATE INDEX IF NOT EXISTS codeml_site_probability ON codeml_site(method, probability);')
+        con.commit()
+
+
+def db_store_codeml(db, run_id, orthogroup, node, results, lrt=None):
+    """results {model: codeml_summary.codemlResults(outfile) + "outfile"} of one foreground node
+    and lrt {"h0", "h1", "ts", "df", "pval", "sig"}, replaces earlier rows, one transaction"""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        for model, r in results.items():
+            key = (run_id, orthogroup, node, model)
+            cur.execute('INSERT OR REPLACE INTO codeml_result(run_id, orthogroup, node, model, lnL, np, ntime, kappa, '
+                        'outfile) VALUES (?,?,?,?,?,?,?,?,?);',
+                        key + (r["lnL"], r["np"], r["ntime"], r["kappa"], r.get("outfile")))
+            for table in ("codeml_omega", "codeml_site"):
+                cur.execute('DELETE FROM {} WHERE run_id IS ? AND orthogroup = ? AND node = ? AND model = ?;'.format(
+                    table), key)
+            cur.executemany('INSERT INTO codeml_omega(run_id, orthogroup, node, model, site_class, proportion, '
+                            'background_w, foreground_w) VALUES (?,?,?,?,?,?,?,?);',
+                            [key + tuple(o) for o in r["omegas"]])
+            for method in ("NEB", "BEB"):
+                cur.executemany('INSERT OR REPLACE INTO codeml_site(run_id, orthogroup, node, model, method, site, '
+                                'residue, probability, stars) VALUES (?,?,?,?,?,?,?,?,?);',
+                                [key + (method,) + tuple(site) for site in r[method]])
+        if lrt:
+            cur.execute('INSERT OR REPLACE INTO codeml_lrt(run_id, orthogroup, node, h0, h1, statistic, df, pval, sig) '
+                        'VALUES (?,?,?,?,?,?,?,?,?);',
+                        (run_id, orthogroup, node, lrt["h0"], lrt["h1"], lrt["ts"], lrt["df"], lrt["pval"], lrt["sig"]))
+        con.commit()
+
+
+def db_get_positive_sites(db, min_probability=0.95, method="BEB", node=None, run_id=None):
+    """(run_id, orthogroup, node, model, site, residue, probability) of the sites above
+    min_probability, of all runs and foreground nodes unless given"""
+    query = 'SELECT run_id, orthogroup, node, model, site, residue, probability FROM codeml_site ' \
+            'WHERE method = ? AND probability > ?'
+    args = [method, min_probability]
+    if node is not None:
+        query += ' AND node = ?'
+        args.append(str(node))
+    if run_id is not None:
+        query += ' AND run_id = ?'
+        args.append(run_id)
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute(query + ' ORDER BY run_id, orthogroup, node, site;', args)
+        return cur.fetchall()
+
+
+def db_get_codeml_pairs(db, run_id):
+    """(orthogroup, node, h0, h1) of every codeml pair of a run with its LRT stored"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        try:
+            cur.execute('SELECT orthogroup, node, h0, h1 FROM codeml_lrt WHERE run_id = ?;', (run_id,))
+        except sqlite3.OperationalError:  # db of a version without the codeml tables
+            return set()
+        return set(cur.fetchall())
+
+
+def db_get_phase_status(db, run_id):
+    """latest status for every (orthogroup, phase) of a run"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        try:
+            cur.execute('SELECT orthogroup, phase, status FROM phase_state WHERE run_id = ?;', (run_id,))
+        except sqlite3.OperationalError:  # not migrated, from the history
+            cur.execute('SELECT orthogroup, phase, status FROM phase WHERE id IN '
+                        '(SELECT MAX(id) FROM phase WHERE run_id = ? GROUP BY orthogroup, phase);', (run_id,))
+        status = dict(((o, p), s) for o, p, s in cur.fetchall())
+    return status
+
+
+def db_get_orthogroup_sizes(db, run_id):
+    """number of sequences per orthogroup"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute('SELECT orthogroup, COUNT(*) FROM sequence WHERE run_id = ? GROUP BY orthogroup;', (run_id,))
+        sizes = dict(cur.fetchall())
+    return sizes
+
+
+def db_find_sequence(db, seq_id):
+    """(run_id, orthogroup) of every orthogroup with the sequence seq_id"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute('SELECT run_id, orthogroup FROM sequence WHERE seq_id = ?;', (seq_id,))
+        return cur.fetchall()
+
+
+def db_store_estimates(db, run_id, estimates):
+    """store (orthogroup, phase, task, cost) estimates of the scheduler's cost model"""
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS job_cost ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'run_id INTEGER, '
+                    'orthogroup TEXT, '
+                    'phase INTEGER, '
+                    'task TEXT, '
+                    'estimate REAL, '
+                    'timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, '
+                    'FOREIGN KEY(run_id) REFERENCES run(id)'
+                    ');')
+        cur.executemany('INSERT INTO job_cost(run_id, orthogroup, phase, task, estimate) VALUES (?,?,?,?,?);',
+                        [(run_id, o, p, t, c) for o, p, t, c in estimates])
+        con.commit()
+
+
+def db_get_cost_vs_cpu(db, run_id=None):
+    """(orthogroup, phase, estimated cost, CPU seconds) for every step with an estimate and
+    recorded resources, of all runs in the db if run_id is None"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = "table" '
+                    'AND name IN ("job_cost", "resource_usage");')
+        if cur.fetchone()[0] < 2:
+            return []
+        cur.execute('SELECT c.orthogroup, c.phase, c.estimate, u.cpu FROM '
+                    '(SELECT run_id, orthogroup, phase, SUM(estimate) AS estimate FROM job_cost '
+                    ' WHERE ? IS NULL OR run_id = ? GROUP BY run_id, orthogroup, phase) c '
+                    'JOIN '
+                    '(SELECT p.run_id, p.orthogroup, p.phase, SUM(r.utime + r.stime) AS cpu '
+                    ' FROM phase p JOIN resource_usage r ON r.phase_id = p.id '
+                    ' WHERE (? IS NULL OR p.run_id = ?) AND p.status = "s" '
+                    ' GROUP BY p.run_id, p.orthogroup, p.phase) u '
+                    'ON c.run_id = u.run_id AND c.orthogroup = u.orthogroup AND c.phase = u.phase;',
+                    (run_id, run_id, run_id, run_id))
+        res = cur.fetchall()
+    return res
+
+
+def db_get_cost_vs_duration(db, run_id=None):
+    """(orthogroup, phase, estimated cost, seconds spent) for every finished step with an estimate,
+    of all runs in the db if run_id is None.
+
+    the seconds are the sum of all end minus all start timestamps,
+    which is the summed duration no matter how the rows interleave
+    """
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name = "job_cost";')
+        if not cur.fetchall():  # no run stored estimates yet
+            return []
+        cur.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name = "phase_summary";')
+        compacted = ''  # the history of compacted runs is summed up in phase_summary (db_compact)
+        if cur.fetchall():
+            compacted = 'UNION ALL SELECT run_id, orthogroup, phase, seconds, 1, 1 FROM phase_summary ' \
+                        ' WHERE seconds IS NOT NULL '
+        cur.execute('SELECT c.orthogroup, c.phase, c.estimate, d.seconds FROM '
+                    '(SELECT run_id, orthogroup, phase, SUM(estimate) AS estimate FROM job_cost '
+                    ' WHERE ? IS NULL OR run_id = ? GROUP BY run_id, orthogroup, phase) c '
+                    'JOIN '
+                    '(SELECT run_id, orthogroup, phase, '
+                    ' SUM(CASE WHEN status = "r" THEN -strftime("%s", timestamp) '
+                    '     ELSE strftime("%s", timestamp) END) AS seconds, '
+                    ' SUM(status = "r") AS started, SUM(status != "r") AS ended '
+                    ' FROM phase WHERE (? IS NULL OR run_id = ?) AND phase > 0 GROUP BY run_id, orthogroup, phase ' +
+                    compacted + ') d '
+                    'ON c.run_id = d.run_id AND c.orthogroup = d.orthogroup AND c.phase = d.phase '
+                    'WHERE d.started = d.ended;', (run_id, run_id, run_id, run_id))
+        res = cur.fetchall()
+    return res
+
+
+def db_running_jobs(db, run_ids):
+    """(run_id, orthogroup, phase) of the jobs of run_ids that are running, or that
+    died without an end row (a killed run), the db cannot tell them apart"""
+    con = sqlite3.connect(db)
+    with con:
+        cur = con.cursor()
+        cur.execute('SELECT run_id, orthogroup, phase FROM phase_state WHERE status = "r" AND run_id IN ({}) '
+                    'ORDER BY run_id, orthogroup, phase;'.format(",".join(str(int(r)) for r in run_ids)))
+        return cur.fetchall()
+
+
+def db_compact(db, archive, run_ids, journal_mode="wal", force=False):
+    """move the phase events of the runs run_ids and their resource_usage rows into
+    the db file archive, sum them up per (run_id, orthogroup, phase) in phase_summary
+    and keep only the latest phase row of each (the one phase_state points to, resume
+    and the status app see the same status as before), then VACUUM.
+    Whether a run will go on (a next phase, --resume) is not in the db, the caller
+    names the runs; runs with a running job are left alone unless force (their jobs
+    died with the run, a resume starts them again). The summary is computed
+    from everything archived for the run, compact into the same archive every time.
+    Returns the number of phase rows removed from db."""
+    migrate_db(db, journal_mode=journal_mode)
+    running = db_running_jobs(db, run_ids) if run_ids and not force else []
+    if running:
+        print("Runs {} have running jobs, not compacted (--force if they died with their run):".format(
+            ", ".join(str(r) for r in sorted(set(j[0] for j in running)))))
+        for run_id, orthogroup, phase in running:
+            print("    run {} orthogroup {} phase {}".format(run_id, orthogroup, phase))
+    run_ids = [r for r in run_ids if r not in set(j[0] for j in running)]
+    if not run_ids:
+        return 0
+    runs = ",".join(str(int(r)) for r in run_ids)
+    con = sqlite3.connect(db, timeout=60)
+    con.execute('ATTACH DATABASE ? AS archive;', (archive,))
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS archive.phase ('
+                    'id INTEGER PRIMARY KEY, run_id INTEGER, phase INTEGER, orthogroup TEXT, status TEXT, '
+                    'timestamp TIMESTAMP, log TEXT, failure TEXT, attempt INTEGER);')
+        cur.execute('CREATE INDEX IF NOT EXISTS archive.archive_phase_run ON phase(run_id, orthogroup, phase);')
+        cur.execute('CREATE TABLE IF NOT EXISTS archive.resource_usage ('
+                    'phase_id INTEGER PRIMARY KEY, wall REAL, utime REAL, stime REAL, maxrss INTEGER, '
+                    'inblock INTEGER, oublock INTEGER, processes INTEGER);')
+        # the archive first, in a transaction of its own: a crash leaves rows in both, never in none
+        cur.execute('INSERT OR IGNORE INTO archive.phase(id, run_id, phase, orthogroup, status, timestamp, log, '
+                    'failure, attempt) SELECT id, run_id, phase, orthogroup, status, timestamp, log, failure, attempt '
+                    'FROM main.phase WHERE run_id IN ({});'.format(runs))
+        cur.execute('INSERT OR IGNORE INTO archive.resource_usage SELECT u.phase_id, u.wall, u.utime, u.stime, '
+                    'u.maxrss, u.inblock, u.oublock, u.processes FROM main.resource_usage u '
+                    'JOIN main.phase p ON p.id = u.phase_id WHERE p.run_id IN ({});'.format(runs))
+        con.commit()
+    with con:
+        cur = con.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS main.phase_summary ('
+                    'run_id INTEGER, orthogroup TEXT, phase INTEGER, status TEXT, attempts INTEGER, '
+                    'started TIMESTAMP, ended TIMESTAMP, seconds REAL, wall REAL, cpu REAL, maxrss INTEGER, '
+                    'PRIMARY KEY(run_id, orthogroup, phase));')
+        # seconds as in db_get_cost_vs_duration, NULL while starts and ends do not pair up
+        cur.execute('INSERT OR REPLACE INTO main.phase_summary(run_id, orthogroup, phase, status, attempts, started, '
+                    'ended, seconds, wall, cpu, maxrss) '
+                    'SELECT p.run_id, p.orthogroup, p.phase, s.status, SUM(p.status = "r"), MIN(p.timestamp), '
+                    'MAX(p.timestamp), CASE WHEN SUM(p.status = "r") = SUM(p.status != "r") THEN '
+                    'SUM(CASE WHEN p.status = "r" THEN -strftime("%s", p.timestamp) '
+                    'ELSE strftime("%s", p.timestamp) END) END, '
+                    'SUM(u.wall), SUM(u.utime + u.stime), MAX(u.maxrss) '
+                    'FROM archive.phase p LEFT JOIN archive.resource_usage u ON u.phase_id = p.id '
+                    'JOIN main.phase_state s ON s.run_id = p.run_id AND s.orthogroup = p.orthogroup '
+                    'AND s.phase = p.phase '
+                    'WHERE p.run_id IN ({}) GROUP BY p.run_id, p.orthogroup, p.phase;'.format(runs))
+        keep = 'SELECT MAX(id) FROM main.phase WHERE run_id IN ({}) GROUP BY run_id, orthogroup, phase'.format(runs)
+        cur.execute('DELETE FROM main.resource_usage WHERE phase_id IN (SELECT id FROM main.phase '
+                    'WHERE run_id IN ({}) AND id NOT IN ({}));'.format(runs, keep))
+        cur.execute('DELETE FROM main.phase WHERE run_id IN ({}) AND id NOT IN ({});'.format(runs, keep))
+        removed = cur.rowcount
+        con.commit()
+    con.execute('DETACH DATABASE archive;')
+    con.execute('VACUUM;')
+    con.execute('PRAGMA wal_checkpoint(TRUNCATE);')  # a no-op without WAL, else the file shrinks now
+    con.close()
+    return removed
@@ -0,0 +1,112 @@
+__author__ = 'jmass'
+import sys
+import time
+import atexit
+import sqlite3
+import threading
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from .dbhelper import db_log_phase, insert_phase
+
+"""
+One writer for the phase rows of a run: the jobs put their rows on a queue
+(log_phase), a thread of the main process owns the only connection to the
+db and commits whatever has queued up in one transaction. Pool workers
+forked after start() inherit the queue; jobs of other processes (array
+workers, another db) write their rows directly with db_log_phase.
+"""
+
+# seconds to wait for the db lock (the status app reads it)
+DB_TIMEOUT = 60
+# most rows per transaction
+BATCH = 500
+# tries of a batch that finds the db locked before its rows are given up
+TRIES = 3
+STOP = None
+
+_writer = None
+
+
+class DBWriter(object):
+    """Commits the rows put on queue in batches, from a thread of its own.
+    close() (also called at exit) returns after every row put so far is in the db."""
+    def __init__(self, db, batch=BATCH):
+        self.db = db
+        self.batch = max(1, int(batch))
+        self.queue = multiprocessing.Queue()
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name="phasePAML db writer")
+        self._thread.daemon = True  # a live thread would block the exit before close() runs
+        self._thread.start()
+
+    def put(self, *args, **kwargs):
+        self.queue.put((args, kwargs))
+
+    def _run(self):
+        con = sqlite3.connect(self.db, timeout=DB_TIMEOUT)
+        if con.execute('PRAGMA journal_mode;').fetchone()[0] == "wal":
+            con.execute('PRAGMA synchronous=NORMAL;')  # still consistent, a power cut may lose the last batches
+        stop = False
+        while not stop:
+            rows = [self.queue.get()]
+            while len(rows) < self.batch:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if STOP in rows:
+                rows = rows[:rows.index(STOP)]  # nothing is put after close()
+                stop = True
+            self._write(con, rows)
+        con.close()
+
+    def _write(self, con, rows):
+        for attempt in range(1, TRIES + 1):
+            try:
+                with con:
+                    cur = con.cursor()
+                    for args, kwargs in rows:
+                        insert_phase(cur, *args, **kwargs)
+                self.written += len(rows)
+                return
+            except sqlite3.OperationalError as e:
+                sys.stderr.write("db writer: {} ({} rows, try {} of {})\n".format(e, len(rows), attempt, TRIES))
+                time.sleep(attempt)
+        for args, kwargs in rows:
+            sys.stderr.write("db writer: lost phase row {} {}\n".format(args, kwargs))
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(STOP)
+            self._thread.join()
+
+
+def start(db, batch=BATCH):
+    """route the phase rows of db through a DBWriter, before the process pool is forked"""
+    global _writer
+    if _writer is not None:
+        if _writer.db == db:
+            return _writer
+        close()
+    _writer = DBWriter(db, batch=batch)
+    atexit.register(close)
+    return _writer
+
+
+def close():
+    """wait until the queued rows are committed, later rows are written directly"""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        writer.close()
+
+
+def log_phase(db, run_id, orthogroup, phase, status, log=None, usage=None, failure=None, attempt=None):
+    """db_log_phase, through the writer if db has one"""
+    if _writer is not None and _writer.db == db:
+        _writer.put(run_id, orthogroup, phase, status, log=log, usage=usage, failure=failure, attempt=attempt)
+    else:
+        db_log_phase(db, run_id, orthogroup, phase, status, log=log, usage=usage, failure=failure, attempt=attempt)
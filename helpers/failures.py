@@ -0,0 +1,92 @@
+__author__ = 'jmass'
+import re
+import errno
+
+"""
+Failure classes of a job, stored in the failure column of its end row in the
+phase table. Jobs failing with a retryable class are run again by
+wrappers.db_logger (aiorunner.logged) under a retry policy:
+
+    {"attempts": 3, "backoff": 60, "timeout_factor": 2}
+
+at most attempts runs, the n-th retry waits backoff * 2^(n-1) seconds, a
+timed out job gets timeout_factor times the time limit of the last attempt.
+Under a scheduler (policy "resubmit" set) the runner does not wait itself,
+it returns resubmit(delay, kwargs) and the scheduler starts the next attempt
+after delay, the worker and its cores are free meanwhile.
+"""
+
+OOM = "oom"          # killed by the kernel or out of memory
+TIMEOUT = "timeout"  # over its [Timeouts] limit
+IO = "io"            # file system or db trouble
+INPUT = "input"      # bad alignment, too few sequences, ... reruns fail the same way
+TOOL = "tool"        # any other non-zero exit
+UNKNOWN = "unknown"  # an exception the runner did not expect
+RETRYABLE = (OOM, TIMEOUT, IO)
+# OS errors of missing or unreadable files, a rerun finds the same
+PERMANENT_ERRNO = (errno.ENOENT, errno.EACCES, errno.EPERM, errno.ENOTDIR, errno.EISDIR)
+
+# stderr patterns, the first matching class wins
+PATTERNS = [
+    (OOM, re.compile(r"out of memory|cannot allocate memory|memoryerror|bad_alloc|oom-kill", re.I)),
+    (IO, re.compile(r"input/output error|stale (nfs )?file handle|no space left on device|disk quota exceeded|"
+                    r"resource temporarily unavailable|too many open files|database is locked", re.I)),
+    (INPUT, re.compile(r"too few (sequences|taxa|species)|less than \d+ (sequences|taxa|species)|"
+                       r"alignment lengths differ|differ in length|consists entirely of undetermined|"
+                       r"duplicate (sequence |taxon )?names?|does not translate|no nucleotide sequence|"
+                       r"not a multiple of 3", re.I)),
+]
+# seconds, longest wait between two attempts
+MAX_BACKOFF = 3600
+# seconds between SIGTERM and SIGKILL for a job over its time limit
+KILL_GRACE = 30
+
+
+def classify(retval=None, stderr="", timed_out=False):
+    """failure class of a tool run from its exit code and stderr"""
+    if timed_out:
+        return TIMEOUT
+    if not isinstance(stderr, str):
+        stderr = stderr.decode("utf-8", "replace")
+    for kind, pattern in PATTERNS:
+        if pattern.search(stderr or ""):
+            return kind
+    if retval in (-9, 137):  # SIGKILL, without a time limit that is most likely the OOM killer
+        return OOM
+    return TOOL
+
+
+def error_kind(e):
+    """failure class of an exception of the runner's own python code (not a tool)"""
+    if isinstance(e, EnvironmentError):
+        return INPUT if e.errno in PERMANENT_ERRNO else IO
+    return INPUT
+
+
+def retry_delay(policy, attempt, kind):
+    """seconds to wait before the next attempt of a job whose attempt-th run failed
+    with kind, None if it is not retried"""
+    if not policy or kind not in RETRYABLE or attempt >= int(policy.get("attempts", 1)):
+        return None
+    return min(float(policy.get("backoff", 0)) * 2 ** (attempt - 1), MAX_BACKOFF)
+
+
+def scale_resources(policy, kind, kwargs):
+    """more of what ran out for the next attempt: a longer time limit after a timeout.
+    Memory is not a resource the local pool hands out, an OOM killed job is only
+    retried later, when the jobs next to it may have finished."""
+    if kind == TIMEOUT and kwargs.get("timeout"):
+        kwargs["timeout"] = float(kwargs["timeout"]) * float(policy.get("timeout_factor", 1))
+
+
+def resubmit(delay, kwargs):
+    """result of a runner whose next attempt the scheduler starts in delay seconds
+    with kwargs, plain data for the job array task results"""
+    return {"resubmit": delay, "kwargs": kwargs}
+
+
+def resubmitted(result):
+    """delay and kwargs of a resubmit() result, None for any other"""
+    if isinstance(result, dict) and "resubmit" in result:
+        return result["resubmit"], result["kwargs"]
+    return None
@@ -0,0 +1,170 @@
+__author__ = 'jmass'
+import os
+import sys
+import json
+import time
+import subprocess
+from failures import resubmitted
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SLURM_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name={name}
+#SBATCH --array=0-{last}%{jobs}
+#SBATCH --cpus-per-task={cores}
+#SBATCH --output={logs}/{name}.%A_%a.log
+cd {cwd}
+PYTHONPATH={repo}:$PYTHONPATH {python} -m helpers.array_worker {taskfile} $SLURM_ARRAY_TASK_ID
+"""
+
+SGE_TEMPLATE = """#!/bin/bash
+#$ -N {name}
+#$ -t 1-{num}
+#$ -tc {jobs}
+#$ -pe smp {cores}
+#$ -j y
+#$ -o {logs}
+cd {cwd}
+PYTHONPATH={repo}:$PYTHONPATH {python} -m helpers.array_worker {taskfile} $((SGE_TASK_ID - 1))
+"""
+
+BACKENDS = ["slurm", "sge", "fake", "asyncio"]
+
+
+class ArrayScheduler(object):
+    """Sends the jobs of a phase to a cluster as batch job arrays.
+
+    Same interface as helpers.scheduler.Scheduler: submit() collects the
+    runner calls, join() writes one task file and array script per core
+    count, submits it and waits. Every array task runs
+    `python -m helpers.array_worker TASKFILE ID` on a node sharing the file
+    system, the runners log into the sqlite phase table from there.
+    The "fake" backend runs the array script with plain local subprocesses
+    (at most jobs at once), to try everything on one machine.
+    The "asyncio" backend runs all tasks of a phase from a single
+    `python3 -m helpers.aiorunner` event loop on this machine, limits
+    (eg. "prank=8,codeml=64") caps the processes of a tool at once, other
+    tools get jobs. Retries of the local runners come back as their own
+    array after their backoff, the asyncio loop waits for its retries itself.
+    """
+    def __init__(self, backend, workdir, jobs=1, cores=None, name="phasePAML", limits=None, python3="python3"):
+        if backend not in BACKENDS:
+            raise ValueError("unknown job array backend {}".format(backend))
+        self.backend = backend
+        self.workdir = os.path.abspath(workdir)
+        self.jobs = max(1, int(jobs))
+        self.cores = int(cores) if cores else None
+        self.name = name
+        self.limits = limits or ""
+        self.python3 = python3
+        self._pending = []
+        self._delayed = []  # (ready, pending) of the retries waiting for their backoff
+        self._batch = 0
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+
+    def submit(self, func, cores=1, callback=None, priority=0, **kwargs):
+        module = func.__module__
+        if module == "__main__":
+            module = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        if self.cores:
+            cores = min(int(cores), self.cores)
+        if isinstance(kwargs.get("retry"), dict) and self.backend != "asyncio":
+            kwargs["retry"] = dict(kwargs["retry"], resubmit=True)
+        task = {"module": module, "func": func.__name__, "kwargs": kwargs}
+        self._pending.append((priority, len(self._pending), int(cores), callback, task))
+
+    def join(self):
+        while self._pending or self._delayed:
+            if not self._pending:
+                time.sleep(max(0, min(d[0] for d in self._delayed) - time.time()))
+            now = time.time()
+            self._pending.extend(d[1] for d in self._delayed if d[0] <= now)
+            self._delayed = [d for d in self._delayed if d[0] > now]
+            if not self._pending:
+                continue
+            pending = sorted(self._pending, key=lambda p: (p[0], -p[1]), reverse=True)
+            self._pending = []
+            if self.backend == "asyncio":  # the event loop limits per tool, not per core count
+                self._run_array(None, pending)
+                continue
+            for cores in sorted(set(p[2] for p in pending)):
+                self._run_array(cores, [p for p in pending if p[2] == cores])
+
+    def close(self):
+        self.join()
+
+    def _run_array(self, cores, pending):
+        self._batch += 1
+        name = "{}_{:04d}".format(self.name, self._batch)
+        taskfile = os.path.join(self.workdir, name + ".tasks")
+        with open(taskfile, 'w') as tasks:
+            for p in pending:
+                tasks.write(json.dumps(p[4]) + "\n")
+        if self.backend == "asyncio":
+            print("Info: running {} tasks of {} in one event loop".format(len(pending), taskfile))
+            retval = self._run_asyncio(taskfile)
+        else:
+            script = self.write_script(name, taskfile, len(pending), cores)
+            print("Info: submitting {} tasks as job array {}".format(len(pending), script))
+            retval = self._submit(script, len(pending))
+        if retval != 0:
+            sys.stderr.write("job array {} returned {}\n".format(name, retval))
+        for i, p in enumerate(pending):
+            done = "{}.{}.done".format(taskfile, i)
+            if os.path.isfile(done):
+                with open(done, 'r') as d:
+                    res = json.loads(d.read())
+                ok, result = res["ok"], res["result"]
+            else:
+                ok, result = False, "task {} of {} left no result".format(i, taskfile)
+                sys.stderr.write(result + "\n")
+            again = resubmitted(result) if ok else None
+            if again:
+                delay, kwargs = again
+                task = dict(p[4], kwargs=kwargs)
+                self._delayed.append((time.time() + delay, (p[0], p[1], p[2], p[3], task)))
+                continue
+            if p[3]:
+                p[3](ok, result)
+
+    def write_script(self, name, taskfile, num, cores):
+        template = SGE_TEMPLATE if self.backend == "sge" else SLURM_TEMPLATE
+        script = os.path.join(self.workdir, name + ".sh")
+        with open(script, 'w') as out:
+            out.write(template.format(name=name, last=num - 1, num=num, jobs=self.jobs,
+                                      cores=cores, logs=self.workdir, repo=REPO_DIR, cwd=os.getcwd(),
+                                      python=sys.executable, taskfile=taskfile))
+        return script
+
+    def _submit(self, script, num):
+        if self.backend == "slurm":
+            return subprocess.call(["sbatch", "--wait", script])
+        if self.backend == "sge":
+            return subprocess.call(["qsub", "-sync", "y", script])
+        return self._run_fake(script, num)
+
+    def _run_asyncio(self, taskfile):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+        return subprocess.call([self.python3, "-m", "helpers.aiorunner", "-j", str(self.jobs), "-l", self.limits,
+                                "-p", sys.executable, taskfile], env=env)
+
+    def _run_fake(self, script, num):
+        """run the slurm style array script locally, one subprocess per task id"""
+        running = []
+        retval = 0
+        task_id = 0
+        while task_id < num or running:
+            while task_id < num and len(running) < self.jobs:
+                env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id))
+                log = open("{}.{}.log".format(script, task_id), 'w')
+                running.append((subprocess.Popen(["bash", script], env=env, stdout=log,
+                                                 stderr=subprocess.STDOUT), log))
+                task_id += 1
+            for p, log in list(running):
+                if p.poll() is not None:
+                    log.close()
+                    running.remove((p, log))
+                    retval = retval or p.returncode
+            time.sleep(0.1)
+        return retval
@@ -0,0 +1,74 @@
+__author__ = 'jmass'
+import os
+import threading
+
+# a job's log is rotated to LOG.1 .. LOG.<LOG_BACKUPS> when it grows over LOG_MAX_BYTES
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 2
+# bytes of stderr kept in memory for the failure message
+STDERR_TAIL = 4096
+
+
+def job_log(log_dir, func_name, kwargs):
+    """log path prefix of a runner call, eg. LOG_DIR/OG1.codeml.OG1.mrc.12.Ah0 for run_codeml"""
+    name = [str(kwargs.get("orthogroup")), func_name.replace("run_", "", 1)]
+    if kwargs.get("ctl_file"):
+        name.append(os.path.basename(kwargs["ctl_file"])[:-len(".ctl")])
+    if kwargs.get("chunk") is not None:  # run_raxml_bootstraps, one log per chunk
+        name.append("bs{}".format(kwargs["chunk"]))
+    return os.path.join(log_dir, ".".join(name))
+
+
+class RotatingLog(object):
+    """Append-only log file, rotated when it grows over max_bytes.
+
+    With tail > 0 the last tail bytes written are kept in self.tail.
+    """
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, tail=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.tail_bytes = tail
+        self.tail = b""
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):  # another worker was faster
+                    raise
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.fh = open(path, 'ab')
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.fh.write(data)
+        self.size += len(data)
+        if self.tail_bytes:
+            self.tail = (self.tail + data)[-self.tail_bytes:]
+
+    def rotate(self):
+        self.fh.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.rename("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + ".1")
+        self.fh = open(self.path, 'wb')
+        self.size = 0
+
+    def close(self):
+        self.fh.close()
+
+
+def pump(stream, log, blocksize=65536):
+    """copy stream to log in a thread of its own until the writer closes it"""
+    def copy():
+        for block in iter(lambda: os.read(stream.fileno(), blocksize), b""):
+            log.write(block)
+        stream.close()
+    t = threading.Thread(target=copy)
+    t.daemon = True
+    t.start()
+    return t
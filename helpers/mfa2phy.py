@@ -1,7 +1,11 @@
 __author__ = 'jmass'
 
+import os
 import sys
-from fastahelper import FastaParser
+try:
+    from .fastahelper import FastaParser
+except (ValueError, ImportError):  # run as a script
+    from fastahelper import FastaParser
 
 
 def mfa2phy(mfa_in=None, phy_out=None):
@@ -25,6 +29,13 @@ def mfa2phy(mfa_in=None, phy_out=None):
             phy.write("{}{}{}\n".format(k, offset, v))
 
 
+def phy_file(mfa, wd, workdir, suffix=".phy"):
+    """phylip file for mfa: next to it, or in wd if a tool runs in a staging directory instead of workdir"""
+    if wd == workdir:
+        return mfa + suffix
+    return os.path.join(wd, os.path.basename(mfa) + suffix)
+
+
 def main():
     mfa2phy(sys.argv[1], sys.argv[1]+".phy")
 
@@ -0,0 +1,51 @@
+__author__ = 'jmass'
+
+# universal code, pal2nal's default -codontable 1
+STOP_CODONS = set(["TAA", "TAG", "TGA"])
+
+
+def read_paml_msa(paml_msa):
+    """[(name, sequence)] of a sequential PAML alignment as written by pal2nal -output paml"""
+    with open(paml_msa, 'r') as paml:
+        tokens = paml.read().split()
+    n, length = int(tokens[0]), int(tokens[1])
+    seqs = []
+    i = 2
+    for _ in range(n):
+        name = tokens[i]
+        i += 1
+        seq = []
+        size = 0
+        while size < length:
+            seq.append(tokens[i])
+            size += len(tokens[i])
+            i += 1
+        seqs.append((name, "".join(seq)))
+    return seqs
+
+
+def write_paml_msa(seqs, paml_msa, width=60):
+    with open(paml_msa, 'w') as out:
+        length = len(seqs[0][1]) if seqs else 0
+        out.write("   {}    {}\n\n".format(len(seqs), length))
+        for name, seq in seqs:
+            out.write("{}\n".format(name))
+            for i in range(0, len(seq), width):
+                out.write("{}\n".format(seq[i:i + width]))
+
+
+def remove_gap_codons(seqs):
+    """drop every codon column with a gap or an inframe stop codon in any sequence, like pal2nal -nogap"""
+    if not seqs:
+        return seqs
+    keep = []
+    for i in range(0, len(seqs[0][1]), 3):
+        codons = [s[i:i + 3].upper() for n, s in seqs]
+        if not any("-" in c or c in STOP_CODONS for c in codons):
+            keep.append(i)
+    return [(n, "".join(s[i:i + 3] for i in keep)) for n, s in seqs]
+
+
+def nogap_paml(pamlg, paml):
+    """write the -nogap alignment paml from the gapped alignment pamlg"""
+    write_paml_msa(remove_gap_codons(read_paml_msa(pamlg)), paml)
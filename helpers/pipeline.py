@@ -0,0 +1,112 @@
+__author__ = 'jmass'
+import sys
+import traceback
+
+
+class Task(object):
+    """One node of the per-orthogroup dataflow graph.
+
+    func(**kwargs) is run by the scheduler once all tasks named in deps
+    succeeded. then() is called in the main process after func succeeded
+    and may return a list of new tasks (eg. one codeml task per .ctl file).
+    A task with skip=True is not run but counts as finished (then() is still called).
+    prepare(task) is called in the main process right before the task is
+    submitted, when the outputs of its dependencies exist, and may adjust
+    its kwargs, cores and priority (eg. raxml threads from the alignment).
+    """
+    def __init__(self, name, func, kwargs=None, deps=(), cores=1, priority=0, then=None, skip=False,
+                 prepare=None):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.cores = cores
+        self.priority = priority
+        self.then = then
+        self.skip = skip
+        self.prepare = prepare
+
+
+class Pipeline(object):
+    """Feeds tasks to a Scheduler as soon as their dependencies are met,
+    so there is no barrier between the phases of different orthogroups."""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._done = set()
+        self._failed = set()
+        self._waiting = {}
+        self._dependents = {}
+
+    def add(self, task):
+        if task.skip:
+            self._succeeded(task)
+            return
+        if self._failed.intersection(task.deps):
+            self._skip_failed(task)
+            return
+        missing = [d for d in task.deps if d not in self._done]
+        if not missing:
+            self._submit(task)
+        else:
+            self._waiting[task.name] = (task, set(missing))
+            for d in missing:
+                self._dependents.setdefault(d, []).append(task.name)
+
+    def _submit(self, task):
+        if task.prepare:
+            try:
+                task.prepare(task)
+            except Exception:
+                sys.stderr.write("{} failed:\n{}".format(task.name, traceback.format_exc()))
+                self._fail(task.name)
+                return
+        self.scheduler.submit(task.func, cores=task.cores, priority=task.priority,
+                              callback=self._finished(task), **task.kwargs)
+
+    def _finished(self, task):
+        def callback(ok, result):
+            # db_logger returns "f" for a failed, "t" for a timed out tool run
+            if ok and result not in ("f", "t"):
+                self._succeeded(task)
+            else:
+                self._fail(task.name)
+        return callback
+
+    def _succeeded(self, task):
+        new_tasks = []
+        if task.then:
+            try:
+                new_tasks = task.then() or []
+            except Exception:
+                sys.stderr.write("{} failed:\n{}".format(task.name, traceback.format_exc()))
+                self._fail(task.name)
+                return
+        self._done.add(task.name)
+        for t in new_tasks:
+            self.add(t)
+        for name in self._dependents.pop(task.name, []):
+            waiting = self._waiting.get(name)
+            if waiting is None:
+                continue
+            waiting[1].discard(task.name)
+            if not waiting[1]:
+                del self._waiting[name]
+                self._submit(waiting[0])
+
+    def _fail(self, name):
+        self._failed.add(name)
+        for dependent in self._dependents.pop(name, []):
+            waiting = self._waiting.pop(dependent, None)
+            if waiting is not None:
+                self._skip_failed(waiting[0])
+
+    def _skip_failed(self, task):
+        sys.stderr.write("Skipping {}, a task it depends on failed.\n".format(task.name))
+        self._fail(task.name)
+
+    def run(self):
+        """run until no task is left, returns the names of the failed tasks"""
+        self.scheduler.join()
+        for name in self._waiting:
+            sys.stderr.write("{} never became ready.\n".format(name))
+        return sorted(self._failed)
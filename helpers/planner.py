@@ -0,0 +1,100 @@
+__author__ = 'jmass'
+import re
+from costmodel import calibrate
+
+# ctl files tree_labeler.generateCtl writes per labeled tree, by model
+CTL_SUFFIXES = {"M0": ["M0_e05", "M0_e10", "M0_f10"], "FR": ["FR_e1"], "BM": ["BM_f1", "BM_e1"],
+                "M1A": ["M1a_e1"], "M2A": ["M2a_e1"], "M7": ["M7_e1"], "M8": ["M8_e1"],
+                "M8A": ["M8a"], "AH0": ["Ah0"], "AH1": ["Ah1"]}
+# phases logged for the jobs of a tool
+TOOL_PHASES = {"prank": (1, 99), "raxml": (3, 31), "codeml": (5,)}
+# seconds per cost unit until a finished run in the db calibrates them, rough guesses
+DEFAULT_SECONDS_PER_UNIT = {"prank": 2e-4, "raxml": 4e-4, "codeml": 5e-2}
+
+
+def ctl_suffixes(models):
+    """ctl suffixes for a comma-separated model list, unknown models write no ctl file"""
+    res = []
+    for m in models.split(","):
+        res.extend(CTL_SUFFIXES.get(m.strip().upper(), []))
+    return res
+
+
+def predict_labels(headers, regex, depth):
+    """(leaves matching regex, labeled trees at most) for an orthogroup.
+
+    tree_labeler.label_regex writes one labeled tree for every inner node up
+    to depth levels above a matching leaf. raxml trees have a trifurcating
+    root, so n leaves give n - 2 inner nodes; that caps the count when the
+    paths of several matching leaves meet.
+    """
+    pattern = re.compile(regex)
+    matches = len([h for h in headers if re.match(pattern, h)])
+    if not matches:
+        return 0, 0
+    return matches, min(matches * int(depth), max(1, len(headers) - 2))
+
+
+class Plan(object):
+    """Work a run would do, from the input files only: jobs per phase and
+    estimated CPU-hours from the cost model, calibrated with the CPU time
+    (resource_usage) or else the durations of earlier runs in the db where
+    there are some."""
+    def __init__(self, costs, regex, depth, models, num_bootstraps, raxml_threads=1, cost_vs_duration=(),
+                 cost_vs_cpu=()):
+        self.costs = costs
+        self.regex = regex
+        self.depth = depth
+        self.suffixes = ctl_suffixes(models)
+        self.num_bootstraps = num_bootstraps
+        self.raxml_threads = raxml_threads
+        self.calibrated = calibrate(cost_vs_duration, TOOL_PHASES)
+        self.cpu_calibrated = calibrate(cost_vs_cpu, TOOL_PHASES)  # CPU seconds, all threads counted
+        self.orthogroups = []
+
+    def seconds_per_unit(self, tool):
+        if tool in self.cpu_calibrated:
+            return self.cpu_calibrated[tool]
+        return self.calibrated.get(tool, DEFAULT_SECONDS_PER_UNIT[tool])
+
+    def calibration(self, tool):
+        if tool in self.cpu_calibrated:
+            return "calibrated, CPU time"
+        return "calibrated" if tool in self.calibrated else "default"
+
+    def add(self, orthogroup, headers, pep_fa):
+        matches, trees = predict_labels(headers, self.regex, self.depth)
+        prank = self.costs.prank(orthogroup, pep_fa)
+        raxml = self.costs.raxml(orthogroup, self.num_bootstraps, pep_fa=pep_fa)
+        codeml = sum(self.costs.codeml(orthogroup, "{}.mrc.plan.{}.ctl".format(orthogroup, s), None, fasta=pep_fa)
+                     for s in self.suffixes) * trees
+        self.orthogroups.append({"orthogroup": orthogroup, "seqs": len(headers), "matches": matches,
+                                 "trees": trees, "ctls": trees * len(self.suffixes),
+                                 "prank": prank, "raxml": raxml, "codeml": codeml})
+        self.costs.pop_estimates()
+
+    def cpu_hours(self, tool):
+        threads = self.raxml_threads if tool == "raxml" and tool not in self.cpu_calibrated else 1
+        return sum(o[tool] for o in self.orthogroups) * self.seconds_per_unit(tool) * threads / 3600.0
+
+    def report(self, cores=1, top=10):
+        n = len(self.orthogroups)
+        ctls = sum(o["ctls"] for o in self.orthogroups)
+        lines = ["orthogroups: {}".format(n),
+                 "without a regex match (no ctl files): {}".format(len([o for o in self.orthogroups if not o["trees"]])),
+                 "labeled trees: up to {}".format(sum(o["trees"] for o in self.orthogroups)),
+                 "ctl files / codeml runs: up to {} ({} per labeled tree)".format(ctls, len(self.suffixes)),
+                 "",
+                 "{:<8}{:>10}{:>14}  {}".format("phase", "jobs", "CPU-hours", "seconds/unit")]
+        total = 0.0
+        for phase, tool, jobs in [(1, "prank", n), (3, "raxml", n), (5, "codeml", ctls)]:
+            hours = self.cpu_hours(tool)
+            total += hours
+            lines.append("{:<8}{:>10}{:>14.1f}  {:.3g} ({})".format(
+                "{} {}".format(phase, tool), jobs, hours, self.seconds_per_unit(tool), self.calibration(tool)))
+        lines.append("total CPU-hours: {:.1f}, about {:.1f} h on {} cores".format(total, total / max(1, cores), cores))
+        lines.append("")
+        lines.append("most labeled trees:")
+        for o in sorted(self.orthogroups, key=lambda o: o["ctls"], reverse=True)[:top]:
+            lines.append("  {orthogroup}: {seqs} seqs, {matches} matching, {trees} trees, {ctls} ctl files".format(**o))
+        return "\n".join(lines)
@@ -0,0 +1,65 @@
+__author__ = 'jmass'
+import os
+from .dbhelper import db_get_phase_status, db_get_codeml_pairs
+from .costmodel import read_ctl
+from .bootstraps import count_trees
+
+
+def msa_pairs(msa_dir, nuc_dir):
+    """(nuc fasta files, msa) for every ORTHOGROUP.msa in msa_dir, its other files are
+    skipped (.reduced, raxml's .msa.phy in a run resumed after phase 3)"""
+    nucfiles = sorted(os.listdir(nuc_dir))
+    for f in sorted(os.listdir(msa_dir)):
+        if not f.endswith(".msa"):
+            continue
+        orthogroup = f.split(".")[0]
+        yield ([os.path.join(nuc_dir, n) for n in nucfiles if n.split(".")[0] == orthogroup],
+               os.path.join(msa_dir, f))
+
+
+class RunState(object):
+    """What an earlier attempt of a run already finished.
+
+    A step counts as done if its latest status (phase_state) is a success
+    (or a cache hit) and its output files are still there. Without a db every step is to do.
+    The summary (phase 7) of an orthogroup is one step per codeml pair, see summary_done.
+    """
+    def __init__(self, db=None, run_id=None):
+        self.status = {}
+        self.summaries = set()
+        if db and run_id and os.path.isfile(db):
+            self.status = db_get_phase_status(db, run_id)
+            self.summaries = db_get_codeml_pairs(db, run_id)
+
+    def done(self, orthogroup, phase, artifacts=()):
+        if self.status.get((orthogroup, phase)) not in ("s", "c"):
+            return False
+        return all(os.path.exists(a) for a in artifacts)
+
+    def summary_done(self, h0, h1):
+        """the pair of codeml outputs ORTHOGROUP.mrc.NODE.H0 and .H1 is summarized once its LRT is
+        in the db, phase 7 rows are per orthogroup and one of its pairs may be missing"""
+        orthogroup = os.path.basename(h0).split(".")[0]
+        node, h0_model = os.path.basename(h0).split(".")[-2:]
+        return (orthogroup, node, h0_model, os.path.basename(h1).split(".")[-1]) in self.summaries
+
+    def chunk_done(self, bootstrap_file, num_bootstraps):
+        """raxml writes the bootstrap trees as they finish, a chunk with all of them is done"""
+        if not self.status:
+            return False
+        return count_trees(bootstrap_file) == int(num_bootstraps)
+
+    def codeml_done(self, ctl_file, work_dir):
+        """codeml only writes 'Time used' once it finished"""
+        if not self.status:
+            return False
+        outfile = read_ctl(os.path.join(work_dir, ctl_file)).get("outfile")
+        if not outfile:
+            return False
+        outfile = os.path.join(work_dir, outfile)
+        if not os.path.isfile(outfile):
+            return False
+        with open(outfile, 'r') as out:
+            out.seek(0, os.SEEK_END)
+            out.seek(max(0, out.tell() - 1024))
+            return "Time used" in out.read()
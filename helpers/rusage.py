@@ -0,0 +1,90 @@
+__author__ = 'jmass'
+import os
+import time
+import errno
+import resource
+import threading
+
+"""
+Resources of a runner call for the resource_usage table: user/sys CPU
+seconds, peak RSS (kB), block I/O and wall time of every tool process
+(os.wait4), plus the CPU time the runner spent in-process.
+"""
+
+FIELDS = ("utime", "stime", "maxrss", "inblock", "oublock")
+
+_current = threading.local()
+
+
+def rusage_dict(rusage):
+    return {"utime": rusage.ru_utime, "stime": rusage.ru_stime, "maxrss": rusage.ru_maxrss,
+            "inblock": rusage.ru_inblock, "oublock": rusage.ru_oublock}
+
+
+def wait_rusage(p):
+    """p.wait() for a subprocess.Popen, returns (returncode, its struct_rusage)"""
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    p.returncode = exit_code(status)
+    return p.returncode, rusage
+
+
+def exit_code(status):
+    """returncode as subprocess has it for a wait status, -N if killed by signal N"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class JobUsage(object):
+    """Resources of one runner call.
+
+    add() sums the rusage of its tool processes (maxrss is the largest one).
+    With in_process the CPU time and block I/O of the calling process since
+    the job started are added, that is right for a pool worker running one
+    job at a time; a job without tool processes gets the worker's peak RSS.
+    """
+    def __init__(self, in_process=True):
+        self.started = time.time()
+        self.processes = 0
+        self.children = dict((f, 0) for f in FIELDS)
+        self.own = resource.getrusage(resource.RUSAGE_SELF) if in_process else None
+
+    def add(self, rusage):
+        if not isinstance(rusage, dict):
+            rusage = rusage_dict(rusage)
+        self.processes += 1
+        for f in FIELDS:
+            if f == "maxrss":
+                self.children[f] = max(self.children[f], rusage[f])
+            else:
+                self.children[f] += rusage[f]
+
+    def finish(self):
+        res = dict(self.children, wall=time.time() - self.started, processes=self.processes)
+        if self.own is not None:
+            now = rusage_dict(resource.getrusage(resource.RUSAGE_SELF))
+            own = rusage_dict(self.own)
+            for f in ("utime", "stime", "inblock", "oublock"):
+                res[f] += now[f] - own[f]
+            if not self.processes:
+                res["maxrss"] = now["maxrss"]
+        return res
+
+
+def start_job(in_process=True):
+    """a JobUsage collecting the tool processes this thread waits for"""
+    _current.job = JobUsage(in_process=in_process)
+    return _current.job
+
+
+def record(rusage):
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.add(rusage)
+
@@ -0,0 +1,156 @@
+__author__ = 'jmass'
+import sys
+import time
+import bisect
+import itertools
+import traceback
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from .failures import resubmitted
+
+
+def _call(func, kwargs):
+    """run func in a pool worker, never let an exception kill the pool.
+    SystemExit is a failed job too (mfa2phy, codeml_summary call sys.exit),
+    a worker that died would leave join() waiting for its result forever."""
+    try:
+        return True, func(**kwargs)
+    except KeyboardInterrupt:
+        raise
+    except BaseException:
+        return False, traceback.format_exc()
+
+
+class Scheduler(object):
+    """Runs the wrapper functions (run_prank, run_raxml, ...) in a bounded process pool.
+
+    Each job claims a number of cores (RAxML claims its num_cpu threads)
+    and is only started while the claimed cores fit into the core budget.
+    With jobs=1 everything runs in the calling process, one job at a time.
+    Queued jobs start in order of decreasing priority (a number or a tuple
+    of numbers), first come first served within the same priority.
+    submit() only queues, jobs are started from join(), so everything
+    submitted before join() competes by priority (also with jobs=1).
+    Smaller jobs may start past a first job that waits for cores until it
+    has waited as long as a finished job took on average, then the cores
+    are kept for it (a wide raxml or codeml job is not starved by the
+    1-core jobs behind it).
+    A job whose runner returns a failures.resubmit() result (a retry after
+    its backoff) goes back to the queue with its priority once the delay is
+    over, it holds no worker and no cores while it waits; its callback is
+    only called for the last attempt.
+    Callbacks are called in the calling process from within join().
+    """
+    def __init__(self, jobs=1, cores=None):
+        self.jobs = max(1, int(jobs))
+        if cores:
+            self.cores = max(1, int(cores))
+        else:
+            self.cores = self.jobs
+        self._free = self.cores
+        self._pending = []
+        self._keys = []
+        self._count = itertools.count()
+        self._running = 0
+        self._done = queue.Queue()
+        self._blocked = None  # (key, since) of the first job while it waits for cores
+        self._durations = [0.0, 0]  # seconds and number of the finished jobs
+        self._delayed = []  # (ready, key, job) of the retries waiting for their backoff
+        self._pool = None
+        if self.jobs > 1:
+            self._pool = multiprocessing.Pool(processes=self.jobs)
+
+    def submit(self, func, cores=1, callback=None, priority=0, **kwargs):
+        """queue func(**kwargs), callback(ok, result) is called after it finished"""
+        cores = max(1, min(int(cores), self.cores))
+        if isinstance(kwargs.get("retry"), dict):  # the runner hands its retries back, see join()
+            kwargs["retry"] = dict(kwargs["retry"], resubmit=True)
+        if isinstance(priority, tuple):
+            key = (tuple(-p for p in priority), next(self._count))
+        else:
+            key = (-priority, next(self._count))
+        self._queue(key, (func, cores, callback, kwargs))
+
+    def _queue(self, key, job):
+        i = bisect.bisect(self._keys, key)
+        self._keys.insert(i, key)
+        self._pending.insert(i, job)
+
+    def _backfill(self):
+        """whether jobs behind the waiting first job may still take free cores"""
+        key = self._keys[0]
+        if self._blocked is None or self._blocked[0] != key:
+            self._blocked = (key, time.time())
+        seconds, finished = self._durations
+        return not finished or time.time() - self._blocked[1] < seconds / finished
+
+    def _dispatch(self):
+        i = 0
+        while i < len(self._pending) and self._running < self.jobs and self._free > 0:
+            job = self._pending[i]
+            func, cores, callback, kwargs = job
+            if cores > self._free:
+                if i == 0 and not self._backfill():
+                    break
+                i += 1
+                continue
+            if i == 0:
+                self._blocked = None
+            key = self._keys.pop(i)
+            del self._pending[i]
+            self._free -= cores
+            self._running += 1
+            if self._pool is None:
+                start = time.time()
+                self._done.put((key, job, start, _call(func, kwargs)))
+            else:
+                self._pool.apply_async(_call, (func, kwargs),
+                                       callback=self._finished(key, job, time.time()))
+
+    def _finished(self, key, job, start):
+        def put(result):
+            self._done.put((key, job, start, result))
+        return put
+
+    def _release(self):
+        """queue the retries whose backoff is over"""
+        now = time.time()
+        for delayed in [d for d in self._delayed if d[0] <= now]:
+            self._delayed.remove(delayed)
+            self._queue(delayed[1], delayed[2])
+
+    def join(self):
+        """wait until every submitted job (and everything submitted by callbacks) is done"""
+        while self._running or self._pending or self._delayed:
+            if self._delayed:
+                self._release()
+            self._dispatch()
+            try:
+                key, job, start, result = self._done.get(True, 1)
+            except queue.Empty:
+                continue
+            func, cores, callback, kwargs = job
+            self._free += cores
+            self._running -= 1
+            self._durations[0] += time.time() - start
+            self._durations[1] += 1
+            ok, res = result
+            again = resubmitted(res) if ok else None
+            if again:
+                delay, kwargs = again
+                self._delayed.append((time.time() + delay, key, (func, cores, callback, kwargs)))
+            else:
+                if not ok:
+                    sys.stderr.write(res)
+                if callback:
+                    callback(ok, res)
+
+    def close(self):
+        self.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,91 @@
+__author__ = 'jmass'
+import os
+import errno
+import shutil
+import tempfile
+import contextlib
+
+
+def link_or_copy(src, dest):
+    """hardlink src to dest, copy if they are on different file systems"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(src, dest)
+
+
+def has_room(root, files=(), min_free_mb=0):
+    """more than min_free_mb plus the size of files free below root"""
+    try:
+        st = os.statvfs(root)
+    except OSError:  # no such directory
+        return False
+    need = int(min_free_mb or 0) * 1024 * 1024 + sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+    return st.f_bavail * st.f_frsize > need
+
+
+def publish(src, dest):
+    """move src to dest, atomically: dest is the old or the complete new file, never a part.
+    Across file systems the copy is made next to dest and renamed into place."""
+    if os.path.abspath(src) == os.path.abspath(dest):
+        return
+    try:
+        os.rename(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), prefix="." + os.path.basename(dest))
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp)  # mode and mtime of src, not the 0600 of mkstemp
+        os.rename(tmp, dest)
+    except (IOError, OSError):
+        os.remove(tmp)
+        raise
+    os.remove(src)
+
+
+def publish_outputs(wd, outputs):
+    """publish() the outputs (name -> destination) a tool wrote to wd"""
+    for dest in outputs.values():
+        publish(os.path.join(wd, os.path.basename(dest)), dest)
+
+
+@contextlib.contextmanager
+def scratch_dir(parent, inputs=(), prefix="tmp", root=None, min_free_mb=0):
+    """private directory below parent with the input files linked in,
+    removed with everything left in it when the block is done.
+
+    Tools like codeml write fixed-name side files (rst, rub, lnf, ...) to
+    their working directory, in a directory of their own several of them
+    can run at once. Pass cwd=... to Popen, os.chdir is process-global.
+    With a scratch root (eg. /dev/shm or a local disk) the directory is made
+    there instead, unless it has no room for the inputs and min_free_mb
+    more; publish() the outputs back.
+    """
+    if root and has_room(root, inputs, min_free_mb):
+        parent = root
+    d = tempfile.mkdtemp(dir=parent, prefix=prefix)
+    try:
+        for i in inputs:
+            link_or_copy(i, os.path.join(d, os.path.basename(i)))
+        yield d
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def staging_dir(workdir, root=None, min_free_mb=0, inputs=(), prefix="tmp"):
+    """where a tool writing into workdir runs: a scratch_dir below root if it
+    has room for inputs and min_free_mb more, else workdir itself. Only the
+    outputs publish()ed to workdir are kept from a scratch directory."""
+    if not root or not has_room(root, inputs, min_free_mb):
+        yield workdir
+        return
+    with scratch_dir(root, prefix=prefix) as d:
+        yield d
@@ -4,52 +4,163 @@ import sys
 import subprocess
 import shutil
 import os
+import time
+import signal
+import functools
+import threading
+import io
 from fastahelper import FastaParser
-from mfa2phy import mfa2phy
+from mfa2phy import mfa2phy, phy_file
 from tree_labeler import make_ctl_tree
-from codeml_summary import calculatePvalue, CODEMLParser
+from codeml_summary import calculatePvalue, CODEMLParser, codemlResults
 from map_back import map_back
+from cache import ArtifactCache, CACHE_HIT
+from scratch import scratch_dir, staging_dir, publish, publish_outputs
+from joblog import RotatingLog, job_log, pump, STDERR_TAIL
+from rusage import wait_rusage, record, start_job
+from dbwriter import log_phase
+from dbhelper import db_store_codeml
+from costmodel import read_ctl, raxml_thread_count
+from paml_msa import nogap_paml
+from backtranslate import back_translate, BackTranslationException
+from bootstraps import chunk_run_name, chunk_file, merge_bootstraps, remove_raxml_files
+from failures import classify, error_kind, retry_delay, scale_resources, resubmit
+from failures import TOOL, TIMEOUT, INPUT, IO, UNKNOWN, KILL_GRACE
+
 
 class PipelineException(Exception):
-    pass
+    """a failed job, kind is its helpers.failures class"""
+    kind = TOOL
+
+    def __init__(self, message="", kind=None):
+        Exception.__init__(self, message)
+        if kind:
+            self.kind = kind
+
+
+class PipelineTimeout(PipelineException):
+    kind = TIMEOUT
+
+
+def kill_group(p, expired, grace=KILL_GRACE):
+    """terminate the process group of p, kill it if it is still there after grace seconds"""
+    expired.append(True)
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        time.sleep(grace)
+        if p.returncode is None:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:  # group is gone already
+        pass
+
+
+def run_command(call, cwd=None, timeout=None, log=None):
+    """run call in a shell, returns (retval, stdout, stderr).
+    The shell gets a process group of its own, so the tool and everything it
+    started is terminated after timeout seconds (PipelineTimeout is raised).
+    With a log prefix the output is streamed to the rotating files LOG.out
+    and LOG.err instead of being held in memory, stdout is then returned
+    empty and stderr as its last STDERR_TAIL bytes.
+    The shell's rusage (os.wait4, with the tool it waited for) is added
+    to the resources of the running job."""
+    p = subprocess.Popen(call, shell=True, cwd=cwd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         preexec_fn=os.setsid)
+    expired = []
+    timer = None
+    if timeout:
+        timer = threading.Timer(float(timeout), kill_group, [p, expired])
+        timer.daemon = True
+        timer.start()
+    try:
+        if log:
+            out = RotatingLog(log + ".out")
+            err = RotatingLog(log + ".err", tail=STDERR_TAIL)
+            out.write("$ {}\n".format(call).encode("utf-8"))
+            try:
+                for t in [pump(p.stdout, out), pump(p.stderr, err)]:
+                    t.join()
+            finally:
+                out.close()
+                err.close()
+            p_out, p_err = b"", err.tail
+        else:
+            out, err = io.BytesIO(), io.BytesIO()
+            for t in [pump(p.stdout, out), pump(p.stderr, err)]:
+                t.join()
+            p_out, p_err = out.getvalue(), err.getvalue()
+    finally:
+        if timer:
+            timer.cancel()
+    retval, rusage = wait_rusage(p)
+    record(rusage)
+    if expired:
+        raise PipelineTimeout("{} killed after {} s\n".format(call, timeout))
+    return retval, p_out, p_err
 
 
-def q(s):
-    return '"' + s + '"'
+def failed(call, retval, p_err):
+    """PipelineException for a tool call, with the end of its stderr"""
+    if not isinstance(p_err, str):
+        p_err = p_err.decode("utf-8", "replace")
+    return PipelineException("{} returned {}:\n{}\n".format(call, retval, p_err[-STDERR_TAIL:]),
+                             kind=classify(retval, p_err))
 
 
 def db_logger(f):
+    """log the runner's start and end rows in the phase table.
+    A retry policy (helpers.failures) in the "retry" kwarg reruns the
+    runner after retryable failures, every attempt gets its rows. An
+    exception the runner did not expect ends the job as failed (unknown)
+    before it is raised on."""
+    @functools.wraps(f)  # keeps the wrapped runners picklable for the process pool
     def wrapper(*args, **kwargs):
         db = kwargs.get("db")
         run_id = kwargs.get("run_id")
         print("WRAPPER runid", run_id)
         if not run_id:
-            run_id = "NULL"
+            run_id = None
         phase = kwargs.get("phase")
-        status = "r"
         orthogroup = kwargs.get("orthogroup")
-        connection = sqlite3.connect(db)
-        with connection:
-            cur = connection.cursor()
-            cmd = 'INSERT INTO phase (run_id, orthogroup, phase, status) VALUES ({},{},{},{})'.format(run_id, q(orthogroup), phase,
-                                                                                           q(status))
-            print(cmd, db)
-            cur.execute(cmd)
-            connection.commit()
+        log_dir = kwargs.pop("log_dir", None)
+        retry = kwargs.pop("retry", None)
+        attempt = kwargs.pop("attempt", 1)  # > 1 for an attempt resubmitted by the scheduler
+        if log_dir:  # tool output goes to LOG.out/LOG.err, the phase rows point there
+            kwargs["log"] = job_log(log_dir, f.__name__, kwargs)
+        # rows go through the run's dbwriter if this process has its queue
+        row = functools.partial(log_phase, db, run_id, orthogroup, phase, log=kwargs.get("log"))
+        while True:
+            failure = None
+            row(status="r", attempt=attempt)
+            job = start_job()
             try:
                 res = f(*args, **kwargs)
                 print(res)
                 status = "s"  # success
+                if res == CACHE_HIT:
+                    status = "c"  # success, outputs from cache
+            except PipelineTimeout as e:
+                sys.stderr.write(str(e))
+                status, failure = "t", e.kind  # timeout, killed
             except PipelineException as e:
                 sys.stderr.write(str(e))
-                status = "f"  # fail
-            cmd = 'INSERT INTO phase (run_id, orthogroup, phase, status) VALUES ({},{},{},{})'.format(run_id, q(orthogroup), phase,
-                                                                                           q(status))
-
+                status, failure = "f", e.kind  # fail
+            except BaseException:  # no "r" row without an end
+                row(status="f", usage=job.finish(), failure=UNKNOWN, attempt=attempt)
+                raise
             print("phase {} done.\n".format(str(phase)))
-            print(cmd)
-            cur.execute(cmd)
-            connection.commit()
+            row(status=status, usage=job.finish(), failure=failure, attempt=attempt)
+            delay = retry_delay(retry, attempt, failure)
+            if delay is None:
+                return status
+            scale_resources(retry, failure, kwargs)
+            sys.stderr.write("{} of {} failed ({}), attempt {} in {} s\n".format(
+                f.__name__, orthogroup, failure, attempt + 1, delay))
+            attempt += 1
+            if retry.get("resubmit"):
+                return resubmit(delay, dict(kwargs, retry=retry, attempt=attempt))
+            time.sleep(delay)
 
     return wrapper
 
@@ -58,17 +169,21 @@ def db_logger(f):
 @db_logger
 def run_prank(infile=None, outfile=None,
               cpu=1, db=None, orthogroup=None,
-              run_id=None, phase=None, program=None):
-    p = subprocess.Popen('{} +F -d={} -o={} '.format(program, infile, outfile),
-                         shell=True, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p_out, p_err = p.communicate()
-    retval = p.wait()
+              run_id=None, phase=None, program=None, cache=None, timeout=None, log=None):
+    if cache:
+        cache = ArtifactCache(cache)
+        key = cache.key(files=[infile], args=[os.path.basename(program), "+F"])
+        if cache.fetch(key, {"msa": outfile}):
+            return CACHE_HIT
+    prank_call = '{} +F -d={} -o={} '.format(program, infile, outfile)
+    retval, p_out, p_err = run_command(prank_call, timeout=timeout, log=log)
     if retval != 0:
-        raise PipelineException
+        raise failed(prank_call, retval, p_err)
     else:
         #prank attaches ".best.fas"
         shutil.move(outfile + ".best.fas", outfile)
+        if cache:
+            cache.store(key, {"msa": outfile})
         return retval
 
 
@@ -88,86 +203,159 @@ def sort_fasta(nuc_fa=None, pep_msa=None, nuc_msa_out=None):
 def run_pal2nal(program = None, pep_msa=None, outfile=None,
                 nuc_fa=None, cpu=1, db=None,
                 orthogroup=None, run_id=None,
-                phase=None):
+                phase=None, timeout=None, log=None):
     pal2nal_nuc_in = outfile + ".nuc"
     sort_fasta(nuc_fa=nuc_fa, pep_msa=pep_msa, nuc_msa_out=pal2nal_nuc_in)
     paml = outfile + ".paml"
     pamlg = outfile + ".pamlg"
-    print("CALL pal2nal nuc: {} msa: {} out:{}", pal2nal_nuc_in, pep_msa, paml)
     print("CALL pal2nal nuc: {} msa: {} out:{}", pal2nal_nuc_in, pep_msa, pamlg)
 
-    p = subprocess.Popen('{} {} {} -output paml -nogap > {} '.format(program, pep_msa, pal2nal_nuc_in, paml),
-                         shell=True, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p_out, p_err = p.communicate()
-    #todo log errors
+    # one pal2nal run for the gapped alignment, the -nogap one is cut from it
+    pal2nal_call = '{} {} {} -output paml > {} '.format(program, pep_msa, pal2nal_nuc_in, pamlg)
+    retval, p_out, p_err = run_command(pal2nal_call, timeout=timeout, log=log)
     print(p_out, p_err)
-    retval = p.wait()
     if retval != 0:
-        raise PipelineException
-    else:
-        p = subprocess.Popen('pal2nal.pl {} {} -output paml > {} '.format(pep_msa, pal2nal_nuc_in, pamlg),
-                             shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        p_out, p_err = p.communicate()
-        #print(p_out, p_err)
-        retval = p.wait()
-        if retval != 0:
-            raise PipelineException
-        elif p_err != "":
-            sys.stderr.write(p_err)
-            return retval
-        else:
+        raise failed(pal2nal_call, retval, p_err)
+    try:
+        nogap_paml(pamlg, paml)
+    except (IndexError, ValueError) as e:
+        raise PipelineException("could not read {}: {}\n".format(pamlg, e))
+    if p_err:
+        sys.stderr.write(p_err)
+    return retval
 
-            return retval
+@db_logger
+def run_backtranslate(program=None, pep_msa=None, outfile=None,
+                      nuc_fa=None, cpu=1, db=None,
+                      orthogroup=None, run_id=None,
+                      phase=None, timeout=None, log=None):
+    """phase 2 without pal2nal, same outputs as run_pal2nal"""
+    try:
+        back_translate(pep_msa, nuc_fa, outfile)
+    except IOError as e:
+        raise PipelineException("back translation of {} failed: {}\n".format(pep_msa, e), kind=error_kind(e))
+    except (BackTranslationException, KeyError) as e:
+        raise PipelineException("back translation of {} failed: {}\n".format(pep_msa, e), kind=INPUT)
+    return 0
 
 @db_logger
 def run_raxml(program = None, pep_msa=None, outdir=None, model=None,
               bootstrap_seed=123, num_bootstraps=None, workdir = None,
               num_cpu=None, db=None, orthogroup=None,
-              run_id=None, phase=None):
+              run_id=None, phase=None, cache=None, scratch=None, min_free_mb=0,
+              timeout=None, log=None):
     run_name = orthogroup
-    pep_msa_phy = pep_msa+".phy"
-    mfa2phy(pep_msa, pep_msa_phy)
+    remove_raxml_files(workdir, run_name)
+    remove_raxml_files(workdir, run_name + ".mrc")
     if num_bootstraps == 0:
-        raxml_call= '{} -p {} -m {} -n {} -s {} -w {}'.format(program, bootstrap_seed, model, run_name, pep_msa_phy, workdir)
-    else:
-        raxml_call = '{} -m {} -T {} -n {} -s {} -b {} -N {} -w {}'.\
-            format(program, model, num_cpu, run_name, pep_msa_phy,
-                   bootstrap_seed, num_bootstraps, workdir)
-    #todo raxml might have different names on other systems
-    print(raxml_call)
-    p = subprocess.Popen(raxml_call, shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    p_out, p_err = p.communicate()
-    print(p_err)
-    print(p_out)
-    retval = p.wait()
-    if retval != 0:
-        raise PipelineException
+        outputs = {"result": os.path.join(workdir, "RAxML_result." + run_name),
+                   "bestTree": os.path.join(workdir, "RAxML_bestTree." + run_name)}
     else:
+        outputs = {"bootstrap": os.path.join(workdir, "RAxML_bootstrap." + run_name),
+                   "MajorityRuleConsensusTree": os.path.join(workdir, "RAxML_MajorityRuleConsensusTree." + run_name + ".mrc")}
+    if cache:
+        cache = ArtifactCache(cache)
+        key = cache.key(files=[pep_msa], args=[os.path.basename(program), model, num_bootstraps, bootstrap_seed])
+        if cache.fetch(key, outputs):
+            return CACHE_HIT
+    # raxml rewrites its RAxML_* files all through the run, on scratch only the outputs reach workdir
+    with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, inputs=[pep_msa], prefix="raxml_") as wd:
+        pep_msa_phy = phy_file(pep_msa, wd, workdir)
+        mfa2phy(pep_msa, pep_msa_phy)
+        threads = raxml_thread_count(program, num_cpu)
+        threads = '-T {} '.format(threads) if threads else ''
         if num_bootstraps == 0:
-            return retval
-            #todo mv to mrc (even though its not an mrc)
+            raxml_call= '{} -p {} -m {} {}-n {} -s {} -w {}'.format(program, bootstrap_seed, model, threads,
+                                                                    run_name, pep_msa_phy, wd)
         else:
-            bstree = os.path.join(workdir,"RAxML_bootstrap."+orthogroup)
-            mrc = orthogroup+".mrc"
-            # raxmlHPC -m $model -J MR -z RAxML_bootstrap.run.$nm -n $short
-            raxml_call_consensus = '{} -m {} -J MR -z {} -n {} -w {}'.format(program, model, bstree, mrc, workdir)
-            p = subprocess.Popen(raxml_call_consensus,
-                                 shell=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            p_out, p_err = p.communicate()
-            print(p_out)
-            print(p_err)
-            retval = p.wait()
-            if retval != 0:
-                raise PipelineException
-            else:
-                #rename
-                return retval
+            raxml_call = '{} -m {} {}-n {} -s {} -b {} -N {} -w {}'.\
+                format(program, model, threads, run_name, pep_msa_phy,
+                       bootstrap_seed, num_bootstraps, wd)
+        #todo raxml might have different names on other systems
+        print(raxml_call)
+        started = time.time()
+        retval, p_out, p_err = run_command(raxml_call, timeout=timeout, log=log)
+        print(p_err)
+        print(p_out)
+        if retval != 0:
+            raise failed(raxml_call, retval, p_err)
+        #todo mv to mrc (even though its not an mrc)
+        if num_bootstraps != 0:
+            bstree = os.path.join(wd, "RAxML_bootstrap."+orthogroup)
+            if timeout:  # the consensus gets what is left of the job's limit
+                timeout = max(1, float(timeout) - (time.time() - started))
+            retval = raxml_consensus(program, model, bstree, orthogroup, wd, timeout=timeout, log=log)
+        publish_outputs(wd, outputs)
+    if cache:
+        cache.store(key, outputs)
+    return retval
+
+
+def raxml_consensus(program, model, bstree, orthogroup, workdir, timeout=None, log=None):
+    """RAxML_MajorityRuleConsensusTree.ORTHOGROUP.mrc of the bootstrap trees in bstree"""
+    mrc = orthogroup+".mrc"
+    # raxmlHPC -m $model -J MR -z RAxML_bootstrap.run.$nm -n $short
+    raxml_call_consensus = '{} -m {} -J MR -z {} -n {} -w {}'.format(program, model, bstree, mrc, workdir)
+    retval, p_out, p_err = run_command(raxml_call_consensus, timeout=timeout, log=log)
+    print(p_out)
+    print(p_err)
+    if retval != 0:
+        raise failed(raxml_call_consensus, retval, p_err)
+    return retval
+
+
+@db_logger
+def run_raxml_bootstraps(program=None, pep_msa=None, model=None, bootstrap_seed=123,
+                         num_bootstraps=None, chunk=0, workdir=None, num_cpu=None,
+                         db=None, orthogroup=None, run_id=None, phase=None,
+                         cache=None, scratch=None, min_free_mb=0, timeout=None, log=None):
+    """one chunk of an orthogroup's bootstraps (helpers.bootstraps), without the consensus;
+    run_raxml_consensus merges the chunks"""
+    run_name = chunk_run_name(orthogroup, chunk)
+    remove_raxml_files(workdir, run_name)
+    outputs = {"bootstrap": chunk_file(workdir, orthogroup, chunk)}
+    if cache:  # same trees as a whole run_raxml with this seed and number of bootstraps
+        cache = ArtifactCache(cache)
+        key = cache.key(files=[pep_msa], args=[os.path.basename(program), model, num_bootstraps, bootstrap_seed])
+        if cache.fetch(key, outputs):
+            return CACHE_HIT
+    with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, inputs=[pep_msa], prefix="raxml_") as wd:
+        pep_msa_phy = phy_file(pep_msa, wd, workdir, suffix=".bs{}.phy".format(chunk))  # chunks run at once
+        mfa2phy(pep_msa, pep_msa_phy)
+        threads = raxml_thread_count(program, num_cpu)
+        threads = '-T {} '.format(threads) if threads else ''
+        raxml_call = '{} -m {} {}-n {} -s {} -b {} -N {} -w {}'.\
+            format(program, model, threads, run_name, pep_msa_phy,
+                   bootstrap_seed, num_bootstraps, wd)
+        print(raxml_call)
+        retval, p_out, p_err = run_command(raxml_call, timeout=timeout, log=log)
+        print(p_err)
+        print(p_out)
+        if retval != 0:
+            raise failed(raxml_call, retval, p_err)
+        publish_outputs(wd, outputs)
+    if cache:
+        cache.store(key, outputs)
+    return retval
+
+
+@db_logger
+def run_raxml_consensus(program=None, model=None, num_bootstraps=None, chunks=None,
+                        workdir=None, db=None, orthogroup=None, run_id=None,
+                        phase=None, scratch=None, min_free_mb=0, timeout=None, log=None):
+    """consensus of the run_raxml_bootstraps chunks, same tree files as run_raxml"""
+    remove_raxml_files(workdir, orthogroup)
+    remove_raxml_files(workdir, orthogroup + ".mrc")
+    outputs = {"bootstrap": os.path.join(workdir, "RAxML_bootstrap." + orthogroup),
+               "MajorityRuleConsensusTree": os.path.join(workdir, "RAxML_MajorityRuleConsensusTree." + orthogroup + ".mrc")}
+    with staging_dir(workdir, root=scratch, min_free_mb=min_free_mb, prefix="raxml_") as wd:
+        try:
+            bstree = merge_bootstraps(workdir, orthogroup, chunks, num_bootstraps, out_dir=wd)
+        except (IOError, ValueError) as e:
+            raise PipelineException("could not merge the bootstraps of {}: {}\n".format(orthogroup, e))
+        retval = raxml_consensus(program, model, bstree, orthogroup, wd, timeout=timeout, log=log)
+        publish_outputs(wd, outputs)
+    return retval
 
 @db_logger
 def run_ctl_maker(paml_file=None, tree_file=None,model="Ah0,Ah1", outfile=None,
@@ -179,7 +367,8 @@ def run_ctl_maker(paml_file=None, tree_file=None,model="Ah0,Ah1", outfile=None,
         make_ctl_tree(treefile=tree_file, paml_msa=paml_file, outfile=outfile, model=model, regex=regex, depth=depth)
     except Exception as e:
         print(e)
-        raise PipelineException
+        raise PipelineException("could not make the ctl files of {}: {}\n".format(orthogroup, e),
+                                kind=error_kind(e))
     return 0
     #todo unlabeled tree from tree_file
 #readtree
@@ -193,41 +382,47 @@ def run_ctl_maker(paml_file=None, tree_file=None,model="Ah0,Ah1", outfile=None,
 @db_logger
 def run_codeml(program=None, ctl_file=None, work_dir=None,
                db=None, orthogroup = None,
-               run_id=None, phase=None, semaphore=None):
-    codeml_call = '{} {}'.format(program, ctl_file)
-    orig_wd = os.getcwd()
-    os.chdir(os.path.abspath(work_dir))
-    p = subprocess.Popen(codeml_call,
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    p_out, p_err = p.communicate()
-    print(p_out)
-    print(p_err)
-    retval = p.wait()
-    os.chdir(orig_wd)
+               run_id=None, phase=None, semaphore=None, cache=None, scratch=None, min_free_mb=0,
+               timeout=None, log=None):
+    ctl = read_ctl(os.path.join(work_dir, ctl_file))
+    outfile = os.path.join(work_dir, ctl["outfile"])
+    if os.path.exists(outfile):  # may be a hardlink into the cache, never write through it
+        os.remove(outfile)
+    inputs = [os.path.join(work_dir, ctl_file),
+              os.path.join(work_dir, ctl["treefile"]),
+              os.path.join(work_dir, ctl["seqfile"])]
+    if cache:
+        cache = ArtifactCache(cache)
+        key = cache.key(files=inputs, args=[os.path.basename(program)])
+        if cache.fetch(key, {"out": outfile}):
+            return CACHE_HIT
+    codeml_call = '{} {}'.format(program, os.path.basename(ctl_file))
+    # codeml writes rst, rst1, rub, lnf, 2NG.* to its cwd, give every run its own
+    # (below the scratch root if there is one with room), only the outfile is kept
+    with scratch_dir(work_dir, inputs=inputs, prefix=".codeml_", root=scratch, min_free_mb=min_free_mb) as wd:
+        retval, p_out, p_err = run_command(codeml_call, cwd=wd, timeout=timeout, log=log)
+        print(p_out)
+        print(p_err)
+        if retval == 0:
+            publish(os.path.join(wd, os.path.basename(ctl["outfile"])), outfile)
     if retval != 0:
-        raise PipelineException
+        raise failed(codeml_call, retval, p_err)
     else:
-        #rename
+        if cache:
+            cache.store(key, {"out": outfile})
         return retval
 
 
 @db_logger
 def run_pysickle(program=None, dir=None, suffix=".msa",outdir=None,
                db=None, orthogroup=None,
-               run_id=None, phase=None, semaphore=None):
+               run_id=None, phase=None, semaphore=None, timeout=None, log=None):
     pysickle_call = 'pysickle.py -F {} -s {}'.format(dir, suffix)
-    p = subprocess.Popen(pysickle_call,
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    p_out, p_err = p.communicate()
+    retval, p_out, p_err = run_command(pysickle_call, timeout=timeout, log=log)
     #print(p_out)
     #print(p_err)
-    retval = p.wait()
     if retval != 0:
-        raise PipelineException
+        raise failed(pysickle_call, retval, p_err)
     else:
         return retval
 
@@ -236,8 +431,8 @@ def run_pysickle(program=None, dir=None, suffix=".msa",outdir=None,
 def run_codeml_summary(h0=None, h1=None, db=None, outfile_prefix=None, orthogroup=None,
                run_id=None, phase=None):
     try:
-        pval = calculatePvalue(h0, h1)
-        pval = str(pval["tablerow"])
+        res = calculatePvalue(h0, h1)
+        pval = str(res["tablerow"])
         cp = CODEMLParser()
         sitesNEB = cp.getPositiveSitesNEB(h1)
         sitesBEB = cp.getPositiveSitesBEB(h1)
@@ -249,10 +444,20 @@ def run_codeml_summary(h0=None, h1=None, db=None, outfile_prefix=None, orthogrou
             out.write("{}\n{}".format(str(sitesNEB["table"]), str(sitesNEB["significant"])))
         with open(outfile_prefix+orthogroup+".beb", 'a') as out:
             out.write("{}\n{}".format(str(sitesBEB["table"]), str(sitesBEB["significant"])))
+        # ORTHOGROUP.mrc.NODE.MODEL, node is the foreground branch
+        node, h0_model = os.path.basename(h0).split(".")[-2:]
+        h1_model = os.path.basename(h1).split(".")[-1]
+        results = {}
+        for model, outfile in [(h0_model, h0), (h1_model, h1)]:
+            results[model] = codemlResults(outfile)
+            results[model]["outfile"] = outfile
+        lrt = dict(h0=h0_model, h1=h1_model, ts=res["ts"], df=res["df"], pval=res["pval"], sig=res["sig"])
+        db_store_codeml(db, run_id, orthogroup, node, results, lrt)
 
     except Exception as e:
         print(e)
-        raise PipelineException
+        raise PipelineException("could not summarize the codeml runs of {}: {}\n".format(orthogroup, e),
+                                kind=IO if isinstance(e, sqlite3.Error) else error_kind(e))
     return 0
 
 
@@ -260,9 +465,9 @@ def run_codeml_summary(h0=None, h1=None, db=None, outfile_prefix=None, orthogrou
 def run_map_back(gapped_alignment_file, list_of_positions, db=None, orthogroup=None, run_id=None, phase=None):
     try:
         retval = map_back(gappedAlignmentFile=gapped_alignment_file, listOfPositions=list_of_positions)
-    except Exception:
-        raise PipelineException
+    except Exception as e:
+        raise PipelineException("map back of {} failed: {}\n".format(orthogroup, e))
     if retval != 0:
-        raise PipelineException
+        raise PipelineException("map back of {} returned {}\n".format(orthogroup, retval))
     else:
         return retval
\ No newline at end of file
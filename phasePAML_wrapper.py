@@ -12,8 +12,20 @@ import ConfigParser
 from helpers.fastahelper import FastaParser
 from helpers.dbhelper import db_check_run
 from helpers.dbhelper import db_get_run_id
+from helpers.dbhelper import db_get_orthogroup_sizes, db_store_estimates, db_get_cost_vs_duration
+from helpers.dbhelper import migrate_db, db_get_cost_vs_cpu, db_compact
+from helpers import dbwriter
 from helpers.wrappers import run_prank, run_pal2nal, run_raxml, run_ctl_maker, run_codeml, run_pysickle
-from helpers.wrappers import run_codeml_summary
+from helpers.wrappers import run_codeml_summary, run_backtranslate, run_raxml_bootstraps, run_raxml_consensus
+from helpers import backtranslate
+from helpers.scheduler import Scheduler
+from helpers.jobarray import ArrayScheduler, BACKENDS
+from helpers.pipeline import Task, Pipeline
+from helpers.resume import RunState, msa_pairs
+from helpers.costmodel import CostModel, read_paml_header, count_patterns, ThreadAllocator, codeml_model
+from helpers.costmodel import raxml_thread_count
+from helpers.planner import Plan
+from helpers.bootstraps import bootstrap_chunks, chunk_file
 
 class DirectoryExistsException(Exception):
     pass
@@ -43,6 +55,11 @@ CONF['RAxML'] = {}
 CONF['RAxML']['num_bootstraps'] = 100
 CONF['RAxML']['model'] = 'PROTGAMMAJTT'
 CONF['RAxML']['num_cpu'] = '8'
+CONF['RAxML']['patterns_per_thread'] = '200'
+CONF['RAxML']['bootstrap_chunks'] = '1'
+CONF['RAxML']['chunk_min_patterns'] = '0'
+CONF['Pal2nal'] = {}
+CONF['Pal2nal']['engine'] = 'native'
 CONF['Labels'] = {}
 CONF['Labels']['regex'] = None
 CONF['Labels']['level'] = '4'
@@ -54,6 +71,25 @@ CONF['Paths']['raxml'] = 'raxmlHPC'
 CONF['Paths']['pal2nal'] = 'pal2nal'
 CONF['Paths']['codeml'] = 'codeml'
 CONF['Paths']['pysickle'] = 'pysickle'
+CONF['Paths']['python3'] = 'python3'
+CONF['Scheduler'] = {}
+CONF['Scheduler']['jobs'] = '1'
+CONF['Scheduler']['cores'] = None
+CONF['Scheduler']['mode'] = 'phases'
+CONF['Scheduler']['backend'] = 'local'
+CONF['Scheduler']['limits'] = ''
+CONF['Cache'] = {}
+CONF['Cache']['dir'] = None
+CONF['Database'] = {}
+CONF['Database']['journal_mode'] = 'wal'
+CONF['Timeouts'] = {}
+CONF['Scratch'] = {}
+CONF['Scratch']['root'] = None
+CONF['Scratch']['min_free_mb'] = '1024'
+CONF['Retry'] = {}
+CONF['Retry']['attempts'] = '3'
+CONF['Retry']['backoff'] = '60'
+CONF['Retry']['timeout_factor'] = '2'
 ####################################################
 
 
@@ -103,7 +139,29 @@ def usage():
                                     models: [Ah0,Ah1,M0,M1a,M2a,M7,M8,M8a,BM]
 
     -p, --phase=INT                 start/resume from phase INT
-    -N, --num_cores=INT [1]         number of cpus to use for raxml
+    -R, --resume                    skip work that already succeeded in an earlier attempt
+                                    of this run (phase table and output files), implies --phase=1
+    -N, --num_cores=INT|auto [1]    number of cpus to use for raxml, auto: choose per job from
+                                    the number of alignment patterns (see patterns_per_thread)
+    -j, --jobs=INT [1]              number of jobs (prank, raxml, codeml, ...) to run at once,
+                                    raxml jobs count with their num_cores
+    -C, --cache_dir=DIR             share prank, raxml and codeml results between runs,
+                                    identical inputs are linked from DIR instead of recomputed
+    -B, --backend=BACKEND [local]   local: process pool on this machine
+                                    slurm, sge: submit the jobs of a phase as a job array
+                                    fake: run the job array scripts with local subprocesses
+                                    asyncio: supervise all tools of a phase from one python3
+                                    event loop, see limits in the [Scheduler] config section
+    -d, --dag                       run each orthogroup through all phases on its own
+                                    instead of finishing a phase for all orthogroups first
+    -P, --plan                      validate the input like phase 0 and print the jobs and
+                                    CPU-hours per phase for the regex/level/models, runs no tool
+    --compact                       move the phase history of the finished run NAME in the db
+                                    (output_dir/db_name) to an archive db, keep one summary row
+                                    and the latest status per orthogroup and phase, runs no tool
+    --archive=FILE [*.archive.db]   archive db for --compact, next to the db by default
+    --force                         --compact a run with jobs still marked running, they
+                                    died with their run (killed, node lost)
 
     -h, --help                      prints this
     -H, --HELP                      more help
@@ -138,6 +196,7 @@ def show_phase_help():
     # 1             MSA              prank
     # 2             nucMSA           pal2nal
     # 3             tree             RAxML
+    # 31            tree, chunks     RAxML bootstraps, [RAxML] bootstrap_chunks > 1
     # 4             tree labeling    ete2
     # 5             select.analysis  codeml (PAML)
     # 6             summarize        result from phase 4 for all files
@@ -185,7 +244,9 @@ def fix_fasta(fasta=None, backupdir=None, faulty_headers=None):
         fa_out.write(new_content)
 
 
-def check_fasta(dir, fix=False, path_dct=None):
+def check_fasta(dir, fix=False, path_dct=None, sequences=None):
+    """{orthogroup: [headers]} of the nuc and pep FASTA files in dir, (orthogroup, header,
+    nuc length, pep length) of every sequence is appended to the list sequences"""
     expected = [os.path.join(dir, "nuc"), os.path.join(dir, "pep")]
     d = os.path.join(dir)
     dirlist = [os.path.join(d, o) for o in os.listdir(d) if os.path.isdir(os.path.join(d, o))]
@@ -226,6 +287,8 @@ def check_fasta(dir, fix=False, path_dct=None):
             len_nuc = len(i[1])
             len_pep = len(j[1])
             print(len_nuc, len_nuc / 3, len_pep)
+            if sequences is not None:
+                sequences.append((os.path.basename(n).split(".")[0], i[0], len_nuc, len_pep))
             if not len_pep == len_nuc / 3 \
                     and not (len_pep - 1 == len_nuc / 3 and j[1][-1] == "*") \
                     and not (len_pep + 1 == len_nuc / 3 and j[1][-1] != "*"):
@@ -262,10 +325,11 @@ def set_path_dct(output_dir, name):
     phase_5 = os.path.join(base_path, "codeml")
     phase_6 = os.path.join(base_path, "results")
     pysickle = os.path.join(base_path, "pysickle")
+    logs = os.path.join(base_path, "logs")
     for i in [phase_0faulty_nuc, phase_0faulty_pep,
               phase_0nuc, phase_0pep, phase_1,
               phase_2, phase_3, phase_5,
-              phase_6,pysickle]:
+              phase_6,pysickle, logs]:
         path_dct[os.path.basename(i)] = i
     return path_dct
 
@@ -282,20 +346,22 @@ def make_folder_skeleton(output_dir, name):
     phase_5 = os.path.join(base_path, "codeml")
     phase_6 = os.path.join(base_path, "results")
     pysickle = os.path.join(base_path, "pysickle")
+    logs = os.path.join(base_path, "logs")
     if not os.path.exists(base_path):
         os.makedirs(base_path)
-        for i in [phase_0faulty_nuc, phase_0faulty_pep, phase_0nuc, phase_0pep, phase_1, phase_2, phase_3, phase_5, phase_6, pysickle]:
+        for i in [phase_0faulty_nuc, phase_0faulty_pep, phase_0nuc, phase_0pep, phase_1, phase_2, phase_3, phase_5, phase_6, pysickle, logs]:
             os.makedirs(i)
     else:
         raise DirectoryExistsException("{} already exists.".format(base_path))
 
 
+KNOWN_SUFFIXES = ["Ah0", "Ah1", "BM", "M0", "M1", "M1a", "M2",
+                  "M2a", "M7", "M8", "M8a"]
+
+
 def is_min_length_paml_msa(paml_msa=None, min_length=None):
-    with open(paml_msa, 'r') as paml:
-        line = paml.readline().strip().split(" ")
-        line = [l for l in line if l.strip() != ""]
-        alignment_length = int(line[1])
-        print("ALIGNMENT LENGTH is {}, min length".format(alignment_length, min_length))
+    alignment_length = read_paml_header(paml_msa)[1]
+    print("ALIGNMENT LENGTH is {}, min length".format(alignment_length, min_length))
     if alignment_length >= min_length:
         print("true")
         return True
@@ -304,6 +370,291 @@ def is_min_length_paml_msa(paml_msa=None, min_length=None):
         return False
 
 
+def timeout_for(tool, *names):
+    """wall-clock limit in seconds from [Timeouts], the first of tool.NAME for names
+    (eg. the orthogroup or the codeml model) that is set, else tool; None for no limit"""
+    for key in ["{}.{}".format(tool, n) for n in names if n] + [tool]:
+        limit = CONF['Timeouts'].get(key.lower())  # ConfigParser lower-cases the options
+        if limit not in (None, ''):
+            return float(limit)
+    return None
+
+
+def raxml_tree_file(orthogroup, path_dct):
+    if int(CONF['RAxML']['num_bootstraps']) == 0:  # non bootstrap tree
+        return os.path.join(path_dct["tree"], "RAxML_result." + orthogroup)
+    return os.path.join(path_dct["tree"], "RAxML_MajorityRuleConsensusTree." + orthogroup + ".mrc")
+
+
+def copy_tree_to_codeml(orthogroup, path_dct):
+    shutil.copy(raxml_tree_file(orthogroup, path_dct), os.path.join(path_dct["codeml"], orthogroup + ".mrc"))
+
+
+def summarize_orthogroup(orthogroup=None, path_dct=None, db=None, run_id=None, done=()):
+    """phase 6 for a single orthogroup, without the Ah0 outputs in done (summarized before)"""
+    prefix = orthogroup + ".mrc."
+    for codeml_file in os.listdir(path_dct['codeml']):
+        if codeml_file.startswith(prefix) and codeml_file.split(".")[-1] in KNOWN_SUFFIXES:
+            shutil.copy(os.path.join(path_dct['codeml'], codeml_file), path_dct['results'])
+    status = "s"
+    for codeml_file in os.listdir(path_dct['results']):
+        if codeml_file.startswith(prefix) and codeml_file.endswith("Ah0") and codeml_file not in done:
+            h0 = os.path.join(path_dct['results'], codeml_file)
+            h1 = os.path.join(path_dct['results'], codeml_file.split(".Ah0")[0] + ".Ah1")
+            if run_codeml_summary(h0=h0, h1=h1, db=db, outfile_prefix=os.path.join(path_dct['results'], "result_"),
+                                  orthogroup=orthogroup, run_id=run_id, phase=7) in ("f", "t"):
+                status = "f"
+    return status
+
+
+def dag_orthogroup(orthogroup, pep_fa, nuc_fa, path_dct, db, run_id, start_phase=1, state=None, costs=None,
+                   prank_phase=1, pal2nal_phase=2, pysickle=True):
+    """tasks taking one orthogroup through prank -> pal2nal -> (pysickle) -> raxml -> ctl -> codeml -> summary"""
+    msa = os.path.join(path_dct["MSA_pep"], orthogroup + ".msa")
+    nuc_msa = os.path.join(path_dct["MSA_nuc"], orthogroup)
+    paml = os.path.join(path_dct["codeml"], orthogroup + ".paml")
+    treefile = os.path.join(path_dct["codeml"], orthogroup + ".mrc")
+    name = lambda step: "{}:{}".format(orthogroup, step)
+    state = state or RunState()
+    costs = costs or CostModel()
+
+    def after_pal2nal():
+        shutil.copy(nuc_msa + ".paml", paml)
+        if pysickle and not is_min_length_paml_msa(nuc_msa + ".paml", min_length=int(CONF['Pysickle']['threshold'])):
+            return dag_pysickle(orthogroup, msa, nuc_fa, path_dct, db, run_id, start_phase=start_phase,
+                                state=state, costs=costs)
+
+    def before_raxml(task):
+        task.cores = task.kwargs["num_cpu"] = raxml_threads(msa)
+
+    def after_prank():
+        return raxml_tasks(orthogroup, msa, pep_fa, path_dct, db, run_id, name, before_raxml, after_raxml,
+                           skip=start_phase > 3 or state.done(orthogroup, 3, [raxml_tree_file(orthogroup, path_dct)]),
+                           state=state, costs=costs)
+
+    def after_raxml():
+        copy_tree_to_codeml(orthogroup, path_dct)
+
+    def after_ctl():
+        ctls = sorted(c for c in os.listdir(path_dct["codeml"])
+                      if c.startswith(orthogroup + ".mrc.") and c.endswith(".ctl"))
+        tasks = [Task(name("codeml:" + ctl), run_codeml,
+                      kwargs=dict(program=CONF['Paths']['codeml'], ctl_file=ctl, work_dir=path_dct["codeml"],
+                                  cache=CONF['Cache']['dir'], db=db, orthogroup=orthogroup, run_id=run_id, phase=5,
+                                  log_dir=path_dct["logs"],
+                                  timeout=timeout_for("codeml", orthogroup, codeml_model(ctl)), retry=retry_policy(), **scratch_kwargs()),
+                      priority=(4, costs.codeml(orthogroup, ctl, paml)),
+                      skip=start_phase > 5 or state.codeml_done(ctl, path_dct["codeml"]))
+                 for ctl in ctls]
+        h0s = [c[:-len(".ctl")] for c in ctls if c.endswith(".Ah0.ctl")]
+        done = [h0 for h0 in h0s if state.summary_done(h0, h0[:-len("Ah0")] + "Ah1")]
+        tasks.append(Task(name("summary"), summarize_orthogroup,
+                          kwargs=dict(orthogroup=orthogroup, path_dct=path_dct, db=db, run_id=run_id, done=done),
+                          deps=[t.name for t in tasks], priority=(5, 0),
+                          skip=start_phase > 6 or len(done) == len(h0s)))
+        return tasks
+
+    return [
+        Task(name("prank"), run_prank,
+             kwargs=dict(program=CONF['Paths']['prank'], infile=pep_fa, outfile=msa, cache=CONF['Cache']['dir'],
+                         db=db, orthogroup=orthogroup, run_id=run_id, phase=prank_phase,
+                         log_dir=path_dct["logs"], timeout=timeout_for("prank", orthogroup), retry=retry_policy()),
+             priority=(0, costs.prank(orthogroup, pep_fa, phase=prank_phase)), then=after_prank,
+             skip=start_phase > 1 or state.done(orthogroup, prank_phase, [msa])),
+        Task(name("pal2nal"), pal2nal_runner(),
+             kwargs=dict(program=CONF['Paths']['pal2nal'], pep_msa=msa, nuc_fa=nuc_fa, outfile=nuc_msa,
+                         cpu=1, db=db, orthogroup=orthogroup, run_id=run_id, phase=pal2nal_phase,
+                         log_dir=path_dct["logs"], timeout=timeout_for("pal2nal", orthogroup), retry=retry_policy()),
+             deps=[name("prank")], priority=(1, 0), then=after_pal2nal,
+             skip=start_phase > 2 or state.done(orthogroup, pal2nal_phase, [nuc_msa + ".paml"])),
+        Task(name("ctl"), run_ctl_maker,
+             kwargs=dict(paml_file=paml, tree_file=treefile, model=CONF['Codeml']['models'],
+                         outfile=treefile, regex=CONF['Labels']['regex'], depth=int(CONF['Labels']['level']),
+                         db=db, orthogroup=orthogroup, run_id=run_id, phase=4),
+             deps=[name("pal2nal"), name("raxml")], priority=(3, 0), then=after_ctl,
+             skip=start_phase > 4 or state.done(orthogroup, 4)),
+    ]
+
+
+def raxml_tasks(orthogroup, msa, pep_fa, path_dct, db, run_id, name, prepare, then, skip=False,
+                state=None, costs=None):
+    """the raxml task name("raxml") of an orthogroup, once its alignment exists; with
+    bootstrap chunks it is the consensus of one task per chunk name("raxml:bsK")"""
+    chunks = [] if skip else raxml_chunks(msa)
+    if not chunks:
+        return [Task(name("raxml"), run_raxml,
+                     kwargs=dict(program=CONF['Paths']['raxml'], pep_msa=msa, outdir=path_dct['tree'],
+                                 num_bootstraps=int(CONF['RAxML']['num_bootstraps']), model=CONF['RAxML']['model'],
+                                 workdir=os.path.abspath(path_dct["tree"]),
+                                 cache=CONF['Cache']['dir'], db=db, orthogroup=orthogroup, run_id=run_id, phase=3,
+                                 log_dir=path_dct["logs"], timeout=timeout_for("raxml", orthogroup), retry=retry_policy(),
+                                 **scratch_kwargs()),
+                     prepare=prepare, then=then, skip=skip,
+                     priority=(2, costs.raxml(orthogroup, CONF['RAxML']['num_bootstraps'], pep_fa=pep_fa)))]
+    tasks = [Task(name("raxml:bs{}".format(k)), run_raxml_bootstraps, prepare=prepare,
+                  kwargs=raxml_chunk_kwargs(orthogroup, msa, k, num_bootstraps, seed, path_dct, db, run_id),
+                  priority=(2, costs.raxml(orthogroup, num_bootstraps, pep_fa=pep_fa, phase=31)),
+                  skip=state.chunk_done(chunk_file(os.path.abspath(path_dct["tree"]), orthogroup, k), num_bootstraps))
+             for k, num_bootstraps, seed in chunks]
+    tasks.append(Task(name("raxml"), run_raxml_consensus,
+                      kwargs=raxml_consensus_kwargs(orthogroup, len(chunks), path_dct, db, run_id),
+                      deps=[t.name for t in tasks], priority=(2, 0), then=then))
+    return tasks
+
+
+def raxml_chunk_kwargs(orthogroup, msa, chunk, num_bootstraps, seed, path_dct, db, run_id):
+    return dict(program=CONF['Paths']['raxml'], pep_msa=msa, model=CONF['RAxML']['model'],
+                bootstrap_seed=seed, num_bootstraps=num_bootstraps, chunk=chunk,
+                workdir=os.path.abspath(path_dct["tree"]), cache=CONF['Cache']['dir'],
+                db=db, orthogroup=orthogroup, run_id=run_id, phase=31,
+                log_dir=path_dct["logs"], timeout=timeout_for("raxml", orthogroup),
+                retry=retry_policy(), **scratch_kwargs())
+
+
+def raxml_consensus_kwargs(orthogroup, chunks, path_dct, db, run_id):
+    return dict(program=CONF['Paths']['raxml'], model=CONF['RAxML']['model'],
+                num_bootstraps=int(CONF['RAxML']['num_bootstraps']), chunks=chunks,
+                workdir=os.path.abspath(path_dct["tree"]), db=db, orthogroup=orthogroup, run_id=run_id,
+                phase=3, log_dir=path_dct["logs"], timeout=timeout_for("raxml", orthogroup),
+                retry=retry_policy(), **scratch_kwargs())
+
+
+def dag_pysickle(orthogroup, msa, nuc_fa, path_dct, db, run_id, start_phase=1, state=None, costs=None):
+    """pysickle a too short alignment, every pysickled file becomes an orthogroup of its own"""
+    workdir = os.path.join(path_dct["pysickle"], orthogroup)
+    outdir = os.path.join(workdir, "ps_out_si")
+    state = state or RunState()
+    skip = start_phase > 2 or state.done(orthogroup, 999)
+    if not skip:
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        shutil.copy(msa, workdir)
+        shutil.copy(nuc_fa, workdir)
+
+    def after_pysickle():
+        if not os.path.isdir(outdir):
+            return []
+        tasks = []
+        for pysickled in os.listdir(outdir):
+            if pysickled.endswith(".tmp"):  # marks new pep.fa
+                new_orthogroup = pysickled.replace(".", "_").replace("_tmp", ".fa").split(".")[0]
+                tasks.extend(dag_orthogroup(new_orthogroup, os.path.join(outdir, pysickled), nuc_fa,
+                                            path_dct, db, run_id, start_phase=start_phase, state=state,
+                                            costs=costs, prank_phase=99, pal2nal_phase=10, pysickle=False))
+        return tasks
+
+    return [Task("{}:pysickle".format(orthogroup), run_pysickle,
+                 kwargs=dict(program=CONF['Paths']['pysickle'], dir=workdir, log_dir=path_dct["logs"],
+                             timeout=timeout_for("pysickle", orthogroup), retry=retry_policy(),
+                             db=db, orthogroup=orthogroup, run_id=run_id, phase=999),
+                 priority=(2, 0), then=after_pysickle, skip=skip)]
+
+
+def run_dag(path_dct, db, run_id, scheduler, start_phase=1, state=None, costs=None):
+    """run every orthogroup through the phases on its own, downstream tasks
+    start as soon as their inputs exist, the most expensive ready ones first"""
+    pipeline = Pipeline(scheduler)
+    costs = costs or CostModel()
+    nucfiles = dict((n.split(".")[0], os.path.join(path_dct["nuc"], n)) for n in os.listdir(path_dct["nuc"]))
+    for f in sorted(os.listdir(path_dct["pep"])):
+        orthogroup = f.split(".")[0]
+        if orthogroup not in nucfiles:
+            sys.stderr.write("No nuc file for {}, skipping.\n".format(orthogroup))
+            continue
+        for task in dag_orthogroup(orthogroup, os.path.join(path_dct["pep"], f), nucfiles[orthogroup],
+                                   path_dct, db, run_id, start_phase=start_phase, state=state,
+                                   costs=costs):
+            pipeline.add(task)
+    db_store_estimates(db, run_id, costs.pop_estimates())
+    failed = pipeline.run()
+    db_store_estimates(db, run_id, costs.pop_estimates())
+    print("dag done, {} failed tasks.".format(len(failed)))
+    for name in failed:
+        print(name)
+
+
+def pal2nal_runner():
+    """phase 2 runner, the NumPy back translation unless [Pal2nal] engine = external"""
+    if CONF['Pal2nal']['engine'] == 'native':
+        return run_backtranslate
+    return run_pal2nal
+
+
+def make_scheduler(base_path):
+    backend = CONF['Scheduler']['backend']
+    if backend in BACKENDS:
+        return ArrayScheduler(backend, workdir=os.path.join(base_path, "jobarray"),
+                              jobs=CONF['Scheduler']['jobs'], cores=CONF['Scheduler']['cores'],
+                              name="phasePAML_" + os.path.basename(base_path),
+                              limits=CONF['Scheduler']['limits'], python3=CONF['Paths']['python3'])
+    elif backend != 'local':
+        sys.stderr.write("Unknown backend {}, use local, {}.\n".format(backend, ", ".join(BACKENDS)))
+        sys.exit(2)
+    return Scheduler(jobs=CONF['Scheduler']['jobs'], cores=CONF['Scheduler']['cores'])
+
+
+def raxml_threads(pep_msa, concurrent=None):
+    """raxml threads for pep_msa, also the cores the job takes from the scheduler's budget:
+    no more than the budget (the scheduler would claim no more), at least 2 for a Pthreads build"""
+    cores = int(CONF['Scheduler']['cores'] or CONF['Scheduler']['jobs'])
+    if str(CONF['RAxML']['num_cpu']).lower() != 'auto':
+        threads = int(CONF['RAxML']['num_cpu'])
+    else:
+        allocator = ThreadAllocator(cores=cores,
+                                    jobs=CONF['Scheduler']['jobs'],
+                                    patterns_per_thread=CONF['RAxML']['patterns_per_thread'])
+        threads = allocator.threads(count_patterns(pep_msa), concurrent=concurrent or CONF['Scheduler']['jobs'])
+    return raxml_thread_count(CONF['Paths']['raxml'], min(threads, cores)) or 1
+
+
+def retry_policy():
+    """[Retry] policy of the tool jobs, see helpers.failures"""
+    return dict(attempts=int(CONF['Retry']['attempts'] or 1), backoff=float(CONF['Retry']['backoff'] or 0),
+                timeout_factor=float(CONF['Retry']['timeout_factor'] or 1))
+
+
+def scratch_kwargs():
+    """staging of the raxml and codeml runs, [Scratch] root and min_free_mb"""
+    return dict(scratch=CONF['Scratch']['root'] or None, min_free_mb=int(CONF['Scratch']['min_free_mb'] or 0))
+
+
+def raxml_chunks(pep_msa):
+    """[(chunk, bootstraps, seed)] if the bootstraps of pep_msa run as [RAxML] bootstrap_chunks
+    jobs of their own, [] for a single raxml run"""
+    num_bootstraps = int(CONF['RAxML']['num_bootstraps'])
+    chunks = int(CONF['RAxML']['bootstrap_chunks'])
+    if num_bootstraps < 2 or chunks < 2:
+        return []
+    min_patterns = int(CONF['RAxML']['chunk_min_patterns'])
+    if min_patterns and count_patterns(pep_msa) < min_patterns:  # small families are done quickly anyway
+        return []
+    return bootstrap_chunks(num_bootstraps, chunks)
+
+
+def plan_run(input_dir, db=None):
+    """--plan: predict the work of a run from the input files, nothing is written"""
+    try:
+        orthogroup_dct = check_fasta(dir=input_dir)
+    except (FastaFilesDoNotMatchException, HeadersDoNotMatchException) as e:
+        sys.stderr.write(repr(e) + '\n')
+        sys.exit(1)
+    cost_vs_duration, cost_vs_cpu = [], []
+    if db and os.path.isfile(db):
+        cost_vs_duration = db_get_cost_vs_duration(db)
+        cost_vs_cpu = db_get_cost_vs_cpu(db)
+    num_cpu = CONF['RAxML']['num_cpu']
+    plan = Plan(CostModel(sizes=dict((o, len(h)) for o, h in orthogroup_dct.items())),
+                regex=CONF['Labels']['regex'], depth=CONF['Labels']['level'], models=CONF['Codeml']['models'],
+                num_bootstraps=CONF['RAxML']['num_bootstraps'],
+                raxml_threads=1 if str(num_cpu).lower() == 'auto' else int(num_cpu),
+                cost_vs_duration=cost_vs_duration, cost_vs_cpu=cost_vs_cpu)
+    pep_dir = os.path.join(input_dir, "pep")
+    pep_files = dict((p.split(".")[0], os.path.join(pep_dir, p)) for p in os.listdir(pep_dir))
+    for orthogroup, headers in sorted(orthogroup_dct.items()):
+        plan.add(orthogroup, headers, pep_files.get(orthogroup))
+    print(plan.report(cores=int(CONF['Scheduler']['cores'] or CONF['Scheduler']['jobs'])))
+
+
 def main():
     global CONF
     configfile = None
@@ -312,10 +663,16 @@ def main():
     models = None
     phase = None
     num_cores = None
+    resume = False
+    plan = False
+    compact = False
+    archive = None
+    force = False
+    default_name = CONF['Directories']['name']
     try:
         opts, args = getopt.gnu_getopt(
             sys.argv[1:],
-            'c:i:o:n:b:t:x:r:l:m:p:N:hHM',
+            'c:i:o:n:b:t:x:r:l:m:p:N:j:C:B:dRPhHM',
             [
                 'config=',
                 'input_dir=',
@@ -329,6 +686,15 @@ def main():
                 'models=',
                 'phase=',
                 'num_cores=',
+                'jobs=',
+                'cache_dir=',
+                'backend=',
+                'dag',
+                'resume',
+                'plan',
+                'compact',
+                'archive=',
+                'force',
                 'help',
                 'HELP',
                 'model_help'
@@ -368,6 +734,24 @@ def main():
             phase = int(a)
         elif o in ("-N", "--num_cores"):
             CONF['RAxML']['num_cpu'] = a
+        elif o in ("-j", "--jobs"):
+            CONF['Scheduler']['jobs'] = a
+        elif o in ("-C", "--cache_dir"):
+            CONF['Cache']['dir'] = a
+        elif o in ("-B", "--backend"):
+            CONF['Scheduler']['backend'] = a
+        elif o in ("-d", "--dag"):
+            CONF['Scheduler']['mode'] = 'dag'
+        elif o in ("-R", "--resume"):
+            resume = True
+        elif o in ("-P", "--plan"):
+            plan = True
+        elif o == "--compact":
+            compact = True
+        elif o == "--archive":
+            archive = a
+        elif o == "--force":
+            force = True
         elif o in ("-h", "--help"):
             usage()
         elif o in ("-H", "--HELP"):
@@ -377,6 +761,26 @@ def main():
         else:
             assert False, "unhandled option"
 
+    if compact:
+        db = os.path.join(CONF['Directories']['output_dir'] or ".", CONF["Directories"]["db_name"])
+        if not os.path.exists(db):
+            print("No database {}.\n".format(db))
+            usage()
+        if archive is None:
+            archive = "{}.archive{}".format(*os.path.splitext(db))
+        if CONF['Directories']['name'] == default_name:
+            print("No run name, --compact needs the name of a finished run.\n")
+            usage()
+        run_ids = [r[0] for r in db_get_run_id(db, CONF['Directories']['name'])]
+        if not run_ids:
+            print("No run {} in {}.\n".format(CONF['Directories']['name'], db))
+            usage()
+        removed = db_compact(db, archive, run_ids, journal_mode=CONF['Database']['journal_mode'] or 'wal',
+                             force=force)
+        print("{} phase rows of run {} archived in {}, the latest one per job is kept".format(
+            removed, CONF['Directories']['name'], archive))
+        return
+
     try:
         input_dir = CONF['Directories']['input_dir']
     except KeyError as e:
@@ -397,6 +801,16 @@ def main():
         print("No regex.\n")
         usage()
 
+    if CONF['Pal2nal']['engine'] == 'native' and backtranslate.np is None:
+        sys.stderr.write("NumPy not found, using the external pal2nal.\n")
+        CONF['Pal2nal']['engine'] = 'external'
+
+    if plan:
+        plan_run(input_dir, db=os.path.join(output_dir, CONF["Directories"]["db_name"]))
+        return
+
+    if phase is None and resume:
+        phase = 1
     if phase is None:
         print("No phase.\n")
         usage()
@@ -424,11 +838,13 @@ def main():
 
         copy_files_to_workdir(input_dir=os.path.join(input_dir, "nuc"), output_dir=path_dct["nuc"])
         copy_files_to_workdir(input_dir=os.path.join(input_dir, "pep"), output_dir=path_dct["pep"])
+        sequences = []
         try:
-            orthogroup_dct = check_fasta(dir=os.path.join(output_dir, name), fix=True, path_dct=path_dct)
+            orthogroup_dct = check_fasta(dir=os.path.join(output_dir, name), fix=True, path_dct=path_dct,
+                                         sequences=sequences)
         except DifferentSequenceLengthsException as e:
             print(e)
-        print(db_check_run(db, run_name=name, orthogroup_dct=orthogroup_dct))
+        print(db_check_run(db, run_name=name, orthogroup_dct=orthogroup_dct, sequences=sequences))
         phase = 1
     run_id = db_get_run_id(db, run_name=name)
     if not run_id:
@@ -440,6 +856,22 @@ def main():
     else:
         run_id = run_id[0][0]
     print("Info: run_id is {}".format(run_id))
+    migrate_db(db, journal_mode=CONF['Database']['journal_mode'] or 'wal')
+    state = RunState()
+    if resume:
+        state = RunState(db, run_id)
+        print("Info: resuming, {} steps finished before.".format(
+            len([st for st in state.status.values() if st in ("s", "c")])))
+    # the jobs' phase rows are committed in batches by one writer, its queue is
+    # inherited by the pool workers; the rows still queued are written at exit
+    dbwriter.start(db)
+    scheduler = make_scheduler(os.path.join(output_dir, name))
+    costs = CostModel(sizes=db_get_orthogroup_sizes(db, run_id))
+    if CONF['Scheduler']['mode'] == 'dag':
+        run_dag(path_dct=path_dct, db=db, run_id=run_id, scheduler=scheduler, start_phase=phase,
+                state=state, costs=costs)
+        scheduler.close()
+        return
 
     if phase == 1:
         if not os.path.exists(path_dct["pep"]):
@@ -450,42 +882,44 @@ def main():
                 infile = os.path.join(path_dct["pep"], f)
                 outfile = os.path.join(path_dct["MSA_pep"], f.split(".")[0]+".msa")
                 orthogroup = os.path.basename(infile).split(".")[0]
-                run_prank(program=CONF['Paths']['prank'], infile=infile,
-                          outfile=outfile,
-                          db=db,
-                          run_id=run_id,
-                          orthogroup=orthogroup,
-                          phase=1)
+                if state.done(orthogroup, 1, [outfile]):
+                    continue
+                scheduler.submit(run_prank, priority=costs.prank(orthogroup, infile),
+                                 program=CONF['Paths']['prank'], infile=infile,
+                                 outfile=outfile, cache=CONF['Cache']['dir'],
+                                 log_dir=path_dct["logs"], timeout=timeout_for("prank", orthogroup), retry=retry_policy(),
+                                 db=db,
+                                 run_id=run_id,
+                                 orthogroup=orthogroup,
+                                 phase=1)
+            db_store_estimates(db, run_id, costs.pop_estimates())
+            scheduler.join()
         phase = 2
     if phase == 2:
         ###phase 2:
-        nucfiles = os.listdir(path_dct["nuc"])
         nuc_msa_dct = {}
-        for f in os.listdir(path_dct["MSA_pep"]):
-            if f.endswith(".msa"): #ignore .reduced
-                msa_file = os.path.join(path_dct["MSA_pep"], f)
-            nucfile = [os.path.join(path_dct["nuc"], n) for n in nucfiles if n.split(".")[0] == f.split(".")[0]]
-            if len(nucfile) > 1:
+        for nucfile, msa_file in msa_pairs(path_dct["MSA_pep"], path_dct["nuc"]):
+            if len(nucfile) != 1:
                 sys.stderr.write("Sth wrong with your fasta files,"
-                                " got multiple matches for {}".format(f.split(".")[0]))
+                                " got {} matches for {}".format(len(nucfile), os.path.basename(msa_file)))
                 sys.exit(1)
-            else:
-                nucfile = nucfile[0]
-                nuc_msa_dct[nucfile] = msa_file
+            nuc_msa_dct[nucfile[0]] = msa_file
         #only pass if all files have a match
         for nuc_fa, pep_msa in nuc_msa_dct.items():
             orthogroup = os.path.basename(pep_msa).split(".")[0]
-            #if not pep_msa.endswith('.msa'):
-            #    continue
             #produces .pamlg, .paml
-            run_pal2nal(program=CONF['Paths']['pal2nal'], pep_msa=pep_msa, nuc_fa=nuc_fa,
-                        outfile=os.path.join(path_dct["MSA_nuc"],
-                                             orthogroup),
-                        cpu=1,
-                        db=db,
-                        orthogroup=orthogroup,
-                        run_id=run_id,
-                        phase=2)
+            nuc_msa = os.path.join(path_dct["MSA_nuc"], orthogroup)
+            if state.done(orthogroup, 2, [nuc_msa + ".paml", nuc_msa + ".pamlg"]):
+                continue
+            scheduler.submit(pal2nal_runner(), program=CONF['Paths']['pal2nal'], pep_msa=pep_msa, nuc_fa=nuc_fa,
+                             outfile=os.path.join(path_dct["MSA_nuc"],
+                                                  orthogroup),
+                             cpu=1, log_dir=path_dct["logs"], timeout=timeout_for("pal2nal", orthogroup), retry=retry_policy(),
+                             db=db,
+                             orthogroup=orthogroup,
+                             run_id=run_id,
+                             phase=2)
+        scheduler.join()
         # copy .paml files to codeml dir
         for pamlfile in os.listdir(path_dct["MSA_nuc"]):
             if pamlfile.endswith(".paml"):
@@ -499,37 +933,82 @@ def main():
                     shutil.copy(os.path.join(path_dct["nuc"], nuc), os.path.join(path_dct["pysickle"], nuc))
                     #todo if pysickle
         pysickle=True
-        if pysickle:
+        if pysickle and not state.done("__pysickle__", 999):
             print("running pysickle")
-            run_pysickle(program=CONF['Paths']['pysickle'], dir=path_dct["pysickle"], db=db,orthogroup="__pysickle__",run_id=run_id,phase=999)
-            for pysickled in os.listdir(os.path.join(path_dct["pysickle"], "ps_out_si")):
-                if pysickled.endswith(".tmp"):#marks new pep.fa
-                    print(pysickled)
-                    new_name = pysickled.replace(".", "_").replace("_tmp", ".fa")
-                    print(new_name, "new name", "infile:", os.path.join(path_dct["pysickle"],"ps_out_si", new_name))
-                    run_prank(program=CONF['Paths']['prank'],infile=os.path.join(path_dct["pysickle"],"ps_out_si", pysickled),
-                              outfile= os.path.join(path_dct["MSA_pep"], new_name.split(".")[0]+".msa"),
-                              cpu=1, db=db,
-                              orthogroup=new_name.split(".")[0], run_id=run_id,
-                              phase=99)
-                    #nwo we still need the new nuc
-                    nucfa = [n for n in os.listdir(path_dct["nuc"]) if n.split(".")[0] == pysickled.split(".")[0]][0]
-                    orthogroup=new_name.split(".")[0]
-                    outfile = os.path.join(path_dct["MSA_nuc"], orthogroup+".msa")
-                    run_pal2nal(program=CONF['Paths']['pal2nal'], pep_msa=os.path.join(path_dct["MSA_pep"], new_name.split(".")[0]+".msa"),
-                                outfile=outfile, nuc_fa=os.path.join(path_dct["MSA_nuc"],nucfa), db=db, phase=10,run_id=run_id, orthogroup=orthogroup)
-                    #merge back
-                    shutil.copy(outfile+".paml", os.path.join(path_dct["codeml"], orthogroup+".paml"))
+            run_pysickle(program=CONF['Paths']['pysickle'], dir=path_dct["pysickle"], log_dir=path_dct["logs"],
+                         timeout=timeout_for("pysickle"), retry=retry_policy(),
+                         db=db,orthogroup="__pysickle__",run_id=run_id,phase=999)
+            pysickled_files = [p for p in os.listdir(os.path.join(path_dct["pysickle"], "ps_out_si"))
+                               if p.endswith(".tmp")]  # marks new pep.fa
+            for pysickled in pysickled_files:
+                print(pysickled)
+                new_name = pysickled.replace(".", "_").replace("_tmp", ".fa")
+                print(new_name, "new name", "infile:", os.path.join(path_dct["pysickle"],"ps_out_si", new_name))
+                if state.done(new_name.split(".")[0], 99, [os.path.join(path_dct["MSA_pep"], new_name.split(".")[0]+".msa")]):
+                    continue
+                scheduler.submit(run_prank, priority=costs.prank(new_name.split(".")[0], os.path.join(path_dct["pysickle"],"ps_out_si", pysickled), phase=99),
+                                 program=CONF['Paths']['prank'],infile=os.path.join(path_dct["pysickle"],"ps_out_si", pysickled),
+                                 outfile= os.path.join(path_dct["MSA_pep"], new_name.split(".")[0]+".msa"),
+                                 cpu=1, db=db, cache=CONF['Cache']['dir'],
+                                 log_dir=path_dct["logs"], timeout=timeout_for("prank", new_name.split(".")[0]), retry=retry_policy(),
+                                 orthogroup=new_name.split(".")[0], run_id=run_id,
+                                 phase=99)
+            db_store_estimates(db, run_id, costs.pop_estimates())
+            scheduler.join()
+            for pysickled in pysickled_files:
+                new_name = pysickled.replace(".", "_").replace("_tmp", ".fa")
+                #nwo we still need the new nuc
+                nucfa = [n for n in os.listdir(path_dct["nuc"]) if n.split(".")[0] == pysickled.split(".")[0]][0]
+                orthogroup=new_name.split(".")[0]
+                outfile = os.path.join(path_dct["MSA_nuc"], orthogroup+".msa")
+                if state.done(orthogroup, 10, [outfile + ".paml"]):
+                    continue
+                scheduler.submit(pal2nal_runner(), program=CONF['Paths']['pal2nal'], pep_msa=os.path.join(path_dct["MSA_pep"], new_name.split(".")[0]+".msa"),
+                                 outfile=outfile, nuc_fa=os.path.join(path_dct["nuc"], nucfa), db=db, phase=10,run_id=run_id, orthogroup=orthogroup,
+                                 log_dir=path_dct["logs"], timeout=timeout_for("pal2nal", orthogroup), retry=retry_policy())
+            scheduler.join()
+            for pysickled in pysickled_files:
+                orthogroup = pysickled.replace(".", "_").replace("_tmp", ".fa").split(".")[0]
+                outfile = os.path.join(path_dct["MSA_nuc"], orthogroup+".msa")
+                #merge back
+                shutil.copy(outfile+".paml", os.path.join(path_dct["codeml"], orthogroup+".paml"))
 
         phase = 3 #raxml
-    if phase == 3: #this will fail if raxml was run there before
-        for pep_msa in os.listdir(path_dct["MSA_pep"]):
-            if pep_msa.endswith(".msa"):
-                orthogroup = os.path.basename(pep_msa).split(".")[0]
-                run_raxml(program=CONF['Paths']['raxml'], pep_msa=os.path.join(path_dct["MSA_pep"], pep_msa), outdir=path_dct['tree'],
-                          num_bootstraps=int(CONF['RAxML']['num_bootstraps']), db=db, model=CONF['RAxML']['model'],
-                          orthogroup=orthogroup, run_id=run_id,
-                          phase=phase, workdir=os.path.abspath(path_dct["tree"]))
+    if phase == 3:
+        pep_msas = [m for m in os.listdir(path_dct["MSA_pep"]) if m.endswith(".msa") and
+                    not state.done(m.split(".")[0], 3, [raxml_tree_file(m.split(".")[0], path_dct)])]
+        chunked = {}
+        for pep_msa in pep_msas:
+            orthogroup = os.path.basename(pep_msa).split(".")[0]
+            threads = raxml_threads(os.path.join(path_dct["MSA_pep"], pep_msa), concurrent=len(pep_msas))
+            chunks = raxml_chunks(os.path.join(path_dct["MSA_pep"], pep_msa))
+            if chunks:  # the consensus follows once all chunks are done
+                chunked[orthogroup] = len(chunks)
+                for k, num_bootstraps, seed in chunks:
+                    if state.chunk_done(chunk_file(os.path.abspath(path_dct["tree"]), orthogroup, k), num_bootstraps):
+                        continue
+                    cost = costs.raxml(orthogroup, num_bootstraps, pep_fa=os.path.join(path_dct["MSA_pep"], pep_msa),
+                                       phase=31)
+                    scheduler.submit(run_raxml_bootstraps, cores=threads, priority=cost, num_cpu=threads,
+                                     **raxml_chunk_kwargs(orthogroup, os.path.join(path_dct["MSA_pep"], pep_msa),
+                                                          k, num_bootstraps, seed, path_dct, db, run_id))
+                continue
+            cost = costs.raxml(orthogroup, CONF['RAxML']['num_bootstraps'],
+                               paml=os.path.join(path_dct["MSA_nuc"], orthogroup + ".paml"),
+                               pep_fa=os.path.join(path_dct["MSA_pep"], pep_msa))
+            scheduler.submit(run_raxml, cores=threads, priority=cost,
+                             program=CONF['Paths']['raxml'], pep_msa=os.path.join(path_dct["MSA_pep"], pep_msa), outdir=path_dct['tree'],
+                             num_bootstraps=int(CONF['RAxML']['num_bootstraps']), db=db, model=CONF['RAxML']['model'],
+                             num_cpu=threads, cache=CONF['Cache']['dir'],
+                             log_dir=path_dct["logs"], timeout=timeout_for("raxml", orthogroup), retry=retry_policy(),
+                             orthogroup=orthogroup, run_id=run_id,
+                             phase=phase, workdir=os.path.abspath(path_dct["tree"]), **scratch_kwargs())
+        db_store_estimates(db, run_id, costs.pop_estimates())
+        scheduler.join()
+        for orthogroup in sorted(chunked):
+            scheduler.submit(run_raxml_consensus, **raxml_consensus_kwargs(orthogroup, chunked[orthogroup],
+                                                                           path_dct, db, run_id))
+        scheduler.join()
         phase = 4
 
     if phase == 4:
@@ -549,27 +1028,35 @@ def main():
                 print(orthogroup)
                 print(pamlfile, mrc)
                 print(regex)
-
-                run_ctl_maker(paml_file=pamlfile, tree_file=treefile, model=CONF['Codeml']['models'],
-                              outfile=treefile, regex=CONF['Labels']['regex'],
-                              depth=int(CONF['Labels']['level']), db=db,
-                              orthogroup=orthogroup, run_id=run_id,
-                              phase=phase)
+                if state.done(orthogroup, 4):
+                    continue
+                scheduler.submit(run_ctl_maker, paml_file=pamlfile, tree_file=treefile, model=CONF['Codeml']['models'],
+                                 outfile=treefile, regex=CONF['Labels']['regex'],
+                                 depth=int(CONF['Labels']['level']), db=db,
+                                 orthogroup=orthogroup, run_id=run_id,
+                                 phase=phase)
+        scheduler.join()
         phase = 5
     if phase == 5:
         for ctl in os.listdir(path_dct["codeml"]):
             if ctl.endswith(".ctl"):
                 workdir = path_dct["codeml"]
                 orthogroup = ctl.split(".")[0]
-                run_codeml(program=CONF['Paths']['codeml'], ctl_file=ctl, work_dir=workdir,
-                           db=db, orthogroup=orthogroup,
-                           run_id=run_id, phase=phase)
+                if state.codeml_done(ctl, workdir):
+                    continue
+                cost = costs.codeml(orthogroup, ctl, paml=os.path.join(workdir, orthogroup + ".paml"))
+                scheduler.submit(run_codeml, priority=cost,
+                                 program=CONF['Paths']['codeml'], ctl_file=ctl, work_dir=workdir,
+                                 cache=CONF['Cache']['dir'], db=db, orthogroup=orthogroup,
+                                 log_dir=path_dct["logs"],
+                                 timeout=timeout_for("codeml", orthogroup, codeml_model(ctl)), retry=retry_policy(),
+                                 run_id=run_id, phase=phase, **scratch_kwargs())
+        db_store_estimates(db, run_id, costs.pop_estimates())
+        scheduler.join()
         phase = 6
     if phase == 6:
         for codeml_file in os.listdir(path_dct['codeml']):
-            known_suffixes=["Ah0","Ah1","BM","M0","M1","M1a","M2",
-                            "M2a","M7","M8","M8a"]
-            if codeml_file.split(".")[-1] in known_suffixes:
+            if codeml_file.split(".")[-1] in KNOWN_SUFFIXES:
                 print(codeml_file)
                 shutil.copy(os.path.join(path_dct['codeml'], codeml_file), path_dct['results'])
 
@@ -580,10 +1067,11 @@ def main():
                 pairs[os.path.join(path_dct['results'],codeml_file)] = os.path.join(path_dct['results'], codeml_file.split(".Ah0")[0]+".Ah1")
             #todo other models
         for k, v in pairs.items():
-            orthogroup=k.split(".")[0] #todo indiv. names for each branch
-
+            orthogroup = os.path.basename(k).split(".")[0] #todo indiv. names for each branch
+            if state.summary_done(k, v):
+                continue
             run_codeml_summary(h0=k, h1=v, db=db, outfile_prefix=os.path.join(path_dct['results'], "result_"), orthogroup=orthogroup, run_id=run_id, phase=7)
-
+    scheduler.close()
 
         #cp to results folder
         #todo parse result folder
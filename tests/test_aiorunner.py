@@ -0,0 +1,84 @@
+__author__ = 'jmass'
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from helpers import backtranslate
+from helpers.dbhelper import db_check_run, migrate_db
+if sys.version_info[0] > 2:
+    import asyncio
+    from helpers.aiorunner import AsyncRunner, ToolFailed, ToolTimeout, NATIVE, current_job
+    from helpers.rusage import JobUsage
+
+
+@unittest.skipIf(sys.version_info[0] < 3, "the asyncio runner is Python 3 only")
+class AsyncRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_loop(self, awaitable):
+        """run_until_complete(awaitable()) in a new event loop"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(awaitable())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def run_tool(self, argv, **kwargs):
+        job = JobUsage(in_process=False)
+        current_job.set(job)  # the task of run_until_complete gets a copy of this context
+        return self.run_loop(lambda: AsyncRunner().exec_tool(argv, **kwargs)), job.finish()
+
+    def test_exit_code_and_rusage(self):
+        (retval, err), usage = self.run_tool(["sh", "-c", "echo failed >&2; exit 3"])
+        self.assertEqual((retval, err), (3, b"failed\n"))
+        self.assertEqual(usage["processes"], 1)
+        self.assertTrue(usage["maxrss"] > 0)
+
+    def test_killed(self):
+        (retval, err), usage = self.run_tool(["sh", "-c", "kill -9 $$"])
+        self.assertEqual(retval, -9)
+
+    def test_timeout(self):
+        self.assertRaises(ToolTimeout, self.run_tool, ["sleep", "30"], timeout=0.5)
+
+    def test_no_such_tool(self):
+        self.assertRaises(ToolFailed, self.run_tool, [os.path.join(self.dir, "prank")])
+
+    def test_concurrent_tools(self):
+        runner = AsyncRunner()
+        res = self.run_loop(lambda: asyncio.gather(*[runner.exec_tool(["sh", "-c", "exit {}".format(i)])
+                                                for i in range(8)]))
+        self.assertEqual([r[0] for r in res], list(range(8)))
+
+    @unittest.skipIf(backtranslate.np is None, "the back translation needs NumPy")
+    def test_native_backtranslate(self):
+        self.assertTrue("run_backtranslate" in NATIVE)
+        db = os.path.join(self.dir, "phasePAML.db")
+        db_check_run(db, "run", {"OG1": ["a", "b"]})
+        migrate_db(db)
+        pep_msa = os.path.join(self.dir, "OG1.msa")
+        nuc_fa = os.path.join(self.dir, "OG1.fa")
+        with open(pep_msa, 'w') as f:
+            f.write(">a\nM-K\n>b\nMRK\n")
+        with open(nuc_fa, 'w') as f:
+            f.write(">a\nATGAAA\n>b\nATGCGTAAA\n")
+        outfile = os.path.join(self.dir, "OG1")
+        status = self.run_loop(lambda: AsyncRunner().run_backtranslate(pep_msa=pep_msa, nuc_fa=nuc_fa, outfile=outfile,
+                                                                  db=db, run_id=1, orthogroup="OG1", phase=2))
+        self.assertEqual(status, "s")
+        self.assertTrue(os.path.isfile(outfile + ".paml") and os.path.isfile(outfile + ".pamlg"))
+        con = sqlite3.connect(db)
+        self.assertEqual(con.execute('SELECT status FROM phase_state WHERE phase = 2;').fetchall(), [("s",)])
+        con.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
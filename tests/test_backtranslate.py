@@ -0,0 +1,56 @@
+__author__ = 'jmass'
+import unittest
+from helpers import backtranslate
+from helpers.backtranslate import BackTranslationException
+
+
+@unittest.skipIf(backtranslate.np is None, "the back translation needs NumPy")
+class CodonAlignmentTest(unittest.TestCase):
+    def rows(self, pep_aln, nuc):
+        names, codon_aln = backtranslate.codon_alignment(pep_aln, nuc)
+        return dict(backtranslate.as_rows(names, codon_aln))
+
+    def test_gaps(self):
+        rows = self.rows([("a", "M-K"), ("b", "MRK")], {"a": "ATGAAA", "b": "ATGCGTAAA"})
+        self.assertEqual(rows, {"a": "ATG---AAA", "b": "ATGCGTAAA"})
+
+    def test_trailing_nucleotides(self):
+        rows = self.rows([("a", "MK")], {"a": "ATGAAATAG"})
+        self.assertEqual(rows, {"a": "ATGAAA"})
+
+    def test_ambiguous_codon(self):
+        rows = self.rows([("a", "MX")], {"a": "ATGNNA"})
+        self.assertEqual(rows, {"a": "ATGNNA"})
+
+    def test_terminal_stop(self):
+        pep_aln = [("a", "MK*"), ("b", "MR*")]
+        rows = self.rows(pep_aln, {"a": "ATGAAATAA", "b": "ATGCGT"})
+        self.assertEqual(rows, {"a": "ATGAAATAA", "b": "ATGCGT---"})
+        names, codon_aln = backtranslate.codon_alignment(pep_aln, {"a": "ATGAAATAA", "b": "ATGCGT"})
+        self.assertEqual(list(backtranslate.nogap_columns(codon_aln)), [True, True, False])
+
+    def test_terminal_stop_before_gaps(self):
+        rows = self.rows([("a", "MK*-"), ("b", "MRKK")], {"a": "ATGAAA", "b": "ATGCGTAAAAAG"})
+        self.assertEqual(rows["a"], "ATGAAA------")
+
+    def test_short_cds(self):
+        self.assertRaises(BackTranslationException, backtranslate.codon_alignment,
+                          [("a", "MKK")], {"a": "ATG"})
+        self.assertRaises(BackTranslationException, backtranslate.codon_alignment,
+                          [("a", "MK*")], {"a": "ATG"})
+
+    def test_wrong_codon(self):
+        self.assertRaises(BackTranslationException, backtranslate.codon_alignment,
+                          [("a", "MK")], {"a": "ATGCGT"})
+
+    def test_ragged_rows(self):
+        self.assertRaises(BackTranslationException, backtranslate.codon_alignment,
+                          [("a", "MK"), ("b", "MRK")], {"a": "ATGAAA", "b": "ATGCGTAAA"})
+
+    def test_missing_cds(self):
+        self.assertRaises(BackTranslationException, backtranslate.codon_alignment,
+                          [("a", "MK")], {"b": "ATGAAA"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+__author__ = 'jmass'
+import os
+import shutil
+import tempfile
+import unittest
+from helpers.bootstraps import bootstrap_chunks, chunk_file, count_trees, merge_bootstraps
+
+
+class BootstrapsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_chunk(self, chunk, trees):
+        with open(chunk_file(self.dir, "OG1", chunk), 'w') as f:
+            f.write("".join("({},b{});\n".format(chunk, i) for i in range(trees)))
+
+    def test_chunks(self):
+        self.assertEqual(bootstrap_chunks(10, 3), [(0, 4, 123), (1, 3, 124), (2, 3, 125)])
+        self.assertEqual(bootstrap_chunks(2, 5, bootstrap_seed=1), [(0, 1, 1), (1, 1, 2)])
+        self.assertEqual(bootstrap_chunks(100, 0), [(0, 100, 123)])
+
+    def test_merge(self):
+        for k, n, seed in bootstrap_chunks(5, 2):
+            self.write_chunk(k, n)
+        out = os.path.join(self.dir, "out")
+        os.mkdir(out)
+        merged = merge_bootstraps(self.dir, "OG1", 2, 5, out_dir=out)
+        self.assertEqual(merged, os.path.join(out, "RAxML_bootstrap.OG1"))
+        self.assertEqual(count_trees(merged), 5)
+        with open(merged) as f:
+            self.assertEqual(f.readline(), "(0,b0);\n")
+
+    def test_missing_trees(self):
+        self.write_chunk(0, 3)
+        self.write_chunk(1, 1)
+        self.assertRaises(ValueError, merge_bootstraps, self.dir, "OG1", 2, 5)
+        self.assertEqual(count_trees(chunk_file(self.dir, "OG1", 2)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
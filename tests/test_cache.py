@@ -0,0 +1,50 @@
+__author__ = 'jmass'
+import os
+import shutil
+import tempfile
+import unittest
+from helpers.cache import ArtifactCache
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self.dir, "cache"))
+        self.infile = self.write("OG1.fa", ">a\nMKK\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_miss_then_hit(self):
+        key = self.cache.key(files=[self.infile], args=["prank", "+F"])
+        outfile = os.path.join(self.dir, "OG1.msa")
+        self.assertFalse(self.cache.fetch(key, {"msa": outfile}))
+        self.write("OG1.msa", ">a\nMKK\n")
+        self.cache.store(key, {"msa": outfile})
+        os.remove(outfile)
+        self.assertTrue(self.cache.fetch(key, {"msa": outfile}))
+        with open(outfile) as f:
+            self.assertEqual(f.read(), ">a\nMKK\n")
+
+    def test_key(self):
+        key = self.cache.key(files=[self.infile], args=["prank", "+F"])
+        self.assertEqual(key, self.cache.key(files=[self.infile], args=["prank", "+F"]))
+        self.assertNotEqual(key, self.cache.key(files=[self.infile], args=["prank"]))
+        other = self.write("OG2.fa", ">a\nMKR\n")
+        self.assertNotEqual(key, self.cache.key(files=[other], args=["prank", "+F"]))
+
+    def test_incomplete_entry(self):
+        key = self.cache.key(files=[self.infile])
+        tree = self.write("tree", "(a,b);\n")
+        self.cache.store(key, {"bootstrap": tree})
+        self.assertFalse(self.cache.fetch(key, {"bootstrap": tree + ".1", "bestTree": tree + ".2"}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+__author__ = 'jmass'
+import os
+import shutil
+import sqlite3
+import time
+import tempfile
+import unittest
+from helpers.dbhelper import db_check_run, db_log_phase, db_get_phase_status, migrate_db, db_get_run_id
+from helpers.dbhelper import db_running_jobs, db_compact
+
+USAGE = {"wall": 2.0, "utime": 1.0, "stime": 0.5, "maxrss": 10, "inblock": 0, "oublock": 0, "processes": 1}
+
+
+class DbTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "phasePAML.db")
+        self.archive = os.path.join(self.dir, "phasePAML.archive.db")
+        db_check_run(self.db, "run1", {"OG1": ["a", "b"], "OG2": ["c"]})
+        db_check_run(self.db, "run2", {"OG1": ["a"]})
+        migrate_db(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def count(self, db, query):
+        con = sqlite3.connect(db)
+        try:
+            return con.execute(query).fetchone()[0]
+        finally:
+            con.close()
+
+
+class PhaseStateTest(DbTest):
+    def state(self, orthogroup, phase, run_id=1):
+        con = sqlite3.connect(self.db)
+        try:
+            return con.execute('SELECT status, attempts, ended IS NOT NULL, phase_id FROM phase_state '
+                               'WHERE run_id = ? AND orthogroup = ? AND phase = ?;',
+                               (run_id, orthogroup, phase)).fetchone()
+        finally:
+            con.close()
+
+    def latest(self, orthogroup, phase, run_id=1):
+        return self.count(self.db, 'SELECT MAX(id) FROM phase WHERE run_id = {} AND orthogroup = "{}" '
+                                   'AND phase = {};'.format(run_id, orthogroup, phase))
+
+    def test_registered(self):
+        self.assertEqual(self.state("OG2", 0)[:3], ("s", 0, 1))
+
+    def test_attempts(self):
+        db_log_phase(self.db, 1, "OG1", 1, "r")
+        self.assertEqual(self.state("OG1", 1), ("r", 1, 0, self.latest("OG1", 1)))
+        db_log_phase(self.db, 1, "OG1", 1, "f", failure="oom")
+        db_log_phase(self.db, 1, "OG1", 1, "r", attempt=2)
+        self.assertEqual(self.state("OG1", 1), ("r", 2, 0, self.latest("OG1", 1)))
+        db_log_phase(self.db, 1, "OG1", 1, "s", attempt=2)
+        self.assertEqual(self.state("OG1", 1), ("s", 2, 1, self.latest("OG1", 1)))
+        self.assertEqual(self.state("OG1", 1, run_id=2), None)
+        self.assertEqual(db_get_phase_status(self.db, 1)[("OG1", 1)], "s")
+
+    def test_migrate_db(self):
+        """a db of a version without phase_state, sequence and the phase columns"""
+        db = os.path.join(self.dir, "old.db")
+        con = sqlite3.connect(db)
+        con.execute('CREATE TABLE run (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT);')
+        con.execute('CREATE TABLE orthoinfo (run_id INTEGER, orthogroup TEXT, headers TEXT);')
+        con.execute('CREATE TABLE phase (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER, phase INTEGER, '
+                    'orthogroup TEXT, status TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL);')
+        con.execute('INSERT INTO run(name) VALUES ("old");')
+        con.execute('INSERT INTO orthoinfo VALUES (1, "OG1", "a,b");')
+        for phase, status in ((0, "s"), (1, "r"), (1, "f"), (1, "r"), (1, "s"), (2, "r")):
+            con.execute('INSERT INTO phase(run_id, phase, orthogroup, status) VALUES (1, ?, "OG1", ?);',
+                        (phase, status))
+        con.commit()
+        con.close()
+        migrate_db(db)
+        migrate_db(db)  # twice is the same as once
+        con = sqlite3.connect(db)
+        self.assertEqual(con.execute('PRAGMA journal_mode;').fetchone()[0], "wal")
+        self.assertEqual(con.execute('SELECT phase, status, attempts, phase_id FROM phase_state '
+                                     'ORDER BY phase;').fetchall(), [(0, "s", 0, 1), (1, "s", 2, 5), (2, "r", 1, 6)])
+        self.assertEqual(con.execute('SELECT headers FROM orthoinfo_headers;').fetchall(), [("a,b",)])
+        indexes = [r[0] for r in con.execute('SELECT name FROM sqlite_master WHERE type = "index";')]
+        self.assertTrue("phase_latest" in indexes and "phase_status" in indexes)
+        con.close()
+        db_log_phase(db, 1, "OG1", 2, "s", attempt=1)
+        self.assertEqual(db_get_phase_status(db, 1), {("OG1", 0): "s", ("OG1", 1): "s", ("OG1", 2): "s"})
+
+
+class CompactTest(DbTest):
+    def setUp(self):
+        DbTest.setUp(self)
+        for orthogroup in ("OG1", "OG2"):
+            for phase in (1, 3):
+                db_log_phase(self.db, 1, orthogroup, phase, "r", attempt=1)
+                db_log_phase(self.db, 1, orthogroup, phase, "f", failure="oom", attempt=1, usage=USAGE)
+                db_log_phase(self.db, 1, orthogroup, phase, "r", attempt=2)
+                db_log_phase(self.db, 1, orthogroup, phase, "s", attempt=2, usage=USAGE)
+        db_log_phase(self.db, 2, "OG1", 1, "r", attempt=1)
+
+    def test_compact(self):
+        before = db_get_phase_status(self.db, 1)
+        self.assertEqual(db_compact(self.db, self.archive, [1]), 12)
+        self.assertEqual(db_get_phase_status(self.db, 1), before)
+        self.assertEqual(self.count(self.db, 'SELECT COUNT(*) FROM phase WHERE run_id = 1 AND phase > 0;'), 4)
+        self.assertEqual(self.count(self.db, 'SELECT COUNT(*) FROM resource_usage;'), 4)
+        self.assertEqual(self.count(self.archive, 'SELECT COUNT(*) FROM phase WHERE phase > 0;'), 16)
+        self.assertEqual(self.count(self.archive, 'SELECT COUNT(*) FROM resource_usage;'), 8)
+        self.assertEqual(self.count(self.db, 'SELECT SUM(attempts) FROM phase_summary WHERE phase > 0;'), 8)
+        self.assertEqual(self.count(self.db, 'SELECT SUM(wall) FROM phase_summary;'), 16.0)
+        # again into the same archive: nothing left to move, the summary stays
+        self.assertEqual(db_compact(self.db, self.archive, [1]), 0)
+        self.assertEqual(self.count(self.db, 'SELECT SUM(attempts) FROM phase_summary WHERE phase > 0;'), 8)
+
+    def test_running_jobs(self):
+        self.assertEqual(db_running_jobs(self.db, [1, 2]), [(2, "OG1", 1)])
+        self.assertEqual(db_compact(self.db, self.archive, [2]), 0)
+        self.assertEqual(self.count(self.db, 'SELECT COUNT(*) FROM phase WHERE run_id = 2;'), 2)
+
+    def test_force(self):
+        db_log_phase(self.db, 2, "OG1", 1, "r", attempt=2)  # a killed run, its job never ended
+        self.assertEqual(db_compact(self.db, self.archive, [2], force=True), 1)
+        self.assertEqual(db_get_phase_status(self.db, 2)[("OG1", 1)], "r")
+
+    def test_journal_mode(self):
+        db = os.path.join(self.dir, "nfs.db")
+        db_check_run(db, "run1", {"OG1": ["a"]})
+        migrate_db(db, journal_mode="delete")
+        db_log_phase(db, 1, "OG1", 1, "r")
+        db_log_phase(db, 1, "OG1", 1, "s")
+        self.assertEqual(db_compact(db, self.archive, [1], journal_mode="delete"), 1)
+        con = sqlite3.connect(db)
+        self.assertEqual(con.execute('PRAGMA journal_mode;').fetchone()[0], "delete")
+        con.close()
+
+class RegisterTest(DbTest):
+    def register(self, name, orthogroups):
+        """seconds db_check_run takes for a new run of orthogroups orthogroups"""
+        dct = dict(("OG{}".format(i), ["{}_{}".format(name, i), "b{}".format(i)]) for i in range(orthogroups))
+        started = time.time()
+        db_check_run(self.db, name, dct)
+        return time.time() - started
+
+    def test_quotes(self):
+        db_check_run(self.db, 'run "3"', {'OG"1': ['seq"a', "seq'b"]})
+        self.assertEqual(db_get_run_id(self.db, 'run "3"'), [(3,)])
+        con = sqlite3.connect(self.db)
+        self.assertEqual(con.execute('SELECT orthogroup, headers FROM orthoinfo_headers WHERE run_id = 3;').fetchall(),
+                         [('OG"1', 'seq"a,seq\'b')])
+        con.close()
+        self.assertEqual(db_get_phase_status(self.db, 3), {('OG"1', 0): "s"})
+
+    def test_linear(self):
+        small = min(self.register("small{}".format(i), 1000) for i in range(3))
+        large = self.register("large", 10000)
+        self.assertEqual(self.count(self.db, 'SELECT COUNT(*) FROM phase_state WHERE phase = 0;'), 13003)
+        self.assertTrue(large < 30 * small, "1k orthogroups {:.3f} s, 10k {:.3f} s".format(small, large))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+__author__ = 'jmass'
+import errno
+import unittest
+from helpers import failures
+from helpers.failures import classify, error_kind, retry_delay, scale_resources, resubmit, resubmitted
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_stderr(self):
+        self.assertEqual(classify(1, b"std::bad_alloc\n"), failures.OOM)
+        self.assertEqual(classify(1, "write failed: No space left on device"), failures.IO)
+        self.assertEqual(classify(255, "ERROR: alignment lengths differ"), failures.INPUT)
+        self.assertEqual(classify(1, "segmentation fault"), failures.TOOL)
+
+    def test_exit_code(self):
+        self.assertEqual(classify(-9), failures.OOM)
+        self.assertEqual(classify(137, ""), failures.OOM)
+        self.assertEqual(classify(-9, timed_out=True), failures.TIMEOUT)
+
+    def test_error_kind(self):
+        self.assertEqual(error_kind(IOError(errno.ENOENT, "no such file")), failures.INPUT)
+        self.assertEqual(error_kind(OSError(errno.EIO, "input/output error")), failures.IO)
+        self.assertEqual(error_kind(ValueError("bad alignment")), failures.INPUT)
+
+
+class RetryTest(unittest.TestCase):
+    policy = {"attempts": 3, "backoff": 60, "timeout_factor": 2}
+
+    def test_delay(self):
+        self.assertEqual(retry_delay(self.policy, 1, failures.OOM), 60)
+        self.assertEqual(retry_delay(self.policy, 2, failures.IO), 120)
+        self.assertEqual(retry_delay(self.policy, 3, failures.IO), None)
+        self.assertEqual(retry_delay(self.policy, 1, failures.INPUT), None)
+        self.assertEqual(retry_delay(None, 1, failures.OOM), None)
+        self.assertEqual(retry_delay({"attempts": 20, "backoff": 60}, 19, failures.IO), failures.MAX_BACKOFF)
+
+    def test_scale_resources(self):
+        kwargs = {"timeout": 100}
+        scale_resources(self.policy, failures.TIMEOUT, kwargs)
+        self.assertEqual(kwargs["timeout"], 200)
+        scale_resources(self.policy, failures.OOM, kwargs)
+        self.assertEqual(kwargs["timeout"], 200)
+
+    def test_resubmit(self):
+        self.assertEqual(resubmitted(resubmit(5, {"attempt": 2})), (5, {"attempt": 2}))
+        self.assertEqual(resubmitted("s"), None)
+        self.assertEqual(resubmitted({"ok": True}), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
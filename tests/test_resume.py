@@ -0,0 +1,65 @@
+__author__ = 'jmass'
+import os
+import shutil
+import tempfile
+import unittest
+from helpers.dbhelper import db_check_run, db_log_phase, migrate_db
+from helpers.resume import RunState, msa_pairs
+
+
+def touch(*parts):
+    path = os.path.join(*parts)
+    with open(path, 'w') as f:
+        f.write(">x\nACGT\n")
+    return path
+
+
+class ResumeTest(unittest.TestCase):
+    """a run that stopped after phase 3 for OG1 and after phase 1 for OG2"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for d in ("nuc", "MSA_pep", "MSA_nuc", "tree"):
+            os.mkdir(os.path.join(self.dir, d))
+        self.db = os.path.join(self.dir, "phasePAML.db")
+        db_check_run(self.db, "run", {"OG1": ["a"], "OG2": ["b"]})
+        migrate_db(self.db)
+        for og, phases in (("OG1", (1, 2, 3)), ("OG2", (1,))):
+            for phase in phases:
+                db_log_phase(self.db, 1, og, phase, "r")
+                db_log_phase(self.db, 1, og, phase, "s")
+        for og in ("OG1", "OG2"):
+            touch(self.dir, "nuc", og + ".fa")
+            touch(self.dir, "MSA_pep", og + ".msa")
+        touch(self.dir, "MSA_pep", "OG1.msa.phy")  # written by raxml
+        touch(self.dir, "MSA_pep", "OG1.msa.reduced")
+        self.paml = [touch(self.dir, "MSA_nuc", "OG1.paml"), touch(self.dir, "MSA_nuc", "OG1.pamlg")]
+        self.tree = touch(self.dir, "tree", "RAxML_bipartitions.OG1")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_msa_pairs(self):
+        pairs = list(msa_pairs(os.path.join(self.dir, "MSA_pep"), os.path.join(self.dir, "nuc")))
+        self.assertEqual(pairs, [([os.path.join(self.dir, "nuc", og + ".fa")],
+                                  os.path.join(self.dir, "MSA_pep", og + ".msa")) for og in ("OG1", "OG2")])
+
+    def test_done(self):
+        state = RunState(self.db, 1)
+        self.assertTrue(state.done("OG1", 1))
+        self.assertTrue(state.done("OG1", 2, self.paml))
+        self.assertTrue(state.done("OG1", 3, [self.tree]))
+        self.assertFalse(state.done("OG2", 2))
+        os.remove(self.tree)
+        self.assertFalse(state.done("OG1", 3, [self.tree]))
+
+    def test_failed_attempt(self):
+        db_log_phase(self.db, 1, "OG1", 3, "r")
+        db_log_phase(self.db, 1, "OG1", 3, "f")
+        self.assertFalse(RunState(self.db, 1).done("OG1", 3, [self.tree]))
+
+    def test_without_db(self):
+        self.assertFalse(RunState(os.path.join(self.dir, "missing.db"), 1).done("OG1", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+__author__ = 'jmass'
+import time
+import unittest
+from helpers.scheduler import Scheduler
+from helpers.failures import resubmit
+
+
+def started(name, seconds=0.0):
+    start = time.time()
+    time.sleep(seconds)
+    return name, start
+
+
+def flaky(attempt=1, retry=None):
+    if attempt < 2:
+        return resubmit(0, dict(attempt=attempt + 1, retry=retry))
+    return attempt
+
+
+class SchedulerTest(unittest.TestCase):
+    def run_jobs(self, jobs, seconds=None):
+        scheduler = Scheduler(jobs=jobs)
+        results = []
+        callback = lambda ok, result: results.append(result)
+        seconds = seconds or {}
+        # submitted cheapest first, as os.listdir might list them
+        for name, priority in (("small", 1), ("medium", 5), ("large", 100), ("tiny", 0)):
+            scheduler.submit(started, callback=callback, priority=priority, name=name,
+                             seconds=seconds.get(name, 0.0))
+        scheduler.close()
+        return [name for name, start in sorted(results, key=lambda r: r[1])]
+
+    def test_serial_start_order(self):
+        self.assertEqual(self.run_jobs(1), ["large", "medium", "small", "tiny"])
+
+    def test_pool_start_order(self):
+        order = self.run_jobs(2, seconds={"large": 0.5, "medium": 0.2, "small": 0.2})
+        self.assertEqual(sorted(order[:2]), ["large", "medium"])
+        self.assertEqual(order[2:], ["small", "tiny"])
+
+    def test_tuple_priority(self):
+        scheduler = Scheduler(jobs=1)
+        results = []
+        for name, priority in (("a", (1, 9)), ("b", (2, 0)), ("c", (1, 10))):
+            scheduler.submit(started, callback=lambda ok, r: results.append(r[0]), priority=priority, name=name)
+        scheduler.close()
+        self.assertEqual(results, ["b", "c", "a"])
+
+    def test_failed_job(self):
+        scheduler = Scheduler(jobs=1)
+        results = []
+        scheduler.submit(started, callback=lambda ok, r: results.append(ok), name="x", seconds="x")
+        scheduler.submit(started, callback=lambda ok, r: results.append(ok), name="y")
+        scheduler.close()
+        self.assertEqual(results, [False, True])
+
+    def test_resubmitted_job(self):
+        scheduler = Scheduler(jobs=1)
+        results = []
+        scheduler.submit(flaky, callback=lambda ok, r: results.append(r), retry={"attempts": 2})
+        scheduler.close()
+        self.assertEqual(results, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()